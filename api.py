@@ -4,22 +4,85 @@ Defines all methods needed for the API. Implemented using Google Cloud Endpoints
 
 __author__ = 'Cesar'
 
+import json
 import endpoints
 from protorpc import remote
 import logging
 import messages
-from observador import Observador, ObservadorCreationError, GetObservadorError
-from casilla import Casilla, CasillaCreationError, GetCasillaError
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from observador import Observador, ObservadorCreationError, GetObservadorError, observador_cache
+import casilla
+from casilla import Casilla, CasillaActivity, CasillaCreationError, GetCasillaError
+from casilla_import import CasillaImport, CasillaImportError
+import timeline
+from timeline import TimelineError
+import assignment
+from assignment import AssignmentJob, AssignmentError
 from distrito import Distrito, DistritoCreationError
-from observacion import Observacion, ObservacionCreationError
+import observacion
+from observacion import Observacion, ObservacionCreationError, GetObservacionError
+import ingest
+from ingest import IngestError
 from location import Location, LocationCreationError
 from media import Media, MediaCreationError
 from nota import Nota, NotaCreationError
-from clasificacion import Clasificacion, GetClasificacionError, ClasificacionCreationError
+from clasificacion import Clasificacion, CatalogueVersion, GetClasificacionError, ClasificacionCreationError
+import rollup
+import sync
+import export
+from export import ObservacionExport, ExportError
 
 package = 'ObservadorElectoral'
 
 
+def casilla_message(c, distrito=None, observador=None):
+    """
+    Builds the Casilla message of a Casilla entity, the expanded fields are filled from the given distrito and
+    observador entities
+    """
+    r_c = messages.Casilla()
+    if c.observador:
+        r_c.observador = c.observador.urlsafe()
+    else:
+        r_c.observador = 'Observador no Asignado'
+    r_c.distrito = c.distrito.urlsafe()
+    r_c.national_id = c.national_id
+    r_c.loc = str(c.loc)
+    r_c.name = c.name
+    r_c.address = c.address
+    r_c.picture_url = c.picture_url
+    if distrito:
+        r_c.distrito_name = distrito.name
+    if observador:
+        r_c.observador_email = observador.email
+        r_c.observador_name = observador.name
+    if distrito or observador:
+        r_c.url_safe_key = c.key.urlsafe()
+    return r_c
+
+
+def assignment_result_message(result):
+    """
+    Builds the CasillaAssignmentResult message of a (email, national_id, ok, error) result
+    """
+    email, national_id, ok, error = result
+    return messages.CasillaAssignmentResult(casilla=national_id, observador=email, ok=ok, error=error)
+
+
+def checklist_tally_message(distrito, count, answers):
+    """
+    ChecklistTally message of a distrito, from {question: {answer: count}}
+    """
+    questions = []
+    for question in sorted(answers):
+        counts = sorted(answers[question].items(), key=lambda a: (-a[1], a[0]))
+        questions.append(messages.QuestionTally(question=question,
+                                                answered=sum(n for a, n in counts),
+                                                answers=[messages.AnswerCount(answer=a, count=n) for a, n in counts]))
+    return messages.ChecklistTally(distrito=distrito, count=count, questions=questions)
+
+
 @endpoints.api(name='backend', version='v1', hostname='observador-electoral.appspot.com')
 class ObservadorElectoralBackendApi(remote.Service):
     """
@@ -45,11 +108,12 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd - new_observador()] - installation_id = {0}".format(request.installation_id))
         resp = messages.CreateObservadorResponse()
         try:
-            Observador.create_in_datastore(email=request.email,
-                                           name=request.name,
-                                           age=request.age,
-                                           account_type=request.account_type,
-                                           installation_id=request.installation_id)
+            Observador.create_in_datastore_async(email=request.email,
+                                                 name=request.name,
+                                                 age=request.age,
+                                                 account_type=request.account_type,
+                                                 installation_id=request.installation_id,
+                                                 home=request.home).get_result()
         except ObservadorCreationError as e:
             resp.ok = False
             resp.error = e.value
@@ -69,12 +133,14 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd - get_observador()] - email = {0}".format(request.email))
         resp = messages.GetObservadorResponse()
         try:
-            retrieved_observador = Observador.get_from_datastore(email=request.email)
+            retrieved_observador = Observador.get_from_datastore_async(email=request.email).get_result()
             resp.email = retrieved_observador.email
             resp.name = retrieved_observador.name
             resp.age = retrieved_observador.age
             resp.account_type = retrieved_observador.account_type
             resp.installation_id = retrieved_observador.installation_id
+            if retrieved_observador.home:
+                resp.home = str(retrieved_observador.home)
         except GetObservadorError as e:
             resp.ok = False
             resp.error = e.value
@@ -86,6 +152,48 @@ class ObservadorElectoralBackendApi(remote.Service):
             resp.ok = True
         return resp
 
+    @endpoints.method(messages.UpdateObservador,
+                      messages.UpdateObservadorResponse,
+                      http_method='POST',
+                      name='observador.update',
+                      path='observador/update')
+    def update_observador(self, request):
+        """
+        Updates the profile of a observador based on it's email address
+        """
+        logging.debug("[FrontEnd - update_observador()] - email = {0}".format(request.email))
+        resp = messages.UpdateObservadorResponse()
+        try:
+            Observador.update_in_datastore_async(email=request.email,
+                                                 name=request.name,
+                                                 age=request.age,
+                                                 installation_id=request.installation_id,
+                                                 home=request.home).get_result()
+        except ObservadorCreationError as e:
+            resp.ok = False
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.GetObservadorCacheStats,
+                      messages.GetObservadorCacheStatsResponse,
+                      http_method='GET',
+                      name='observador.cache_stats',
+                      path='observador/cache_stats')
+    def observador_cache_stats(self, request):
+        """
+        Gets the hit/miss counters of the observador cache in the instance serving the request
+        """
+        logging.debug("[FrontEnd - observador_cache_stats()]")
+        resp = messages.GetObservadorCacheStatsResponse()
+        stats = observador_cache.stats()
+        resp.local_hits = stats['local_hits']
+        resp.memcache_hits = stats['memcache_hits']
+        resp.misses = stats['misses']
+        resp.ok = True
+        return resp
+
     """
     CASILLA
     """
@@ -107,12 +215,12 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.CreateCasillaResponse()
         try:
-            Casilla.create(loc=request.loc,
-                           name=request.name,
-                           address=request.address,
-                           picture_url=request.picture_url,
-                           national_id=request.national_id,
-                           distrito=request.distrito)
+            Casilla.create_async(loc=request.loc,
+                                 name=request.name,
+                                 address=request.address,
+                                 picture_url=request.picture_url,
+                                 national_id=request.national_id,
+                                 distrito=request.distrito).get_result()
         except CasillaCreationError as e:
             resp.error = e.value
         else:
@@ -131,7 +239,12 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - Get Casillas Assigned to Observador - Observador = {0}".format(request.email))
         resp = messages.GetCasillasAssignedToObservadorResponse()
         try:
-            resp.casillas = Casilla.get_based_on_observador(email=request.email)
+            if request.expand:
+                detailed = Casilla.get_detailed_based_on_observador_async(email=request.email).get_result()
+                resp.casillas = [c.key.urlsafe() for c, d, o in detailed]
+                resp.casillas_detail = [casilla_message(c, distrito=d, observador=o) for c, d, o in detailed]
+            else:
+                resp.casillas = Casilla.get_based_on_observador_async(email=request.email).get_result()
         except GetCasillaError as e:
             resp.error = e.value
         else:
@@ -150,22 +263,37 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - get_casilla_details - Casilla: {0}".format(request.casilla))
         resp = messages.GetCasillaDetailResponse()
         try:
-            r = Casilla.get_from_datastore(request.casilla)
-            r_c = messages.Casilla()
-
-            if r.observador:
-                r_c.observador = r.observador.urlsafe()
-            else:
-                r_c.observador = 'Observador no Asignado'
-            r_c.distrito = r.distrito.urlsafe()
-            r_c.national_id = r.national_id
-            r_c.loc = str(r.loc)
-            r_c.name = r.name
-            r_c.address = r.address
-            r_c.picture_url = r.picture_url
+            r = Casilla.get_from_datastore_async(request.casilla).get_result()
+            resp.casilla = casilla_message(r)
+        except GetCasillaError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
 
-            resp.casilla = r_c
-        except GetClasificacionError as e:
+    @endpoints.method(messages.GetNearbyCasillas,
+                      messages.GetNearbyCasillasResponse,
+                      http_method='POST',
+                      name='casilla.nearby',
+                      path='casilla/nearby')
+    def get_nearby_casillas(self, request):
+        """
+        Gets a page of the casillas nearest to a location, with their details and distance.
+        """
+        logging.debug("[FrontEnd] - get_nearby_casillas - loc = {0}".format(request.loc))
+        logging.debug("[FrontEnd] - get_nearby_casillas - limit = {0}".format(request.limit))
+        logging.debug("[FrontEnd] - get_nearby_casillas - radius = {0}".format(request.radius))
+        resp = messages.GetNearbyCasillasResponse()
+        try:
+            nearby, cursor = Casilla.get_nearby_async(loc=request.loc,
+                                                      limit=request.limit,
+                                                      radius=request.radius,
+                                                      cursor=request.cursor).get_result()
+            resp.casillas = [messages.NearbyCasilla(url_safe_key=c.key.urlsafe(),
+                                                    distance=d,
+                                                    casilla=casilla_message(c)) for d, c in nearby]
+            resp.cursor = cursor
+        except GetCasillaError as e:
             resp.error = e.value
         else:
             resp.ok = True
@@ -184,7 +312,8 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - assign - Observador: {0}".format(request.observador))
         resp = messages.AssignCasillaToObservadorResponse()
         try:
-            r = Casilla.assign_to_observador(email=request.observador, national_id=request.casilla)
+            r = Casilla.assign_to_observador_async(email=request.observador,
+                                                   national_id=request.casilla).get_result()
             r_c = messages.Casilla()
 
             if r:
@@ -198,6 +327,201 @@ class ObservadorElectoralBackendApi(remote.Service):
             resp.ok = True
         return resp
 
+    @endpoints.method(messages.AssignCasillasBulk,
+                      messages.AssignCasillasBulkResponse,
+                      http_method='POST',
+                      name='casilla.assign_bulk',
+                      path='casilla/assign_bulk')
+    def assign_casillas_bulk(self, request):
+        """
+        Assigns casillas to observadores in bulk, inline or as a background job
+        """
+        logging.debug("[FrontEnd] - assign_bulk - Pairs: {0}".format(len(request.assignments)))
+        logging.debug("[FrontEnd] - assign_bulk - Background: {0}".format(request.background))
+        resp = messages.AssignCasillasBulkResponse()
+        pairs = [(a.observador, a.casilla) for a in request.assignments]
+        try:
+            if request.background:
+                resp.job = AssignmentJob.start(pairs).urlsafe()
+            else:
+                resp.results = [assignment_result_message(r) for r in Casilla.assign_bulk_async(pairs).get_result()]
+        except AssignmentError as e:
+            resp.error = e.value
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.AutoAssignCasillas,
+                      messages.AutoAssignCasillasResponse,
+                      http_method='POST',
+                      name='casilla.auto_assign',
+                      path='casilla/auto_assign')
+    def auto_assign_casillas(self, request):
+        """
+        Plans the assignment of the casillas of the distritos to the nearest observadores, and applies it unless
+        dry_run
+        """
+        logging.debug("[FrontEnd] - auto_assign - Distritos: {0}".format(request.distritos))
+        logging.debug("[FrontEnd] - auto_assign - Capacity: {0}".format(request.capacity))
+        resp = messages.AutoAssignCasillasResponse()
+        try:
+            if request.capacity < 1:
+                raise AssignmentError('Capacity must be at least 1')
+            planned, resp.unassigned = assignment.plan(request.distritos,
+                                                       emails=request.observadores or None,
+                                                       capacity=request.capacity,
+                                                       keep_existing=request.keep_existing)
+            resp.total_distance = sum(d for email, national_id, d in planned)
+            distances = dict(((email, national_id), d) for email, national_id, d in planned)
+            pairs = [(email, national_id) for email, national_id, d in planned]
+            if request.dry_run:
+                results = [(email, national_id, None, None) for email, national_id in pairs]
+            elif request.background:
+                resp.job = AssignmentJob.start(pairs).urlsafe()
+                results = [(email, national_id, None, None) for email, national_id in pairs]
+            else:
+                results = Casilla.assign_bulk_async(pairs).get_result()
+            resp.results = [assignment_result_message(r) for r in results]
+            for message, (email, national_id) in zip(resp.results, pairs):
+                message.distance = distances[(email, national_id)]
+        except AssignmentError as e:
+            resp.error = e.value
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.GetAssignmentJob,
+                      messages.GetAssignmentJobResponse,
+                      http_method='POST',
+                      name='casilla.assign_bulk_status',
+                      path='casilla/assign_bulk_status')
+    def assign_casillas_bulk_status(self, request):
+        """
+        Gets the progress and results of a background bulk assignment
+        """
+        logging.debug("[FrontEnd] - assign_bulk_status - Job: {0}".format(request.job))
+        resp = messages.GetAssignmentJobResponse()
+        try:
+            job = AssignmentJob.get_status(request.job)
+            resp.status = job.status
+            resp.total = len(job.pairs)
+            resp.results = [assignment_result_message(r) for r in job.results]
+        except AssignmentError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.ImportCasillas,
+                      messages.ImportCasillasResponse,
+                      http_method='POST',
+                      name='casilla.import',
+                      path='casilla/import')
+    def import_casillas(self, request):
+        """
+        Starts a bulk import of casillas from a CSV or NDJSON file in Cloud Storage.
+        """
+        logging.debug("[FrontEnd] - import_casillas - source = {0}".format(request.source))
+        logging.debug("[FrontEnd] - import_casillas - format = {0}".format(request.file_format))
+        resp = messages.ImportCasillasResponse()
+        try:
+            key = CasillaImport.start(source=request.source, file_format=request.file_format)
+        except CasillaImportError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            resp.job = key.urlsafe()
+        return resp
+
+    @endpoints.method(messages.GetCasillaImportStatus,
+                      messages.GetCasillaImportStatusResponse,
+                      http_method='POST',
+                      name='casilla.import_status',
+                      path='casilla/import_status')
+    def casilla_import_status(self, request):
+        """
+        Gets the progress of a bulk import of casillas, optionally resuming it from its last checkpoint.
+        """
+        logging.debug("[FrontEnd] - casilla_import_status - job = {0}".format(request.job))
+        resp = messages.GetCasillaImportStatusResponse()
+        try:
+            if request.resume:
+                job = CasillaImport.resume(request.job)
+            else:
+                job = CasillaImport.get_status(request.job)
+            resp.status = job.status
+            resp.rows_ok = job.rows_ok
+            resp.rows_failed = job.rows_failed
+            resp.rows_per_second = job.rows_per_second
+            resp.errors = [messages.CasillaImportRowError(row=e['row'], error=e['error']) for e in job.errors or []]
+        except CasillaImportError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.GetCasillaTimeline,
+                      messages.GetCasillaTimelineResponse,
+                      http_method='POST',
+                      name='casilla.timeline',
+                      path='casilla/timeline')
+    def casilla_timeline(self, request):
+        """
+        Gets a page of the timeline of a casilla (observaciones, notas and medias), latest first, follow the cursor
+        for the next pages
+        """
+        logging.debug("[FrontEnd] - casilla_timeline - Casilla = {0}".format(request.casilla))
+        logging.debug("[FrontEnd] - casilla_timeline - Cursor = {0}".format(request.cursor))
+
+        resp = messages.GetCasillaTimelineResponse()
+        try:
+            items, resp.cursor, resp.more = timeline.get_page(request.casilla,
+                                                              request.cursor,
+                                                              request.page_size or timeline.PAGE_SIZE)
+        except TimelineError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            for item in items:
+                fields = dict((k, v) for k, v in item.items() if v is not None and k != 'date')
+                resp.items.append(messages.TimelineItem(date=item['date'].isoformat(), **fields))
+        return resp
+
+    @endpoints.method(messages.GetStaleCasillas,
+                      messages.GetStaleCasillasResponse,
+                      http_method='POST',
+                      name='casilla.stale',
+                      path='casilla/stale')
+    def stale_casillas(self, request):
+        """
+        Gets a page of the casillas without observaciones in the last minutes, optionally of a distrito, least
+        recently observed first
+        """
+        logging.debug("[FrontEnd] - stale_casillas - Minutes = {0}".format(request.minutes))
+        logging.debug("[FrontEnd] - stale_casillas - Distrito = {0}".format(request.distrito))
+
+        resp = messages.GetStaleCasillasResponse()
+        try:
+            page = CasillaActivity.get_stale(request.minutes,
+                                             request.distrito,
+                                             request.cursor,
+                                             request.page_size or casilla.STALE_PAGE_SIZE)
+            activities, resp.cursor, resp.more = page
+        except GetCasillaError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            for a in activities:
+                r_c = messages.StaleCasilla(national_id=a.key.id(), distrito=a.distrito.id() if a.distrito else None)
+                if a.last_observed > casilla.NEVER_OBSERVED:
+                    r_c.last_observed = a.last_observed.isoformat()
+                resp.casillas.append(r_c)
+        return resp
+
     """
     DISTRITO
     """
@@ -242,17 +566,79 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.CreateObservacionResponse()
         try:
-            url_safe_key = Observacion.save_to_datastore(casilla=request.casilla,
-                                                         observador=request.observador,
-                                                         clasificacion=request.clasificacion,
-                                                         filled_checklist=request.filled_checklist)
-        except ObservacionCreationError as e:
+            if request.background:
+                url_safe_key = ingest.enqueue_observacion(casilla=request.casilla,
+                                                          observador=request.observador,
+                                                          clasificacion=request.clasificacion,
+                                                          filled_checklist=request.filled_checklist,
+                                                          submission_id=request.submission_id)
+            else:
+                url_safe_key = Observacion.save_to_datastore_async(casilla=request.casilla,
+                                                                   observador=request.observador,
+                                                                   clasificacion=request.clasificacion,
+                                                                   filled_checklist=request.filled_checklist,
+                                                                   submission_id=request.submission_id)\
+                    .get_result()
+        except (ObservacionCreationError, IngestError) as e:
             resp.error = e.value
         else:
             resp.ok = True
             resp.url_safe_key = url_safe_key
         return resp
 
+    @endpoints.method(messages.GetIngestStatus,
+                      messages.GetIngestStatusResponse,
+                      http_method='POST',
+                      name='observacion.ingest_status',
+                      path='observacion/ingest_status')
+    def ingest_status(self, request):
+        """
+        Gets the status of an observacion created in background mode: pending, written or failed (with the reason)
+        """
+        logging.debug("[FrontEnd] - ingest_status - Observacion = {0}".format(request.url_safe_key))
+        resp = messages.GetIngestStatusResponse()
+        try:
+            resp.status, resp.reason = ingest.get_status(request.url_safe_key)
+        except IngestError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.ListObservaciones,
+                      messages.ListObservacionesResponse,
+                      http_method='POST',
+                      name='observacion.list',
+                      path='observacion/list')
+    def list_observaciones(self, request):
+        """
+        Gets a page of the observaciones of a casilla, latest first, follow the cursor for the next pages
+        """
+        logging.debug("[FrontEnd] - list_observaciones - Casilla = {0}".format(request.casilla))
+        logging.debug("[FrontEnd] - list_observaciones - Cursor = {0}".format(request.cursor))
+
+        resp = messages.ListObservacionesResponse()
+        try:
+            page = Observacion.get_page(request.casilla,
+                                        request.cursor,
+                                        request.page_size or observacion.LIST_PAGE_SIZE,
+                                        bool(request.projection))
+            observaciones, filled, resp.cursor, resp.more = page
+        except GetObservacionError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            for o, f in zip(observaciones, filled):
+                r_o = messages.Observacion(url_safe_key=o.key.urlsafe(), date=o.date.isoformat())
+                if o.observador:
+                    r_o.observador = o.observador.id()
+                if o.clasificacion:
+                    r_o.clasificacion = o.clasificacion.urlsafe()
+                if f is not None:
+                    r_o.filled_checklist = json.dumps(f)
+                resp.observaciones.append(r_o)
+        return resp
+
     @endpoints.method(messages.GetNumberOfObservaciones,
                       messages.GetNumberOfObservacionesResponse,
                       http_method='GET',
@@ -266,14 +652,224 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.GetNumberOfObservacionesResponse()
         try:
-            number = Observacion.count()
-        except ObservacionCreationError as e:
+            number = Observacion.count_async().get_result()
+        except (ObservacionCreationError, GetObservacionError) as e:
             resp.error = e.value
         else:
             resp.ok = True
             resp.number_of_observaciones = number
         return resp
 
+    @endpoints.method(messages.ReconcileNumberOfObservaciones,
+                      messages.ReconcileNumberOfObservacionesResponse,
+                      http_method='POST',
+                      name='observacion.reconcile_number',
+                      path='observacion/reconcile_number')
+    def reconcile_total_number(self, request):
+        """
+        Starts a background job recomputing the observaciones counter from the datastore
+        """
+        logging.debug("[FrontEnd] - Reconcile Number of Observaciones")
+
+        resp = messages.ReconcileNumberOfObservacionesResponse()
+        try:
+            deferred.defer(observacion.reconcile_count)
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.GetObservacionRollups,
+                      messages.GetObservacionRollupsResponse,
+                      http_method='POST',
+                      name='observacion.rollups',
+                      path='observacion/rollups')
+    def observacion_rollups(self, request):
+        """
+        Gets the observaciones per distrito, clasificacion and 15 minutes bucket, and per casilla, from the rollups
+        """
+        logging.debug("[FrontEnd] - Rollups - Distrito = {0}".format(request.distrito))
+        logging.debug("[FrontEnd] - Rollups - Clasificacion = {0}".format(request.clasificacion))
+        logging.debug("[FrontEnd] - Rollups - Range = {0} - {1}".format(request.start, request.end))
+
+        resp = messages.GetObservacionRollupsResponse()
+        try:
+            distrito = ndb.Key(Distrito, request.distrito) if request.distrito else None
+            clasificacion = ndb.Key(urlsafe=request.clasificacion) if request.clasificacion else None
+            casillas_future = rollup.get_casillas_async(request.casillas)
+            # Buckets only for a range, read while the casillas are
+            buckets = []
+            if request.start or request.end:
+                buckets = rollup.get_buckets(distrito, clasificacion,
+                                             rollup.parse_bucket(request.start),
+                                             rollup.parse_bucket(request.end))
+            casillas = casillas_future.get_result()
+        except rollup.RollupError as e:
+            resp.error = e.value
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+            resp.buckets = [messages.RollupBucket(distrito=d.id(),
+                                                  clasificacion=c.urlsafe(),
+                                                  bucket=bucket.strftime(rollup.BUCKET_FORMAT),
+                                                  count=count) for d, c, bucket, count in buckets]
+            resp.total = sum(b.count for b in resp.buckets)
+            resp.casillas = [messages.CasillaRollup(casilla=n,
+                                                    count=count,
+                                                    last_observed=last.isoformat() if last else None)
+                             for n, count, last in casillas]
+        return resp
+
+    @endpoints.method(messages.GetChecklistTallies,
+                      messages.GetChecklistTalliesResponse,
+                      http_method='POST',
+                      name='observacion.tallies',
+                      path='observacion/tallies')
+    def observacion_tallies(self, request):
+        """
+        Gets the answers to each question of the checklist of a clasificacion, per distrito, from the tallies
+        """
+        logging.debug("[FrontEnd] - Tallies - Clasificacion = {0}".format(request.clasificacion))
+        logging.debug("[FrontEnd] - Tallies - Distrito = {0}".format(request.distrito))
+
+        resp = messages.GetChecklistTalliesResponse()
+        try:
+            distrito = ndb.Key(Distrito, request.distrito) if request.distrito else None
+            tallies = rollup.get_tallies(ndb.Key(urlsafe=request.clasificacion), distrito)
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+            total = {}
+            for d, count, answers in tallies:
+                resp.distritos.append(checklist_tally_message(d.id(), count, answers))
+                for question, tally in answers.items():
+                    merged = total.setdefault(question, {})
+                    for answer, n in tally.items():
+                        merged[answer] = merged.get(answer, 0) + n
+            resp.total = checklist_tally_message(None, sum(count for d, count, answers in tallies), total)
+        return resp
+
+    @endpoints.method(messages.ExportObservaciones,
+                      messages.ExportObservacionesResponse,
+                      http_method='POST',
+                      name='observacion.export',
+                      path='observacion/export')
+    def export_observaciones(self, request):
+        """
+        Gets a page of the observaciones export, follow the cursor for the next pages
+        """
+        logging.debug("[FrontEnd] - Export - Format = {0}".format(request.file_format))
+        logging.debug("[FrontEnd] - Export - Cursor = {0}".format(request.cursor))
+
+        resp = messages.ExportObservacionesResponse()
+        try:
+            distrito = ndb.Key(Distrito, request.distrito) if request.distrito else None
+            clasificacion = ndb.Key(urlsafe=request.clasificacion) if request.clasificacion else None
+            data, resp.rows, resp.cursor, resp.more = export.get_page(request.file_format,
+                                                                      request.cursor,
+                                                                      request.page_size or export.PAGE_SIZE,
+                                                                      distrito,
+                                                                      clasificacion)
+            resp.data = data.decode('utf-8')
+        except ExportError as e:
+            resp.error = e.value
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.StartObservacionesExport,
+                      messages.StartObservacionesExportResponse,
+                      http_method='POST',
+                      name='observacion.export_start',
+                      path='observacion/export_start')
+    def start_observaciones_export(self, request):
+        """
+        Starts an export of observaciones to a CSV or NDJSON file in Cloud Storage.
+        """
+        logging.debug("[FrontEnd] - start_observaciones_export - destination = {0}".format(request.destination))
+        logging.debug("[FrontEnd] - start_observaciones_export - format = {0}".format(request.file_format))
+        resp = messages.StartObservacionesExportResponse()
+        try:
+            key = ObservacionExport.start(destination=request.destination,
+                                          file_format=request.file_format,
+                                          distrito=request.distrito,
+                                          clasificacion=request.clasificacion)
+        except ExportError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            resp.job = key.urlsafe()
+        return resp
+
+    @endpoints.method(messages.GetObservacionesExportStatus,
+                      messages.GetObservacionesExportStatusResponse,
+                      http_method='POST',
+                      name='observacion.export_status',
+                      path='observacion/export_status')
+    def observaciones_export_status(self, request):
+        """
+        Gets the progress of an export of observaciones, optionally resuming it from its last checkpoint.
+        """
+        logging.debug("[FrontEnd] - observaciones_export_status - job = {0}".format(request.job))
+        resp = messages.GetObservacionesExportStatusResponse()
+        try:
+            if request.resume:
+                job = ObservacionExport.resume(request.job)
+            else:
+                job = ObservacionExport.get_status(request.job)
+            resp.status = job.status
+            resp.rows = job.rows
+        except ExportError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.BackfillObservacionRollups,
+                      messages.BackfillObservacionRollupsResponse,
+                      http_method='POST',
+                      name='observacion.backfill_rollups',
+                      path='observacion/backfill_rollups')
+    def backfill_observacion_rollups(self, request):
+        """
+        Starts a background job adding the observaciones written before the rollups existed to them
+        """
+        logging.debug("[FrontEnd] - Backfill Rollups")
+
+        resp = messages.BackfillObservacionRollupsResponse()
+        try:
+            deferred.defer(observacion.backfill_rollups)
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.CompactObservacionChecklists,
+                      messages.CompactObservacionChecklistsResponse,
+                      http_method='POST',
+                      name='observacion.compact_checklists',
+                      path='observacion/compact_checklists')
+    def compact_observacion_checklists(self, request):
+        """
+        Starts a background job encoding the filled checklists stored before the compact encoding
+        """
+        logging.debug("[FrontEnd] - Compact Checklists")
+
+        resp = messages.CompactObservacionChecklistsResponse()
+        try:
+            deferred.defer(observacion.compact_checklists)
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
     """
     MEDIA
     """
@@ -292,7 +888,10 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.CreateMediaResponse()
         try:
-            Media.create(observacion=request.observacion, name=request.name, m_type=request.m_type)
+            Media.create_async(observacion=request.observacion,
+                               name=request.name,
+                               m_type=request.m_type,
+                               submission_id=request.submission_id).get_result()
         except MediaCreationError as e:
             resp.error = e.value
         else:
@@ -316,7 +915,9 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.CreateNotaResponse()
         try:
-            Nota.create(observacion=request.observacion, name=request.name)
+            Nota.create_async(observacion=request.observacion,
+                              name=request.name,
+                              submission_id=request.submission_id).get_result()
         except NotaCreationError as e:
             resp.error = e.value
         else:
@@ -339,14 +940,18 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - Observacion - Loc = {0}".format(request.loc))
 
         resp = messages.CreateLocationResponse()
+        # Store the location and find a near casilla concurrently
+        location_future = Location.create_async(observador=request.observador,
+                                                loc=request.loc,
+                                                submission_id=request.submission_id)
+        casilla_future = Casilla.get_based_on_location_async(request.loc, 10)
         try:
-            Location.create(observador=request.observador, loc=request.loc)
+            location_future.get_result()
         except LocationCreationError as e:
             resp.error = e.value
         else:
             try:
-                # Find a near casilla
-                c = Casilla.get_based_on_location(request.loc, 10)
+                c = casilla_future.get_result()
             except GetCasillaError as e:
                 resp.error = e.value
             else:
@@ -372,7 +977,8 @@ class ObservadorElectoralBackendApi(remote.Service):
 
         resp = messages.CreateClasificacionResponse()
         try:
-            Clasificacion.create(name=request.name, checklist=request.checklist, repeatable=request.repeatable)
+            Clasificacion.create_async(name=request.name, checklist=request.checklist,
+                                       repeatable=request.repeatable).get_result()
         except ClasificacionCreationError as e:
             resp.error = e.value
         else:
@@ -391,7 +997,7 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - Get Available Clasificaciones - Casilla = {0}".format(request.casilla))
         resp = messages.GetAvailableClasificacionesResponse()
         try:
-            resp.clasificacion = Clasificacion.get_available(request.casilla)
+            resp.clasificacion = Clasificacion.get_available_async(request.casilla).get_result()
         except GetClasificacionError as e:
             resp.error = e.value
         else:
@@ -410,13 +1016,42 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - Get All Clasificaciones")
         resp = messages.GetAllClasificacionesResponse()
         try:
-            resp.clasificacion = Clasificacion.get_all()
+            resp.clasificacion = Clasificacion.get_all_async().get_result()
         except GetClasificacionError as e:
             resp.error = e.value
         else:
             resp.ok = True
         return resp
 
+    @endpoints.method(messages.GetClasificacionCatalogue,
+                      messages.GetClasificacionCatalogueResponse,
+                      http_method='POST',
+                      name='clasificacion.catalogue',
+                      path='clasificacion/catalogue')
+    def get_clasificacion_catalogue(self, request):
+        """
+        Gets every clasificacion with its details, unless the client already has the current version.
+        """
+        logging.debug("[FrontEnd] - get_clasificacion_catalogue - Version: {0}".format(request.version))
+        resp = messages.GetClasificacionCatalogueResponse()
+        try:
+            version = str(CatalogueVersion.get_version_async().get_result())
+            if request.version == version:
+                resp.not_modified = True
+            else:
+                version, catalogue = Clasificacion.get_versioned_catalogue_async().get_result()
+                version = str(version)
+                resp.clasificaciones = [messages.Clasificacion(url_safe_key=c.key.urlsafe(),
+                                                               name=c.name,
+                                                               checklist=c.checklist,
+                                                               repeatable=c.repeatable) for c in catalogue]
+            resp.version = version
+        except Exception as e:
+            resp.error = e.__str__()
+        else:
+            resp.ok = True
+        return resp
+
     @endpoints.method(messages.GetClasificacionDetails,
                       messages.GetClasificacionDetailsResponse,
                       http_method='POST',
@@ -429,7 +1064,7 @@ class ObservadorElectoralBackendApi(remote.Service):
         logging.debug("[FrontEnd] - get_clasificacion_details - Clasificacion: {0}".format(request.clasificacion))
         resp = messages.GetClasificacionDetailsResponse()
         try:
-            r = Clasificacion.get_details(request.clasificacion)
+            r = Clasificacion.get_details_async(request.clasificacion).get_result()
             r_c = messages.Clasificacion()
             r_c.name = r.name
             r_c.checklist = r.checklist
@@ -441,4 +1076,39 @@ class ObservadorElectoralBackendApi(remote.Service):
             resp.ok = True
         return resp
 
+    """
+    SYNC
+    """
+    @endpoints.method(messages.SyncUpload,
+                      messages.SyncUploadResponse,
+                      http_method='POST',
+                      name='sync.upload',
+                      path='sync/upload')
+    def sync_upload(self, request):
+        """
+        Creates the observaciones, notas, medias and locations a device queued while offline, in one batch.
+        """
+        logging.debug("[FrontEnd] - sync_upload - Items: {0}".format(len(request.items)))
+        resp = messages.SyncUploadResponse()
+        try:
+            items = []
+            for item in request.items:
+                for kind in sync.KINDS:
+                    submission = getattr(item, kind)
+                    if submission is not None:
+                        fields = dict((f.name, submission.get_assigned_value(f.name)) for f in submission.all_fields())
+                        fields.update(kind=kind, ref=item.ref)
+                        items.append(fields)
+                        break
+                else:
+                    items.append({'kind': None, 'ref': item.ref})
+            results = sync.upload(items)
+        except sync.SyncError as e:
+            resp.error = e.value
+        else:
+            resp.ok = True
+            resp.results = [messages.SyncItemResult(ref=item.ref, ok=not error, url_safe_key=key, error=error)
+                            for item, (key, error) in zip(request.items, results)]
+        return resp
+
 app = endpoints.api_server([ObservadorElectoralBackendApi])
@@ -0,0 +1,14 @@
+"""
+App Engine configuration loaded before the app: third party libraries are vendored in lib/, install them with
+
+    pip install -t lib -r requirements.txt
+"""
+__author__ = 'Cesar'
+
+
+import os
+from google.appengine.ext import vendor
+
+
+if os.path.isdir(os.path.join(os.path.dirname(__file__), 'lib')):
+    vendor.add('lib')
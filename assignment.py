@@ -0,0 +1,316 @@
+"""
+Defines the bulk assignment of Casillas to observadores in the Observador-Electoral platform: the background jobs
+that apply assignments in bulk, and the planner that computes travel distance minimising assignments.
+"""
+__author__ = 'Cesar'
+
+
+import time
+import logging
+import datetime
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+
+import spatial
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from location import LastLocation
+
+
+# Pairs applied per task
+TASK_BATCH_SIZE = 500
+# Distritos with up to this many casillas and observador slots are solved exactly (Hungarian), larger ones greedily
+HUNGARIAN_MAX_SIZE = 60
+# Nearest casillas considered per free observador slot by the greedy solver
+GREEDY_CANDIDATES = 8
+# Reported Locations considered for the observadores without home coordinate
+LOCATION_WINDOW_HOURS = 12
+
+
+class AssignmentJob(ndb.Model):
+    """
+    Represents a bulk assignment of Casillas to observadores.
+
+        - pairs: List of [email, national_id] to assign
+        - results: List of [email, national_id, ok, error] for the pairs already applied
+        - status: pending, running or done
+    """
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    status = ndb.StringProperty(choices=['pending', 'running', 'done'], default='pending')
+    pairs = ndb.JsonProperty(compressed=True)
+    results = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def start(cls, pairs):
+        """
+        Creates a new bulk assignment job and enqueues its first task.
+        :param:
+            - pairs: list of (email, national_id)
+
+        :return:
+            Key of the new job
+        """
+        try:
+            job = AssignmentJob(pairs=[list(p) for p in pairs], results=[])
+            key = job.put()
+            deferred.defer(run, key.urlsafe())
+        except Exception as e:
+            logging.exception("[AssignmentJob] - Error starting assignment", exc_info=True)
+            raise AssignmentError('Error starting the assignment: '+e.__str__())
+        else:
+            logging.info('[AssignmentJob] - New assignment {0}: {1} pairs'.format(key, len(pairs)))
+            return key
+
+    @classmethod
+    def get_status(cls, url_safe_key):
+        """
+        Gets a bulk assignment job from its URL safe key
+        """
+        try:
+            job = ndb.Key(urlsafe=url_safe_key).get()
+            if not job:
+                raise AssignmentError('Assignment does not exist')
+        except AssignmentError:
+            raise
+        except Exception as e:
+            raise AssignmentError('Error getting the assignment: '+e.__str__())
+        else:
+            return job
+
+
+def run(url_safe_key):
+    """
+    Applies the next TASK_BATCH_SIZE pairs of the job and chains the next task.
+    """
+    job = ndb.Key(urlsafe=url_safe_key).get()
+    if not job or job.status == 'done':
+        return
+    start = len(job.results)
+    batch = [tuple(p) for p in job.pairs[start:start + TASK_BATCH_SIZE]]
+    job.results.extend([list(r) for r in Casilla.assign_bulk(batch)])
+    job.status = 'done' if len(job.results) >= len(job.pairs) else 'running'
+    job.put()
+    if job.status != 'done':
+        deferred.defer(run, url_safe_key)
+
+
+def plan(distritos, emails=None, capacity=1, keep_existing=True):
+    """
+    Computes a travel distance minimising assignment of the casillas of the given distritos to observadores.
+
+    Observadores are placed at their home coordinate or, when missing, at their last reported Location. Every
+    observador is attached to the distrito of its nearest casilla, each distrito is solved on its own (Hungarian
+    when small, greedy on k-nearest candidates otherwise) and the casillas left without observador are matched
+    greedily with the observadores that still have free slots.
+
+    Args:
+        - distritos:        national_ids of the distritos to plan
+        - emails:           Observadores available, all the observadores if None
+        - capacity:         Casillas per observador
+        - keep_existing:    Keep the casillas already assigned to an available observador
+
+    Returns:
+        (assignments, unassigned): list of (email, national_id, distance in meters) and the national_ids of the
+        casillas left without observador
+    """
+    started = time.time()
+    futures = [Casilla.query(Casilla.distrito == ndb.Key(Distrito, d)).fetch_async() for d in distritos]
+    if emails is None:
+        observadores = Observador.query().fetch()
+    else:
+        observadores = [o for o in ndb.get_multi([ndb.Key(Observador, e) for e in emails]) if o]
+    positions = _observador_positions(observadores)
+    casillas = [c for f in futures for c in f.get_result() if c.loc]
+
+    remaining = dict((email, capacity) for email in positions)
+    to_plan = {}
+    distrito_of = {}
+    for c in casillas:
+        current = c.observador.id() if c.observador else None
+        if keep_existing and current in remaining and remaining[current] > 0:
+            remaining[current] -= 1
+            continue
+        to_plan[c.key.id()] = (c.loc.lat, c.loc.lon)
+        distrito_of[c.key.id()] = c.distrito
+
+    # Attach every observador with free slots to the distrito of its nearest casilla
+    index = spatial.GridIndex()
+    for national_id, (lat, lon) in to_plan.items():
+        index.add(national_id, lat, lon)
+    groups = {}
+    for email, free in remaining.items():
+        if free <= 0:
+            continue
+        nearest = index.nearest(positions[email][0], positions[email][1], k=1)
+        if nearest:
+            groups.setdefault(distrito_of[nearest[0][1]], ([], {}))[1][email] = free
+    for national_id, distrito in distrito_of.items():
+        groups.setdefault(distrito, ([], {}))[0].append(national_id)
+
+    assignments = []
+    for distrito, (national_ids, group_remaining) in groups.items():
+        group_casillas = dict((n, to_plan[n]) for n in national_ids)
+        if len(national_ids) <= HUNGARIAN_MAX_SIZE and sum(group_remaining.values()) <= HUNGARIAN_MAX_SIZE:
+            planned = _solve_exact(group_casillas, group_remaining, positions)
+        else:
+            planned = _solve_greedy(group_casillas, group_remaining, positions)
+        for email, national_id, d in planned:
+            remaining[email] -= 1
+            del to_plan[national_id]
+        assignments.extend(planned)
+
+    # Casillas of distritos without enough observadores
+    if to_plan:
+        assignments.extend(_solve_greedy(to_plan, remaining, positions))
+    assigned = set(national_id for email, national_id, d in assignments)
+    unassigned = sorted(n for n in to_plan if n not in assigned)
+    logging.info('[Assignment] - Planned {0} casillas ({1} unassigned) for {2} observadores in {3:.2f}s'
+                 .format(len(assignments), len(unassigned), len(positions), time.time() - started))
+    return assignments, unassigned
+
+
+def _observador_positions(observadores):
+    """
+    Coordinates of the observadores: home, or last Location reported in the last LOCATION_WINDOW_HOURS
+    """
+    positions = {}
+    missing = set()
+    for o in observadores:
+        if o.home:
+            positions[o.key.id()] = (o.home.lat, o.home.lon)
+        else:
+            missing.add(o.key)
+    if missing:
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=LOCATION_WINDOW_HOURS)
+        positions.update(LastLocation.get_positions([k.id() for k in missing], since))
+    return positions
+
+
+def _solve_greedy(casillas, remaining, positions):
+    """
+    Greedy assignment on candidate edges: the GREEDY_CANDIDATES nearest casillas of every free slot, shortest first.
+    Casillas whose candidates were all taken go to the nearest observador that still has free slots.
+
+    Args:
+        - casillas:     dict national_id -> (lat, lon)
+        - remaining:    dict email -> free slots, not modified
+        - positions:    dict email -> (lat, lon)
+
+    Returns:
+        list of (email, national_id, distance in meters)
+    """
+    free = dict((e, n) for e, n in remaining.items() if n > 0)
+    index = spatial.GridIndex()
+    for national_id, (lat, lon) in casillas.items():
+        index.add(national_id, lat, lon)
+    edges = []
+    for email, n in free.items():
+        lat, lon = positions[email]
+        for d, national_id, p_lat, p_lon in index.nearest(lat, lon, k=GREEDY_CANDIDATES * n):
+            edges.append((d, email, national_id))
+    edges.sort()
+
+    planned = []
+    for d, email, national_id in edges:
+        if free[email] > 0 and national_id in index.points:
+            planned.append((email, national_id, d))
+            free[email] -= 1
+            index.remove(national_id)
+
+    observadores = spatial.GridIndex()
+    for email, n in free.items():
+        if n > 0:
+            observadores.add(email, *positions[email])
+    for national_id, (lat, lon) in sorted(index.points.items()):
+        nearest = observadores.nearest(lat, lon, k=1)
+        if not nearest:
+            break
+        d, email = nearest[0][:2]
+        planned.append((email, national_id, d))
+        free[email] -= 1
+        if not free[email]:
+            observadores.remove(email)
+    return planned
+
+
+def _solve_exact(casillas, remaining, positions):
+    """
+    Minimum total distance assignment of casillas to observador slots (Hungarian algorithm), same arguments and
+    result as _solve_greedy
+    """
+    national_ids = sorted(casillas)
+    slots = [email for email, n in sorted(remaining.items()) for i in range(max(n, 0))]
+    if not national_ids or not slots:
+        return []
+    cost = [[spatial.distance(casillas[n][0], casillas[n][1], positions[e][0], positions[e][1]) for e in slots]
+            for n in national_ids]
+    if len(national_ids) <= len(slots):
+        return [(slots[j], national_ids[i], cost[i][j]) for i, j in enumerate(_hungarian(cost))]
+    transposed = [list(row) for row in zip(*cost)]
+    return [(slots[i], national_ids[j], cost[j][i]) for i, j in enumerate(_hungarian(transposed))]
+
+
+def _hungarian(cost):
+    """
+    Minimum cost assignment of every row of cost (n x m matrix, n <= m) to a distinct column, O(n^2 m).
+
+    Returns:
+        list with the column assigned to every row
+    """
+    n, m = len(cost), len(cost[0])
+    inf = float('inf')
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = cost[i0 - 1]
+            delta = inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+    rows = [None] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            rows[p[j] - 1] = j - 1
+    return rows
+
+
+class AssignmentError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,195 @@
+"""
+Defines the caches used in front of the datastore in the Observador-Electoral platform.
+
+    - LRUCache:     bounded per instance cache with TTL
+    - TwoTierCache: LRUCache -> memcache -> loader (datastore), with hit/miss counters
+    - submission_cache: Dedup cache of the create requests carrying a client submission id
+"""
+__author__ = 'Cesar'
+
+
+import time
+import pickle
+import threading
+import collections
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+class LRUCache(object):
+    """
+    Bounded, thread safe, least recently used cache local to the instance. Entries expire after ttl seconds. Every
+    get returns the cached object itself, shared by all the requests of the instance: cache immutable values (or
+    snapshots, see TwoTierCache) and never modify what it returns.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value for key, None if not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                return None
+            # Re-insert as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache(object):
+    """
+    Read-through cache: per instance LRUCache, then memcache, then the loader. Values are stored in memcache under
+    the given namespace, so they must be picklable (ndb entities are). None values are never cached.
+
+    Invalidation removes the value from the local tier of this instance and from memcache, other instances keep their
+    local copy until local_ttl expires.
+
+    The local tier shares the cached value between the requests of the instance, as LRUCache does: cache immutable
+    values, or values that are never modified (say so where the cache is declared). With copy_on_read, the local
+    tier keeps a pickled snapshot of the values that are not immutable (entities, lists, dicts) and every get returns
+    a copy of its own, so a request modifying what it got does not change what the other requests read. Snapshots
+    cost an unpickle per hit, use them only for the values callers may modify.
+    """
+
+    def __init__(self, namespace, max_size=1000, local_ttl=60, memcache_ttl=600, copy_on_read=False):
+        self.namespace = namespace
+        self.memcache_ttl = memcache_ttl
+        self.copy_on_read = copy_on_read
+        self.local = LRUCache(max_size, local_ttl)
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'memcache_hits': 0, 'misses': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+    @ndb.tasklet
+    def get_async(self, key, loader):
+        """
+        Gets the value for key from the first tier holding it.
+
+        Args:
+            - key:      String key
+            - loader:   Function called with key on a miss in both tiers, returns a future for the value or None
+
+        Returns:
+            Future for the value, None if the loader did not find it
+        """
+        value = self._get_local(key)
+        if value is not None:
+            self._count('local_hits')
+            raise ndb.Return(value)
+
+        ctx = ndb.get_context()
+        value = yield ctx.memcache_get(key, namespace=self.namespace)
+        if value is not None:
+            self._count('memcache_hits')
+            self._set_local(key, value)
+            raise ndb.Return(value)
+
+        self._count('misses')
+        value = yield loader(key)
+        if value is not None:
+            self._set_local(key, value)
+            yield ctx.memcache_set(key, value, time=self.memcache_ttl, namespace=self.namespace)
+        raise ndb.Return(value)
+
+    def get(self, key, loader):
+        """
+        Synchronous get_async()
+        """
+        return self.get_async(key, loader).get_result()
+
+    @ndb.tasklet
+    def peek_async(self, key):
+        """
+        Gets the value for key from the cache tiers only, the datastore is never read.
+
+        Returns:
+            Future for the value, None if not cached
+        """
+        value = self._get_local(key)
+        if value is None:
+            value = yield ndb.get_context().memcache_get(key, namespace=self.namespace)
+            if value is not None:
+                self._set_local(key, value)
+        raise ndb.Return(value)
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        memcache.set(key, value, time=self.memcache_ttl, namespace=self.namespace)
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self._set_local(key, value)
+        memcache.set_multi(mapping, time=self.memcache_ttl, namespace=self.namespace)
+
+    @ndb.tasklet
+    def set_async(self, key, value):
+        self._set_local(key, value)
+        yield ndb.get_context().memcache_set(key, value, time=self.memcache_ttl, namespace=self.namespace)
+
+    def invalidate(self, key):
+        self.local.delete(key)
+        memcache.delete(key, namespace=self.namespace)
+
+    def stats(self):
+        """
+        Returns a copy of the hit/miss counters of this instance
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _get_local(self, key):
+        value = self.local.get(key)
+        return pickle.loads(value.data) if isinstance(value, _Snapshot) else value
+
+    def _set_local(self, key, value):
+        if self.copy_on_read and not isinstance(value, IMMUTABLE_TYPES):
+            value = _Snapshot(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.local.set(key, value)
+
+
+# Values the local tier of a copy_on_read TwoTierCache shares as they are, the others are snapshotted
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+class _Snapshot(object):
+    """
+    Pickled value in the local tier of a TwoTierCache
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+# Results of client submissions (Kind:submission_id -> URL safe key of the entity), replays are answered from here
+submission_cache = TwoTierCache('submission', max_size=5000, local_ttl=600, memcache_ttl=24 * 60 * 60)
@@ -4,22 +4,49 @@ Defines the datastore and all interfaces needed for a Casilla in the Observador-
 __author__ = 'Cesar'
 
 
+import base64
 import logging
+import datetime
 from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.api import memcache
 from google.appengine.api import search
 
+import spatial
 from observador import Observador, GetObservadorError
-from distrito import Distrito
+from distrito import Distrito, distrito_cache
+
+
+# 'index': nearest casilla lookups answered by the in-process spatial index (casillas_index)
+# 'search': lookups sent to the CasillasIndex (Search API), also used as fallback if the spatial index fails
+LOCATION_MODE = 'index'
+# Upper bound for Search API nearest lookups without radius (meters)
+SEARCH_MAX_RADIUS = 50000
+# Page size limit of the nearby casillas listing
+NEARBY_MAX_LIMIT = 100
+# Casillas per cross-group transaction in bulk assignments (XG transactions span up to 25 entity groups)
+ASSIGN_BATCH_SIZE = 25
+# Recent observaciones of a casilla are recorded with a leading and a trailing write per period (seconds), see
+# CasillaActivity.record_async
+ACTIVITY_COALESCE_SECONDS = 60
+ACTIVITY_NAMESPACE = 'casilla-activity'
+ACTIVITY_CAS_RETRIES = 3
+ACTIVITY_BACKFILL_BATCH_SIZE = 200
+NEVER_OBSERVED = datetime.datetime(1970, 1, 1)
+# Page size of the stale casillas listing
+STALE_PAGE_SIZE = 100
+STALE_MAX_PAGE_SIZE = 500
 
 
 class Casilla(ndb.Model):
     """
-    Represents a casilla within the platform.
+    Represents a casilla within the platform. Keyed by national_id.
 
         - loc:          Lat, Lon
         - name:
         - address:
         - picture_url:
+        - updated:      Last write, used to refresh the spatial index incrementally
     """
 
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -30,9 +57,15 @@ class Casilla(ndb.Model):
     name = ndb.StringProperty()
     address = ndb.StringProperty()
     picture_url = ndb.StringProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def _post_put_hook(self, future):
+        if self.loc and self.key.string_id():
+            casillas_index.add(self.key.string_id(), self.loc.lat, self.loc.lon)
 
     @classmethod
-    def exists(cls, national_id):
+    @ndb.tasklet
+    def exists_async(cls, national_id):
         """
         Checks the datastore to find if the casilla (national_id) is already on it.
 
@@ -40,12 +73,18 @@ class Casilla(ndb.Model):
             national_id: (String) national_id from request
 
         Returns:
-            True if national_id exist False otherwise
+            Future, True if national_id exist False otherwise
         """
-        return cls.query(cls.national_id == national_id).count(1) == 1
+        c = yield cls.get_by_id_async(national_id)
+        raise ndb.Return(c is not None)
 
     @classmethod
-    def create(cls, distrito, national_id, name, loc, address, picture_url):
+    def exists(cls, national_id):
+        return cls.exists_async(national_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def create_async(cls, distrito, national_id, name, loc, address, picture_url):
         """
         Creates a new casilla in the datastore and a document for the Search API and includes it on the
         CasillasIndex.
@@ -59,101 +98,202 @@ class Casilla(ndb.Model):
             - picture_url:  String holding the url of the picture for the location
 
         Returns:
-            Key of new entity
+            Future, key of new entity
         """
-        try:
-            d = Distrito.get_from_datastore(distrito)
-            distrito_key = d.key
-            geo_pt = ndb.GeoPt(str(loc))
-            o = Casilla(loc=geo_pt,
+        @ndb.transactional_tasklet(xg=True)
+        def txn():
+            current = yield Casilla.get_by_id_async(national_id)
+            if current:
+                raise CasillaCreationError('Casilla already in platform')
+            o = Casilla(id=national_id,
+                        loc=geo_pt,
                         national_id=national_id,
                         distrito=distrito_key,
                         name=name,
                         address=address,
                         picture_url=picture_url)
-            key = o.put()
+            key, activity_key = yield (o.put_async(), CasillaActivity.for_casilla(o).put_async())
+            raise ndb.Return(key)
+
+        try:
+            d = Distrito.get_cached(distrito)
+            distrito_key = d.key
+            geo_pt = ndb.GeoPt(str(loc))
+            key = yield txn()
 
             # Generate document for search API
-            l_doc = search.Document(fields=[search.TextField(name='key',
-                                                             value=str(key)),
-                                            search.GeoField(name='loc',
-                                                            value=search.GeoPoint(geo_pt.lat,
-                                                                                  geo_pt.lon))])
             index = search.Index(name="CasillasIndex")
-            index.put(l_doc)
+            yield _search_result_async(index.put_async(Casilla.search_document(key, geo_pt)))
         except Exception:
             logging.exception("[casilla] - Error in create Casilla", exc_info=True)
             raise CasillaCreationError('Error creating the casilla in platform')
         else:
-            return key
+            raise ndb.Return(key)
 
     @classmethod
-    def get_from_datastore(cls, national_id):
+    def create(cls, distrito, national_id, name, loc, address, picture_url):
+        return cls.create_async(distrito, national_id, name, loc, address, picture_url).get_result()
+
+    @staticmethod
+    def search_document(key, geo_pt):
+        """
+        Builds the Search API document for a casilla, identified by its national_id.
+
+        Args:
+            - key:      Key of the casilla
+            - geo_pt:   GeoPt of the casilla
+
+        Returns:
+            search.Document for the CasillasIndex
+        """
+        return search.Document(doc_id=key.id(),
+                               fields=[search.TextField(name='key',
+                                                        value=key.urlsafe()),
+                                       search.GeoField(name='loc',
+                                                       value=search.GeoPoint(geo_pt.lat, geo_pt.lon))])
+
+    @classmethod
+    @ndb.tasklet
+    def get_from_datastore_async(cls, national_id):
         """
         Gets a casilla from datastore based on its id
-            :returns Casilla object
+            :returns Future, Casilla object
         """
         try:
-            if Casilla.exists(national_id):
-                query = Casilla.query(Casilla.national_id == national_id).fetch(limit=1)
-                u = query
-            else:
+            u = yield Casilla.get_by_id_async(national_id)
+            if not u:
                 raise GetCasillaError('Casilla does not exist')
         except Exception as e:
                 raise GetCasillaError('Error getting Casilla: '+e.__str__())
         else:
-            logging.debug("[Casilla] - Key = {0}".format(u[0].key))
-            logging.debug("[Casilla] - location = {0}".format(u[0].loc))
-            logging.debug("[Casilla] - national_id = {0}".format(u[0].national_id))
-            logging.debug("[Casilla] - distrito = {0}".format(u[0].distrito))
-            logging.debug("[Casilla] - name = {0}".format(u[0].name))
-            logging.debug("[Casilla] - address = {0}".format(u[0].address))
-            logging.debug("[Casilla] - picture_url = {0}".format(u[0].picture_url))
-            return u[0]
+            logging.debug("[Casilla] - Key = {0}".format(u.key))
+            logging.debug("[Casilla] - location = {0}".format(u.loc))
+            logging.debug("[Casilla] - national_id = {0}".format(u.national_id))
+            logging.debug("[Casilla] - distrito = {0}".format(u.distrito))
+            logging.debug("[Casilla] - name = {0}".format(u.name))
+            logging.debug("[Casilla] - address = {0}".format(u.address))
+            logging.debug("[Casilla] - picture_url = {0}".format(u.picture_url))
+            raise ndb.Return(u)
 
     @classmethod
-    def get_based_on_location(cls, loc, radius):
+    def get_from_datastore(cls, national_id):
+        return cls.get_from_datastore_async(national_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def nearest_keys_async(cls, lat, lng, k=1, radius=None):
+        """
+        Gets the keys of the k casillas nearest to a location. Answered by the spatial index (LOCATION_MODE) or by the
+        Search API.
+            :param lat, lng: (Float) location
+            :param k: (Integer) number of casillas
+            :param radius: (Float) optional maximum distance in meters
+            :returns Future, list of (distance in meters, Casilla key), nearest first
+        """
+        if LOCATION_MODE == 'index':
+            try:
+                index = casillas_index.get()
+            except Exception:
+                logging.exception('[Casilla] - Spatial index unavailable, using Search API')
+                index = None
+            if index is not None:
+                raise ndb.Return([(d, ndb.Key(Casilla, point_id))
+                                  for d, point_id, p_lat, p_lng in index.nearest(lat, lng, k, radius)])
+
+        # Search nearby Casillas in CasillasIndex (SearchAPI)
+        point = "geopoint(" + str(lat) + "," + str(lng) + ")"
+        query = "distance(loc, " + point + ") < " + str(radius or SEARCH_MAX_RADIUS)
+        options = search.QueryOptions(
+            limit=min(k, 1000),
+            sort_options=search.SortOptions(expressions=[
+                search.SortExpression(expression="distance(loc, " + point + ")",
+                                      direction=search.SortExpression.ASCENDING,
+                                      default_value=SEARCH_MAX_RADIUS)]),
+            returned_expressions=[search.FieldExpression(name='distance', expression="distance(loc, " + point + ")")])
+        results = yield _search_result_async(
+            search.Index('CasillasIndex').search_async(search.Query(query_string=query, options=options)))
+        nearest = []
+        for doc in results:
+            d = [e.value for e in doc.expressions if e.name == 'distance']
+            nearest.append((d[0] if d else None, ndb.Key(urlsafe=doc.field("key").value)))
+        raise ndb.Return(nearest)
+
+    @classmethod
+    def nearest_keys(cls, lat, lng, k=1, radius=None):
+        return cls.nearest_keys_async(lat, lng, k, radius).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_based_on_location_async(cls, loc, radius):
         """
-        Gets a casilla from datastore based on its location (lat,long)
-            :returns Casilla object
+        Gets the casilla nearest to a location (lat,long) within radius meters
+            :returns Future, Casilla object
         """
         try:
-            lat, lng = str(loc).split(',')
-            # Search nearby Casillas in LocationsIndex (SearchAPI)
-            index = search.Index('CasillasIndex')
-            query = "distance(loc, geopoint(" + str(lat) + "," + str(lng) + ")) < " + str(radius)
-            results = index.search(query)
-            for doc in results:
-                key = doc.field("key").value
-                logging.info('[Casilla] - Document! ' + str(key))
-                dummy, c_id = key.split(',')
-                c_id = c_id[:-1]
-                logging.debug('[Casilla] - Casilla ID: ' + str(int(c_id)))
-                c = Casilla.get_by_id(int(c_id))
+            lat, lng = [float(x) for x in str(loc).split(',')]
+            nearest = yield Casilla.nearest_keys_async(lat, lng, k=1, radius=radius)
+            c = None
+            for d, key in nearest:
+                logging.info('[Casilla] - Nearest! {0} at {1} m'.format(key, d))
+                c = yield key.get_async()
                 if c:
                     logging.debug('[Casilla] - Casilla: ' + str(c))
-                    return c
+                    break
                 else:
                     logging.exception('[Casilla] - Error in DataStore search! (index different than DataStore?)')
-            logging.debug('[Casilla] - Results Found =  ' + str(results.number_found))
-            if results.number_found == 0:
+            logging.debug('[Casilla] - Results Found =  ' + str(len(nearest)))
+            if not nearest:
                 raise GetCasillaError('No near Casillas found')
 
         except Exception as e:
             raise GetCasillaError('Error getting Casilla: '+e.__str__())
+        else:
+            raise ndb.Return(c)
 
     @classmethod
-    def get_based_on_observador(cls, email):
+    def get_based_on_location(cls, loc, radius):
+        return cls.get_based_on_location_async(loc, radius).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_nearby_async(cls, loc, limit, radius=None, cursor=None):
         """
-        Gets all casillas from datastore based on observador assigned to them
-            :returns list of Casilla object
+        Gets a page of the casillas nearest to a location (lat,long), nearest first, fetched with one get_multi.
+            :param loc: (String) lat,long
+            :param limit: (Integer) page size
+            :param radius: (Float) optional maximum distance in meters
+            :param cursor: (String) cursor returned by the previous page
+            :returns Future, (list of (distance in meters, Casilla), cursor of the next page or None)
         """
         try:
-            observador = Observador.get_from_datastore(email=email)
-            query_response = Casilla.query(Casilla.observador == observador.key).fetch()
+            lat, lng = [float(x) for x in str(loc).split(',')]
+            limit = max(1, min(limit or NEARBY_MAX_LIMIT, NEARBY_MAX_LIMIT))
+            offset = int(base64.urlsafe_b64decode(str(cursor))) if cursor else 0
+            nearest = yield Casilla.nearest_keys_async(lat, lng, k=offset + limit + 1, radius=radius)
+            page = nearest[offset:offset + limit]
+            casillas = yield ndb.get_multi_async([key for d, key in page])
+            next_cursor = base64.urlsafe_b64encode(str(offset + limit)) if len(nearest) > offset + limit else None
+        except Exception as e:
+            raise GetCasillaError('Error getting nearby Casillas: '+e.__str__())
+        else:
+            raise ndb.Return(([(d, c) for (d, key), c in zip(page, casillas) if c], next_cursor))
+
+    @classmethod
+    @ndb.tasklet
+    def get_based_on_observador_async(cls, email):
+        """
+        Gets all casillas from datastore based on observador assigned to them, the observador lookup and the casillas
+        query run concurrently.
+            :returns Future, list of URL safe keys of Casilla
+        """
+        try:
+            observador_key = ndb.Key(Observador, email)
+            observador, query_response = yield (Observador.get_from_datastore_async(email=email),
+                                                Casilla.query(Casilla.observador == observador_key)
+                                                .fetch_async(keys_only=True))
             casillas = []
             for c in query_response:
-                casillas.append(c.key.urlsafe())
+                casillas.append(c.urlsafe())
             if casillas:
                 pass
             else:
@@ -165,10 +305,35 @@ class Casilla(ndb.Model):
         else:
             for c in casillas:
                 logging.debug("[Casilla] = {0}".format(c))
-            return casillas
+            raise ndb.Return(casillas)
 
     @classmethod
-    def assign_to_observador(cls, email, national_id):
+    def get_based_on_observador(cls, email):
+        return cls.get_based_on_observador_async(email).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_detailed_based_on_observador_async(cls, email):
+        """
+        Gets all casillas from datastore based on observador assigned to them, with their distritos resolved from
+        distrito_cache.
+            :returns Future, list of (Casilla, Distrito, Observador)
+        """
+        try:
+            observador_key = ndb.Key(Observador, email)
+            observador, casillas = yield (Observador.get_from_datastore_async(email=email),
+                                          Casilla.query(Casilla.observador == observador_key).fetch_async())
+            if not casillas:
+                raise GetCasillaError('No casillas assigned to observador: {0}'.format(email))
+            by_key = dict((k, distrito_cache.get_by_key(k)) for k in set(c.distrito for c in casillas if c.distrito))
+        except Exception as e:
+            raise GetCasillaError('Error getting Casilla: '+e.__str__())
+        else:
+            raise ndb.Return([(c, by_key.get(c.distrito), observador) for c in casillas])
+
+    @classmethod
+    @ndb.tasklet
+    def assign_to_observador_async(cls, email, national_id):
         """
         Assigns a Casilla to a observador (email) in the platform.
 
@@ -177,15 +342,13 @@ class Casilla(ndb.Model):
             national_id: (String) national_id of the casilla to assign
 
         Returns:
-            True if assignment successful, False otherwise
+            Future, True if assignment successful, False otherwise
         """
         try:
-            o = Observador.get_from_datastore(email)
-            c = Casilla.get_from_datastore(national_id)
-
-            casilla = c.key.get()
+            o, casilla = yield (Observador.get_from_datastore_async(email),
+                                Casilla.get_from_datastore_async(national_id))
             casilla.observador = o.key
-            casilla.put()
+            yield casilla.put_async()
         except GetCasillaError:
             raise
         except GetObservadorError:
@@ -194,9 +357,274 @@ class Casilla(ndb.Model):
             logging.debug("[Casilla] - assign_to_observador(): Assignment successful!"
                           " casilla = {0} assigned to observador = {1}"
                           .format(casilla.national_id, o.email))
-            return True
+            raise ndb.Return(True)
+
+    @classmethod
+    def assign_to_observador(cls, email, national_id):
+        return cls.assign_to_observador_async(email, national_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def assign_bulk_async(cls, pairs):
+        """
+        Assigns Casillas to observadores in bulk. Observadores and Casillas are resolved with two get_multi, and the
+        assignments are applied in cross-group transactions of ASSIGN_BATCH_SIZE casillas, grouped by national_id so
+        concurrent bulk assignments touch the casillas in the same order.
+
+        Args:
+            pairs: list of (email, national_id), if a casilla appears more than once the last pair wins
+
+        Returns:
+            Future, list of (email, national_id, ok, error) in the order of pairs
+        """
+        results = [[email, national_id, False, None] for email, national_id in pairs]
+        latest = {}
+        for i, (email, national_id) in enumerate(pairs):
+            if national_id in latest:
+                results[latest[national_id]][3] = 'Superseded by a later pair for the same casilla'
+            latest[national_id] = i
+
+        national_ids = sorted(latest)
+        emails = list(set(pairs[latest[n]][0] for n in national_ids))
+        observadores, casillas = yield (ndb.get_multi_async([ndb.Key(Observador, e) for e in emails]),
+                                        ndb.get_multi_async([ndb.Key(Casilla, n) for n in national_ids]))
+        observador_keys = dict((e, o.key) for e, o in zip(emails, observadores) if o)
+
+        to_assign = []
+        for national_id, c in zip(national_ids, casillas):
+            i = latest[national_id]
+            email = pairs[i][0]
+            if not c:
+                results[i][3] = 'Casilla does not exist'
+            elif email not in observador_keys:
+                results[i][3] = 'Observador does not exist'
+            else:
+                to_assign.append(national_id)
+
+        @ndb.transactional_tasklet(xg=True)
+        def txn(batch):
+            current = yield ndb.get_multi_async([ndb.Key(Casilla, n) for n in batch])
+            for c in current:
+                c.observador = observador_keys[pairs[latest[c.key.id()]][0]]
+            yield ndb.put_multi_async(current)
+
+        @ndb.tasklet
+        def apply(batch):
+            try:
+                yield txn(batch)
+            except Exception as e:
+                logging.exception('[Casilla] - assign_bulk(): batch failed')
+                for n in batch:
+                    results[latest[n]][3] = 'Error assigning Casilla: '+e.__str__()
+            else:
+                for n in batch:
+                    results[latest[n]][2] = True
+
+        yield [apply(to_assign[i:i + ASSIGN_BATCH_SIZE]) for i in range(0, len(to_assign), ASSIGN_BATCH_SIZE)]
+        logging.debug("[Casilla] - assign_bulk(): {0} of {1} assignments successful"
+                      .format(len([r for r in results if r[2]]), len(pairs)))
+        raise ndb.Return([tuple(r) for r in results])
+
+    @classmethod
+    def assign_bulk(cls, pairs):
+        return cls.assign_bulk_async(pairs).get_result()
+
+
+class CasillaActivity(ndb.Model):
+    """
+    Represents the latest observacion of a casilla, for the coverage gap queries. Keyed by the national_id of the
+    casilla, created together with it.
+
+        - distrito:         Distrito of the casilla
+        - last_observed:    Date of the latest observacion, NEVER_OBSERVED until the first one. Written at most twice
+                            per ACTIVITY_COALESCE_SECONDS, so it can lag behind by that much
+    """
+
+    distrito = ndb.KeyProperty(kind=Distrito)
+    last_observed = ndb.DateTimeProperty(default=NEVER_OBSERVED)
+
+    @classmethod
+    def for_casilla(cls, casilla):
+        return CasillaActivity(id=casilla.key.id(), distrito=casilla.distrito)
+
+    @classmethod
+    @ndb.tasklet
+    def record_async(cls, observaciones):
+        """
+        Records the latest observacion of their casillas, once the observaciones are written. The writes of recent
+        observaciones are coalesced: their latest date is kept in memcache, the first one of a casilla in
+        ACTIVITY_COALESCE_SECONDS claims the casilla and writes, and a task at the end of the period writes the latest
+        date seen in it (flush_activity), so a busy casilla costs two writes per period instead of one per
+        observacion. Older observaciones (synced) never claim the casilla, they are written only if they move
+        last_observed forward.
+            :param observaciones: list of Observacion
+            :return: Future
+        """
+        latest = {}
+        for o in observaciones:
+            national_id = o.casilla.id()
+            if national_id not in latest or latest[national_id].date < o.date:
+                latest[national_id] = o
+        try:
+            since = datetime.datetime.utcnow() - datetime.timedelta(seconds=ACTIVITY_COALESCE_SECONDS)
+            recent = [o for o in latest.values() if o.date >= since]
+            old = [o for o in latest.values() if o.date < since]
+            ctx = ndb.get_context()
+            yield [_remember_activity_async(o) for o in recent]
+            claimed = yield [ctx.memcache_add('slot:' + o.casilla.id(), True, time=ACTIVITY_COALESCE_SECONDS,
+                                              namespace=ACTIVITY_NAMESPACE) for o in recent]
+            leading = [o for o, ok in zip(recent, claimed) if ok]
+            for o in leading:
+                deferred.defer(flush_activity, o.casilla.id(), _countdown=ACTIVITY_COALESCE_SECONDS)
+            yield CasillaActivity._write_newer_async([(o.casilla.id(), o.distrito, o.date) for o in leading + old])
+        except Exception:
+            logging.exception('[Casilla] - Error recording the activity of {0} casillas'.format(len(latest)))
+
+    @classmethod
+    @ndb.tasklet
+    def _write_newer_async(cls, observed):
+        """
+        Writes the (national_id, distrito, date) that move last_observed forward, one transaction per casilla so
+        concurrent writes (a leading write and the flush of the period before) never move it backwards
+        """
+        yield [cls._write_newer_one_async(n, distrito, date) for n, distrito, date in observed]
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _write_newer_one_async(cls, national_id, distrito, date):
+        activity = yield ndb.Key(CasillaActivity, national_id).get_async()
+        if activity is None or activity.last_observed < date:
+            yield CasillaActivity(id=national_id, distrito=distrito, last_observed=date).put_async()
+
+    @classmethod
+    @ndb.tasklet
+    def get_stale_async(cls, minutes, distrito=None, cursor=None, page_size=STALE_PAGE_SIZE):
+        """
+        Gets a page of the casillas without observaciones in the last minutes, least recently observed first.
+
+        Args:
+            - minutes:      Minutes without observaciones
+            - distrito:     Optional national_id of the distrito
+            - cursor:       URL safe cursor of the page, the first page if None
+            - page_size:    Casillas in the page, at most STALE_MAX_PAGE_SIZE
+
+        Returns:
+            Future, (list of CasillaActivity, URL safe cursor of the next page, more (Boolean))
+        """
+        try:
+            since = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+            query = CasillaActivity.query(CasillaActivity.last_observed < since)
+            if distrito:
+                query = query.filter(CasillaActivity.distrito == ndb.Key(Distrito, distrito))
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            page, next_cursor, more = yield query.order(CasillaActivity.last_observed).fetch_page_async(
+                min(page_size, STALE_MAX_PAGE_SIZE), start_cursor=start_cursor)
+        except Exception as e:
+            logging.exception("[Casilla] - Error getting stale casillas")
+            raise GetCasillaError('Error getting stale casillas: '+e.__str__())
+        raise ndb.Return((page, next_cursor.urlsafe() if next_cursor and more else None, more))
+
+    @classmethod
+    def get_stale(cls, minutes, distrito=None, cursor=None, page_size=STALE_PAGE_SIZE):
+        return cls.get_stale_async(minutes, distrito, cursor, page_size).get_result()
+
+
+@ndb.tasklet
+def _remember_activity_async(o):
+    """
+    Keeps the date of the observacion in memcache as the latest of its casilla (compare and set), for flush_activity
+    """
+    ctx = ndb.get_context()
+    key = 'latest:' + o.casilla.id()
+    for attempt in range(ACTIVITY_CAS_RETRIES):
+        current = yield ctx.memcache_gets(key, namespace=ACTIVITY_NAMESPACE)
+        if current is None:
+            stored = yield ctx.memcache_add(key, (o.date, o.distrito), time=2 * ACTIVITY_COALESCE_SECONDS,
+                                            namespace=ACTIVITY_NAMESPACE)
+        elif current[0] >= o.date:
+            return
+        else:
+            stored = yield ctx.memcache_cas(key, (o.date, o.distrito), time=2 * ACTIVITY_COALESCE_SECONDS,
+                                            namespace=ACTIVITY_NAMESPACE)
+        if stored:
+            return
+
+
+def flush_activity(national_id):
+    """
+    Writes the latest observacion of a casilla seen in the coalescing period, the trailing write of
+    CasillaActivity.record_async
+    """
+    latest = memcache.get('latest:' + national_id, namespace=ACTIVITY_NAMESPACE)
+    if latest:
+        date, distrito = latest
+        CasillaActivity._write_newer_async([(national_id, distrito, date)]).get_result()
+
+
+def backfill_activity(cursor=None):
+    """
+    Creates the CasillaActivity of the casillas created before it existed, from the latest observacion in their
+    summary (CasillaRollup). Chains itself every ACTIVITY_BACKFILL_BATCH_SIZE casillas, start it (e.g. from the remote
+    api shell) with deferred.defer(casilla.backfill_activity).
+        :param cursor: URL safe cursor to continue the scan from
+    """
+    from rollup import get_summaries
+
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    casillas, start_cursor, more = Casilla.query().fetch_page(ACTIVITY_BACKFILL_BATCH_SIZE, start_cursor=start_cursor)
+    activities = ndb.get_multi([ndb.Key(CasillaActivity, c.key.id()) for c in casillas])
+    missing = [c for c, a in zip(casillas, activities) if a is None]
+    summaries = get_summaries([c.key.id() for c in missing])
+    new = []
+    for c, summary in zip(missing, summaries):
+        activity = CasillaActivity.for_casilla(c)
+        if summary and summary.last_observed:
+            activity.last_observed = summary.last_observed
+        new.append(activity)
+    ndb.put_multi(new)
+    if more:
+        deferred.defer(backfill_activity, start_cursor.urlsafe())
+    else:
+        logging.info('[Casilla] - Activity backfill done')
+
+
+@ndb.tasklet
+def _search_result_async(future):
+    """
+    Waits for a Search API future (put_async, search_async) in a tasklet: its RPC is yielded to the event loop, so the
+    other tasklets run meanwhile, then get_result() runs its result hook (and raises its errors as search errors).
+        :returns Future, result of the Search API future
+    """
+    rpc = getattr(future, '_rpc', None)
+    if rpc is not None:
+        try:
+            yield rpc
+        except Exception:
+            # Raised again by get_result()
+            pass
+    raise ndb.Return(future.get_result())
+
+
+def _index_points():
+    """
+    All the casillas locations for the spatial index, from a projection query
+    """
+    for c in Casilla.query(projection=[Casilla.loc]).iter(batch_size=1000):
+        if c.key.string_id():
+            yield c.key.string_id(), c.loc.lat, c.loc.lon
+
+
+def _index_points_since(since):
+    """
+    The casillas locations written after since (epoch seconds)
+    """
+    updated = datetime.datetime.utcfromtimestamp(since)
+    for c in Casilla.query(Casilla.updated > updated).iter(batch_size=500):
+        if c.loc and c.key.string_id():
+            yield c.key.string_id(), c.loc.lat, c.loc.lon
 
 
+casillas_index = spatial.SnapshotIndex('casillas_index', _index_points, _index_points_since)
 
 
 class GetCasillaError(Exception):
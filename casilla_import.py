@@ -0,0 +1,264 @@
+"""
+Defines the bulk import of Casillas (national polling-station catalogue) in the Observador-Electoral platform.
+
+The catalogue is streamed from a Cloud Storage file, either CSV (with a header row) or NDJSON (one JSON object per
+line), with the fields:
+
+    national_id, distrito, name, loc ("lat,lon") or lat and lon, address, picture_url
+
+Rows are written with put_multi in batches, and their Search API documents 200 at a time. The job checkpoints the
+byte offset after every batch, runs as a chain of deferred tasks, and can be resumed from the last checkpoint.
+"""
+__author__ = 'Cesar'
+
+
+import csv
+import json
+import time
+import datetime
+import logging
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.ext import blobstore
+from google.appengine.api import search
+
+from casilla import Casilla, CasillaActivity
+from distrito import distrito_cache
+
+
+BATCH_SIZE = 200
+# Leave room before the 10 minutes deadline of a push task
+TASK_BUDGET_SECONDS = 8 * 60
+MAX_STORED_ERRORS = 1000
+# A pending or running job without progress for this long can be resumed (seconds), its task chain was lost
+RESUME_STALE_SECONDS = 15 * 60
+
+
+class CasillaImport(ndb.Model):
+    """
+    Represents a bulk import job of Casillas.
+
+        - source: Cloud Storage file (/bucket/object)
+        - file_format: csv or ndjson
+        - offset: Byte offset of the first row not yet imported (checkpoint)
+        - fieldnames: CSV header
+        - lines: Data lines read so far (row numbers in errors count from the first data line)
+        - rows_ok / rows_failed: Rows imported / rejected so far
+        - errors: List of {row, error} for the rejected rows (capped to MAX_STORED_ERRORS)
+        - seconds: Processing time spent so far
+    """
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    source = ndb.StringProperty()
+    file_format = ndb.StringProperty(choices=['csv', 'ndjson'])
+    status = ndb.StringProperty(choices=['pending', 'running', 'done', 'failed'], default='pending')
+    offset = ndb.IntegerProperty(default=0)
+    fieldnames = ndb.StringProperty(repeated=True, indexed=False)
+    lines = ndb.IntegerProperty(default=0)
+    rows_ok = ndb.IntegerProperty(default=0)
+    rows_failed = ndb.IntegerProperty(default=0)
+    errors = ndb.JsonProperty()
+    seconds = ndb.FloatProperty(default=0.0)
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return (self.rows_ok + self.rows_failed) / self.seconds
+
+    @classmethod
+    def start(cls, source, file_format):
+        """
+        Creates a new import job and enqueues its first task.
+        :param:
+            - source: Cloud Storage file (/bucket/object)
+            - file_format: csv or ndjson
+
+        :return:
+            Key of the new job
+        """
+        try:
+            if file_format not in ('csv', 'ndjson'):
+                raise CasillaImportError('Unknown format: {0}'.format(file_format))
+            job = CasillaImport(source=source, file_format=file_format, errors=[])
+            key = job.put()
+            deferred.defer(run, key.urlsafe())
+        except CasillaImportError:
+            raise
+        except Exception as e:
+            logging.exception("[CasillaImport] - Error starting import", exc_info=True)
+            raise CasillaImportError('Error starting the import: '+e.__str__())
+        else:
+            logging.info('[CasillaImport] - New import {0} from {1}'.format(key, source))
+            return key
+
+    @classmethod
+    def resume(cls, url_safe_key):
+        """
+        Enqueues a new task for a failed job, or a pending or running one without progress in RESUME_STALE_SECONDS
+        (its task was lost), continuing from its last checkpoint. The job is flipped to pending in the transaction
+        enqueueing the task, so a job never runs two task chains.
+        """
+        @ndb.transactional
+        def txn(key):
+            job = key.get()
+            if not job:
+                raise CasillaImportError('Import does not exist')
+            stale = datetime.datetime.utcnow() - job.updated > datetime.timedelta(seconds=RESUME_STALE_SECONDS)
+            if job.status != 'failed' and not (job.status in ('pending', 'running') and stale):
+                raise CasillaImportError('Import is {0}, only failed or stalled imports can be resumed'
+                                         .format(job.status))
+            job.status = 'pending'
+            job.put()
+            deferred.defer(run, key.urlsafe(), _transactional=True)
+            return job
+
+        try:
+            job = txn(ndb.Key(urlsafe=url_safe_key))
+        except CasillaImportError:
+            raise
+        except Exception as e:
+            raise CasillaImportError('Error resuming the import: '+e.__str__())
+        else:
+            return job
+
+    @classmethod
+    def get_status(cls, url_safe_key):
+        """
+        Gets an import job from its URL safe key
+        """
+        try:
+            job = ndb.Key(urlsafe=url_safe_key).get()
+            if not job:
+                raise CasillaImportError('Import does not exist')
+        except CasillaImportError:
+            raise
+        except Exception as e:
+            raise CasillaImportError('Error getting the import: '+e.__str__())
+        else:
+            return job
+
+
+def run(url_safe_key):
+    """
+    Imports batches of rows until the source is exhausted or the task budget is spent, in that case the job chains
+    itself from the checkpoint.
+    """
+    job = ndb.Key(urlsafe=url_safe_key).get()
+    if not job or job.status == 'done':
+        return
+
+    task_started = time.time()
+    job.status = 'running'
+    # Distritos are resolved once per task from distrito_cache
+    distritos = dict((n, d.key) for n, d in distrito_cache.get_all().items())
+    reader = blobstore.BlobReader(blobstore.create_gs_key('/gs' + job.source))
+    try:
+        reader.seek(job.offset)
+        if job.file_format == 'csv' and not job.fieldnames:
+            job.fieldnames = [f.strip() for f in next(csv.reader([reader.readline()]))]
+            job.offset = reader.tell()
+
+        while True:
+            batch_started = time.time()
+            lines = []
+            for i in range(BATCH_SIZE):
+                line = reader.readline()
+                if not line:
+                    break
+                lines.append(line)
+            if lines:
+                _import_batch(job, lines, distritos)
+                job.offset = reader.tell()
+            job.seconds += time.time() - batch_started
+            if len(lines) < BATCH_SIZE:
+                job.status = 'done'
+                job.put()
+                logging.info('[CasillaImport] - Import {0} done: {1} ok, {2} failed, {3:.1f} rows/s'
+                             .format(url_safe_key, job.rows_ok, job.rows_failed, job.rows_per_second))
+                return
+            # Checkpoint
+            job.put()
+            if time.time() - task_started > TASK_BUDGET_SECONDS:
+                break
+    except Exception:
+        logging.exception('[CasillaImport] - Import {0} failed at offset {1}'.format(url_safe_key, job.offset))
+        # Back to the last checkpoint, the counters of the failed batch are counted again when it is resumed
+        job = job.key.get(use_cache=False, use_memcache=False)
+        job.status = 'failed'
+        job.put()
+        return
+    finally:
+        reader.close()
+
+    deferred.defer(run, url_safe_key)
+
+
+def _parse(job, line):
+    if job.file_format == 'ndjson':
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError('Row is not a JSON object')
+        return row
+    values = next(csv.reader([line]))
+    return dict(zip(job.fieldnames, [v.decode('utf-8') for v in values]))
+
+
+def _import_batch(job, lines, distritos):
+    """
+    Writes a batch of rows: one get_multi to keep the assignments and activity of existing casillas, one put_multi
+    (with the CasillaActivity of the new ones) and one Search API put.
+    """
+    casillas = {}
+    for i, line in enumerate(lines):
+        row_number = job.lines + i + 1
+        if not line.strip():
+            continue
+        try:
+            row = _parse(job, line)
+            national_id = row.get('national_id')
+            if not national_id:
+                raise ValueError('Missing national_id')
+            distrito_key = distritos.get(row.get('distrito'))
+            if not distrito_key:
+                raise ValueError('Distrito does not exist: {0}'.format(row.get('distrito')))
+            if row.get('loc'):
+                geo_pt = ndb.GeoPt(str(row['loc']))
+            else:
+                geo_pt = ndb.GeoPt(float(row['lat']), float(row['lon']))
+            casillas[national_id] = Casilla(id=national_id,
+                                            national_id=national_id,
+                                            distrito=distrito_key,
+                                            loc=geo_pt,
+                                            name=row.get('name'),
+                                            address=row.get('address'),
+                                            picture_url=row.get('picture_url'))
+        except Exception as e:
+            job.rows_failed += 1
+            if len(job.errors) < MAX_STORED_ERRORS:
+                job.errors.append({'row': row_number, 'error': e.__str__()})
+        else:
+            job.rows_ok += 1
+    job.lines += len(lines)
+
+    entities = list(casillas.values())
+    existing = ndb.get_multi([c.key for c in entities] + [ndb.Key(CasillaActivity, c.key.id()) for c in entities])
+    existing, activities = existing[:len(entities)], existing[len(entities):]
+    for new, current in zip(entities, existing):
+        if current:
+            new.observador = current.observador
+            new.created = current.created
+    # The activity of the casillas already observed is kept
+    new_activities = [CasillaActivity.for_casilla(c) for c, a in zip(entities, activities) if a is None]
+    keys = ndb.put_multi(entities + new_activities)[:len(entities)]
+    if keys:
+        search.Index(name="CasillasIndex").put([Casilla.search_document(k, c.loc) for k, c in zip(keys, entities)])
+
+
+class CasillaImportError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,207 @@
+"""
+Defines the validation of the filled checklists of observaciones against the checklist of their Clasificacion in the
+Observador-Electoral platform.
+
+A checklist template is a JSON object mapping every question to the answer it expects:
+
+    - a type name: "boolean", "integer", "number" or "text"
+    - a list of the allowed answers
+    - an object with type and/or choices, and optionally required (default false), max_length (text), min and max
+      (integer, number)
+    - any other scalar (e.g. a label of the question) for any scalar answer
+
+A JSON list of question names is read as questions taking any scalar answer. Templates of any other shape only get
+the generic checks: a filled checklist is a JSON object of at most MAX_FILLED_SIZE characters.
+
+compile_template() parses a template once into a CompiledChecklist: validating a filled checklist is then one
+json.loads and a check per answer.
+
+Filled checklists are stored encoded against their template (CompiledChecklist.encode): the answers in the order of
+the sorted questions, a missing answer as [] (answers are scalars, so it is never an answer), trailing missing answers
+dropped, and the list prefixed with the version of the template (CRC32 of its questions). The result is zlib
+compressed by the datastore property. Answers that do not fit the template (checklists stored before validation) are
+encoded as the JSON object itself. The question names of every version are kept (clasificacion.ChecklistVersion), so
+answers encoded for a previous version of an edited checklist are decoded against its own questions.
+"""
+__author__ = 'Cesar'
+
+
+import json
+import zlib
+
+
+MAX_FILLED_SIZE = 16 * 1024
+MAX_TEXT_LENGTH = 1000
+
+TYPES = {'boolean': (bool,),
+         'integer': (int, long),
+         'number': (int, long, float),
+         'text': (basestring,)}
+SCALARS = (bool, int, long, float, basestring, type(None))
+MISSING = []
+
+
+def compile_template(template):
+    """
+    Compiles a checklist template.
+        :param template: JSON string of the checklist of a Clasificacion (or the decoded JSON)
+
+        :return: CompiledChecklist
+    """
+    if isinstance(template, basestring):
+        try:
+            template = json.loads(template)
+        except ValueError:
+            raise ChecklistTemplateError('Checklist is not valid JSON')
+    if isinstance(template, dict):
+        questions = [_compile_question(name, spec) for name, spec in sorted(template.items())]
+    elif isinstance(template, list) and all(isinstance(name, basestring) for name in template):
+        questions = [_compile_question(name, None) for name in sorted(set(template))]
+    else:
+        questions = None
+    return CompiledChecklist(questions)
+
+
+class CompiledChecklist(object):
+    """
+    Validator and encoder of the filled checklists of a template. questions is a list of (name, required, check)
+    sorted by name, None for templates without questions.
+    """
+
+    def __init__(self, questions):
+        self.questions = questions
+        if questions is None:
+            self.names = None
+            self.question_names = None
+            self.version = None
+        else:
+            self.question_names = [name for name, required, check in questions]
+            self.names = frozenset(self.question_names)
+            self.positions = dict((name, i) for i, name in enumerate(self.question_names))
+            self.version = zlib.crc32(json.dumps(self.question_names)) & 0xffffffff
+
+    def validate(self, filled):
+        """
+        Validates a filled checklist.
+            :param filled: JSON string of the filled checklist (or the decoded JSON)
+
+            :return: decoded filled checklist, raises FilledChecklistError if it does not match the template
+        """
+        if isinstance(filled, basestring):
+            if len(filled) > MAX_FILLED_SIZE:
+                raise FilledChecklistError('Filled checklist exceeds {0} characters'.format(MAX_FILLED_SIZE))
+            try:
+                filled = json.loads(filled)
+            except ValueError:
+                raise FilledChecklistError('Filled checklist is not valid JSON')
+        if not isinstance(filled, dict):
+            raise FilledChecklistError('Filled checklist must be a JSON object')
+        if self.names is None:
+            return filled
+        unknown = [name for name in filled if name not in self.names]
+        if unknown:
+            raise FilledChecklistError('Unknown questions: {0}'.format(', '.join(sorted(unknown))))
+        for name, required, check in self.questions:
+            if name in filled:
+                check(filled[name])
+            elif required:
+                raise FilledChecklistError('Missing answer to: {0}'.format(name))
+        return filled
+
+    def encode(self, filled):
+        """
+        Encodes a decoded filled checklist for storage
+            :return: compact JSON string
+        """
+        positional = self.names is not None and all(name in self.names and isinstance(answer, SCALARS)
+                                                    for name, answer in filled.items())
+        if not positional:
+            return json.dumps(filled, separators=(',', ':'))
+        answers = [MISSING] * len(self.questions)
+        for name, answer in filled.items():
+            answers[self.positions[name]] = answer
+        while answers and answers[-1] is MISSING:
+            answers.pop()
+        return json.dumps([self.version] + answers, separators=(',', ':'))
+
+    def decode(self, data, versions=None):
+        """
+        Decodes a filled checklist stored with encode()
+            :param versions: {version: question names} of the previous versions of the checklist
+            :return: filled checklist (dict)
+        """
+        encoded = json.loads(data)
+        if isinstance(encoded, dict):
+            return encoded
+        if encoded[0] == self.version:
+            names = self.question_names
+        elif versions and encoded[0] in versions:
+            names = versions[encoded[0]]
+        else:
+            raise FilledChecklistError('Filled checklist encoded for an unknown version of the checklist')
+        if len(encoded) - 1 > len(names):
+            raise FilledChecklistError('Filled checklist has more answers than its checklist questions')
+        return dict((names[i], answer) for i, answer in enumerate(encoded[1:]) if answer != MISSING)
+
+
+def encoded_version(data):
+    """
+    Version of the checklist a filled checklist was encoded for, None if it was stored as a JSON object
+    """
+    encoded = json.loads(data)
+    return None if isinstance(encoded, dict) else encoded[0]
+
+
+def _compile_question(name, spec):
+    """
+    (name, required, check) of a question of a template
+    """
+    if isinstance(spec, basestring) and spec in TYPES:
+        spec = {'type': spec}
+    elif isinstance(spec, list):
+        spec = {'choices': spec}
+    elif not isinstance(spec, dict):
+        spec = {}
+
+    a_type = spec.get('type')
+    if a_type is not None and a_type not in TYPES:
+        raise ChecklistTemplateError('Unknown type {0} of question: {1}'.format(a_type, name))
+    types = TYPES.get(a_type, SCALARS)
+    choices = spec.get('choices')
+    if choices is not None:
+        if not isinstance(choices, list) or not all(isinstance(c, SCALARS) for c in choices):
+            raise ChecklistTemplateError('Choices of question {0} must be a list of scalars'.format(name))
+        choices = frozenset(choices)
+    max_length = spec.get('max_length', MAX_TEXT_LENGTH)
+    low = spec.get('min')
+    high = spec.get('max')
+
+    def check(answer):
+        # bool is an int, but true is not an answer to a number question
+        if not isinstance(answer, types) or (isinstance(answer, bool) and bool not in types):
+            raise FilledChecklistError('Invalid answer to: {0}'.format(name))
+        if choices is not None and answer not in choices:
+            raise FilledChecklistError('Answer to {0} is not one of the choices'.format(name))
+        if isinstance(answer, basestring) and len(answer) > max_length:
+            raise FilledChecklistError('Answer to {0} exceeds {1} characters'.format(name, max_length))
+        if isinstance(answer, (int, long, float)) and not isinstance(answer, bool):
+            if (low is not None and answer < low) or (high is not None and answer > high):
+                raise FilledChecklistError('Answer to {0} is out of range'.format(name))
+
+    return name, bool(spec.get('required', False)), check
+
+
+class ChecklistTemplateError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class FilledChecklistError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -5,9 +5,113 @@ __author__ = 'Cesar'
 
 
 import logging
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from cache import TwoTierCache, LRUCache
+import checklist as checklists
 
 
+# All the clasificaciones, read on every get_available: LRU (per instance) -> memcache -> datastore. Cached per
+# catalogue version, so a new version is picked up by every instance within VERSION_MEMCACHE_TTL. The catalogue tuple
+# is shared by the requests of the instance: never modify it nor its clasificaciones.
+catalogue_cache = TwoTierCache('clasificacion', max_size=2, local_ttl=3600, memcache_ttl=24 * 60 * 60)
+# Compiled checklists, per catalogue version and clasificacion. Shared as well, a CompiledChecklist is never modified
+# once compiled.
+compiled_checklists = LRUCache(max_size=500, ttl=24 * 60 * 60)
+VERSION_NAMESPACE = 'clasificacion-version'
+# A reader can repopulate the version it read just before a bump committed, so the cached version is short lived: a
+# stale version is served for at most this long
+VERSION_MEMCACHE_TTL = 60
+
+
+class CatalogueVersion(ndb.Model):
+    """
+    Represents the version of the Clasificacion catalogue, bumped every time a Clasificacion is created. Singleton
+    keyed by 'clasificacion'.
+
+        - clasificaciones: Keys of the clasificaciones created since versioning, so a new version is loaded with them
+          even before the global query sees them
+    """
+
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    clasificaciones = ndb.KeyProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    @ndb.tasklet
+    def get_version_async(cls):
+        """
+        Gets the current version from memcache, or from the datastore when memcache lost it (or it expired, see
+        VERSION_MEMCACHE_TTL)
+
+        :return:
+            Future, version (Integer)
+        """
+        ctx = ndb.get_context()
+        version = yield ctx.memcache_get('version', namespace=VERSION_NAMESPACE)
+        if version is None:
+            current = yield ndb.Key(CatalogueVersion, 'clasificacion').get_async(use_cache=False, use_memcache=False)
+            version = current.version if current else 0
+            yield ctx.memcache_add('version', version, time=VERSION_MEMCACHE_TTL, namespace=VERSION_NAMESPACE)
+        raise ndb.Return(version)
+
+    @classmethod
+    @ndb.tasklet
+    def bump_async(cls, clasificacion):
+        """
+        Increments the version, must run in the transaction creating the clasificacion (key). The cached version is
+        dropped once the transaction commits.
+        """
+        key = ndb.Key(CatalogueVersion, 'clasificacion')
+        current = yield key.get_async()
+        if current is None:
+            current = CatalogueVersion(key=key)
+        current.version += 1
+        current.clasificaciones.append(clasificacion)
+        yield current.put_async()
+        ndb.get_context().call_on_commit(lambda: memcache.delete('version', namespace=VERSION_NAMESPACE))
+        raise ndb.Return(current.version)
+
+
+class ChecklistVersion(ndb.Model):
+    """
+    Represents a version of the checklist of a Clasificacion, child of the Clasificacion keyed by the version (CRC32
+    of its questions, see checklist.py). Recorded before any filled checklist is encoded for it, so the filled
+    checklists stay readable after the checklist is edited.
+
+        - questions: Sorted question names, the positions of the encoded answers
+    """
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    questions = ndb.StringProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def build_key(cls, clasificacion, version):
+        return ndb.Key(ChecklistVersion, str(version), parent=clasificacion)
+
+    @classmethod
+    @ndb.tasklet
+    def record_async(cls, clasificacion, compiled):
+        """
+        Records the questions of a compiled checklist of a clasificacion (key), unless that version exists
+        """
+        if compiled.version is not None:
+            yield ChecklistVersion.get_or_insert_async(str(compiled.version), parent=clasificacion,
+                                                       questions=compiled.question_names)
+
+    @classmethod
+    @ndb.tasklet
+    def get_questions_async(cls, versions):
+        """
+        Gets the questions of versions of checklists
+        :param versions: list of (clasificacion key, version)
+
+        :return:
+            Future, {(clasificacion key, version): list of question names}, without the unknown versions
+        """
+        found = yield ndb.get_multi_async([ChecklistVersion.build_key(c, v) for c, v in versions])
+        raise ndb.Return(dict((cv, f.questions) for cv, f in zip(versions, found) if f))
+
 
 class Clasificacion(ndb.Model):
     """
@@ -24,7 +128,8 @@ class Clasificacion(ndb.Model):
     repeatable = ndb.BooleanProperty()
 
     @classmethod
-    def create(cls, name, checklist, repeatable):
+    @ndb.tasklet
+    def create_async(cls, name, checklist, repeatable):
         """
         Creates a new Clasificacion in the datastore.
         :param:
@@ -33,48 +138,146 @@ class Clasificacion(ndb.Model):
             - repeatable: Can only be performed once for a given Casilla
 
         :return:
-            Key of new entity
+            Future, key of new entity
         """
         try:
+            compiled = checklists.compile_template(checklist)
+        except checklists.ChecklistTemplateError as e:
+            raise ClasificacionCreationError('Invalid checklist: {0}'.format(e.value))
+
+        @ndb.transactional_tasklet(xg=True)
+        def txn():
             c = Clasificacion(name=name, checklist=checklist, repeatable=repeatable)
-            key = c.put()
+            key = yield c.put_async()
+            yield (CatalogueVersion.bump_async(key),
+                   ChecklistVersion.record_async(key, compiled))
+            raise ndb.Return(key)
+
+        try:
+            key = yield txn()
 
         except Exception:
             logging.exception("[Clasificacion] - Error in create Clasificacion", exc_info=True)
             raise ClasificacionCreationError('Error creating the Clasificacion in platform')
         else:
-            return key
+            raise ndb.Return(key)
 
     @classmethod
-    def get_available(cls, casilla):
+    def create(cls, name, checklist, repeatable):
+        return cls.create_async(name, checklist, repeatable).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_catalogue_async(cls):
         """
-        Gets available clasificaciones for the requested casilla
+        Gets all the clasificaciones from catalogue_cache
+
+        :return:
+            Future, tuple of Clasificacion (shared, do not modify)
+        """
+        version, catalogue = yield Clasificacion.get_versioned_catalogue_async()
+        raise ndb.Return(catalogue)
+
+    @classmethod
+    @ndb.tasklet
+    def get_versioned_catalogue_async(cls):
+        """
+        Gets the catalogue version and all the clasificaciones of that version from catalogue_cache
+
+        :return:
+            Future, (version, tuple of Clasificacion (shared, do not modify))
+        """
+        version = yield CatalogueVersion.get_version_async()
+        catalogue = yield catalogue_cache.get_async('catalogue:{0}'.format(version),
+                                                    lambda k: Clasificacion._load_catalogue_async())
+        raise ndb.Return((version, catalogue))
+
+    @classmethod
+    @ndb.tasklet
+    def _load_catalogue_async(cls):
+        """
+        Keys from the global query plus the ones recorded in CatalogueVersion, then one get_multi
+        """
+        current, keys = yield (ndb.Key(CatalogueVersion, 'clasificacion').get_async(),
+                               Clasificacion.query().fetch_async(keys_only=True))
+        keys = set(keys)
+        if current:
+            keys.update(current.clasificaciones)
+        clasificaciones = yield ndb.get_multi_async(list(keys))
+        raise ndb.Return(tuple(sorted([c for c in clasificaciones if c], key=lambda c: (c.created, c.key.id()))))
+
+    @classmethod
+    @ndb.tasklet
+    def get_checklist_async(cls, url_safe_key):
+        """
+        Gets the compiled checklist of a clasificacion, validating and encoding its filled checklists. The checklist
+        is compiled once per catalogue version and cached in the instance, its version is recorded (ChecklistVersion)
+        before it is used, which covers checklists edited in place.
+        :param url_safe_key
+
+        :return:
+            Future, checklist.CompiledChecklist
+        """
+        version, catalogue = yield Clasificacion.get_versioned_catalogue_async()
+        cache_key = '{0}:{1}'.format(version, url_safe_key)
+        compiled = compiled_checklists.get(cache_key)
+        if compiled is None:
+            try:
+                key = ndb.Key(urlsafe=url_safe_key)
+            except Exception:
+                key = None
+            if key is None or key.kind() != 'Clasificacion':
+                raise GetClasificacionError('Invalid clasificacion key: {0}'.format(url_safe_key))
+            found = [c for c in catalogue if c.key == key]
+            if found:
+                clasificacion = found[0]
+            else:
+                clasificacion = yield key.get_async()
+            if clasificacion is None:
+                raise GetClasificacionError('Clasificacion does not exist: {0}'.format(url_safe_key))
+            try:
+                compiled = checklists.compile_template(clasificacion.checklist)
+            except checklists.ChecklistTemplateError as e:
+                # Checklists created before validation, only the generic checks apply
+                logging.warning("[Clasificacion] - Invalid checklist in {0}: {1}".format(url_safe_key, e.value))
+                compiled = checklists.compile_template(None)
+            yield ChecklistVersion.record_async(key, compiled)
+            compiled_checklists.set(cache_key, compiled)
+        raise ndb.Return(compiled)
+
+    @classmethod
+    @ndb.tasklet
+    def get_available_async(cls, casilla):
+        """
+        Gets available clasificaciones for the requested casilla: the catalogue minus the non repeatable
+        clasificaciones already performed in an observacion of the casilla, read from the summary of the casilla (or
+        its observaciones if it has none).
         :param:
             - casilla: national_id (String) unique identifier of the Casilla in the national database
 
         :return:
-            list of URL safe keys of clasificaciones
+            Future, list of URL safe keys of clasificaciones
         """
-        from observacion import Observacion
+        from rollup import get_summaries_async
 
         try:
-            # Get all clasificaciones
-            query_response = Clasificacion.query()
-            c_available = []
-            for c in query_response:
-                c_available.append(c.key.urlsafe())
-            # Get observaciones for given casilla
-            obs = Observacion.get_all(casilla)
-            # Remove all clasificaciones already performed in an observacion if the clasificacion is not repeatable
-            for i, o in enumerate(obs):
-                clasificacion = o.clasificacion.get()
-                logging.debug("[Clasificacion] - Clasificacion: {0}.repeatable = {1}"
-                              .format(clasificacion.key, clasificacion.repeatable))
-                if not clasificacion.repeatable:
-                    c_available.pop(i)
-            if c_available:
-                pass
+            catalogue, summaries = yield (Clasificacion.get_catalogue_async(),
+                                          get_summaries_async([casilla]))
+            summary = summaries[0]
+            if summary is None or summary.clasificaciones is None:
+                # Casillas not summarised yet (observed before the rollups) or summarised before the counts
+                performed = yield Clasificacion._get_performed_async(casilla)
             else:
+                performed = set(ndb.Key(urlsafe=k) for k in summary.clasificaciones)
+            clasificaciones = dict((c.key, c) for c in catalogue)
+            # Clasificaciones created after the catalogue was cached
+            missing = [k for k in performed if k not in clasificaciones]
+            if missing:
+                found = yield ndb.get_multi_async(missing)
+                clasificaciones.update((c.key, c) for c in found if c)
+            done = set(k for k in performed if k in clasificaciones and not clasificaciones[k].repeatable)
+            c_available = [c.key.urlsafe() for c in catalogue if c.key not in done]
+            if not c_available:
                 raise GetClasificacionError('No available clasificaciones for Casilla: {0}'.format(casilla))
         except Exception:
             logging.exception("[Clasificacion] - Error in getting available Clasificaciones for Casilla: {0}"
@@ -83,22 +286,43 @@ class Clasificacion(ndb.Model):
         else:
             for c in c_available:
                 logging.debug("[Clasificacion] = {0}".format(c))
-            return c_available
+            raise ndb.Return(c_available)
 
     @classmethod
-    def get_all(cls):
+    @ndb.tasklet
+    def _get_performed_async(cls, casilla):
+        """
+        Keys of the clasificaciones performed in the casilla, from one distinct projection query. Used for the
+        casillas without summary or whose summary predates the per clasificacion counts.
+        """
+        from observacion import Observacion
+        from casilla import Casilla
+
+        query = Observacion.query(Observacion.casilla == ndb.Key(Casilla, casilla),
+                                  projection=[Observacion.clasificacion],
+                                  distinct=True)
+        observaciones = yield query.fetch_async()
+        raise ndb.Return(set(o.clasificacion for o in observaciones))
+
+    @classmethod
+    def get_available(cls, casilla):
+        return cls.get_available_async(casilla).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_all_async(cls):
         """
         Gets all clasificaciones
 
         :return:
-            list of URL safe keys of clasificaciones
+            Future, list of URL safe keys of clasificaciones
         """
 
         try:
             # Get all clasificaciones
-            query_response = Clasificacion.query()
+            catalogue = yield Clasificacion.get_catalogue_async()
             c_available = []
-            for c in query_response:
+            for c in catalogue:
                 c_available.append(c.key.urlsafe())
             if c_available:
                 pass
@@ -110,31 +334,40 @@ class Clasificacion(ndb.Model):
         else:
             for c in c_available:
                 logging.debug("[Clasificacion] = {0}".format(c))
-            return c_available
+            raise ndb.Return(c_available)
 
     @classmethod
-    def get_details(cls, url_safe_key):
+    def get_all(cls):
+        return cls.get_all_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_details_async(cls, url_safe_key):
         """
         Gets the details of a given (URL safe key) clasificacion
 
         :param url_safe_key
 
         :return:
-            list of URL safe keys of clasificaciones
+            Future, Clasificacion object
         """
 
         try:
             c = ndb.Key(urlsafe=url_safe_key)
-            clasificacion = c.get()
+            clasificacion = yield c.get_async()
             if not clasificacion:
                 raise GetClasificacionError("[Clasificacion] - Error in getting {0} Clasificacion"
-                                            .format(url_safe_key), exc_info=True)
+                                            .format(url_safe_key))
         except Exception:
             logging.exception("[Clasificacion] - Error in getting {0} Clasificacion".format(url_safe_key),
                               exc_info=True)
             raise GetClasificacionError('Error creating the Clasificacion in platform')
         else:
-            return clasificacion
+            raise ndb.Return(clasificacion)
+
+    @classmethod
+    def get_details(cls, url_safe_key):
+        return cls.get_details_async(url_safe_key).get_result()
 
 
 class ClasificacionCreationError(Exception):
@@ -0,0 +1,179 @@
+"""
+Defines the sharded counters used for the platform wide totals in the Observador-Electoral platform.
+
+Every counter is split in NUM_SHARDS entities so concurrent increments rarely contend on the same entity group. The
+total is the sum of the shards, cached in memcache: reads cost one memcache get, or one get_multi of the shards.
+
+Increments go to the current generation of the counter, kept in every shard, and return it so the counted entity can
+record it in the same transaction. A reconciliation closes the generation (close_generation) in one transaction over
+all the shards: every increment committed before is in the closed generation, every later one in the new generation,
+and the transactions in flight retry on the new one. The entities recording the closed generation (or none) can then
+be recounted at leisure, and the closed generation replaced by that count (set_closed_total).
+"""
+__author__ = 'Cesar'
+
+
+import random
+import logging
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+# Closing a generation writes every shard and the Counter in one cross-group transaction (at most 25 groups)
+NUM_SHARDS = 20
+MEMCACHE_NAMESPACE = 'counter'
+# Bounds how long a total cached while an increment was in flight can stay behind
+MEMCACHE_TTL = 60
+
+
+class Counter(ndb.Model):
+    """
+    Represents the reconciled part of a counter. Keyed by name, missing until its first reconciliation.
+
+        - generation: Current generation
+        - closing: Generation being recounted, None if none
+        - base: Recounted total of the generations before the current one (before closing, if one is being recounted)
+    """
+
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+    closing = ndb.IntegerProperty(indexed=False)
+    base = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CounterShard(ndb.Model):
+    """
+    Represents one shard of a counter. Keyed by name:index.
+
+        - name: Counter the shard belongs to
+        - count: Partial count of the current generation
+        - generation: Current generation of the counter
+        - closed: Partial count of the generation being recounted
+    """
+
+    name = ndb.StringProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+    closed = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls, name):
+        return [ndb.Key(cls, '{0}:{1}'.format(name, i)) for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional_tasklet(propagation=ndb.TransactionOptions.ALLOWED)
+def increment_async(name, delta=1):
+    """
+    Adds delta to a random shard of the counter. Joins the current transaction if there is one, so the increment is
+    committed together with the entity it counts. The cached total is updated once the transaction commits.
+
+    Args:
+        - name:     Counter name
+        - delta:    Amount to add
+
+    Returns:
+        Future, generation that got the increment
+    """
+    index = random.randint(0, NUM_SHARDS - 1)
+    key = ndb.Key(CounterShard, '{0}:{1}'.format(name, index))
+    shard = yield key.get_async()
+    if shard is None:
+        # close_generation writes every shard, a missing one has never seen a generation closed
+        shard = CounterShard(key=key, name=name)
+    shard.count += delta
+    yield shard.put_async()
+    ndb.get_context().call_on_commit(lambda: memcache.incr(name, delta=delta, namespace=MEMCACHE_NAMESPACE))
+    raise ndb.Return(shard.generation)
+
+
+def increment(name, delta=1):
+    return increment_async(name, delta).get_result()
+
+
+@ndb.tasklet
+def get_count_async(name):
+    """
+    Gets the total of the counter from memcache, or from the shards when not cached.
+
+    Returns:
+        Future, total
+    """
+    ctx = ndb.get_context()
+    total = yield ctx.memcache_get(name, namespace=MEMCACHE_NAMESPACE)
+    if total is None:
+        total = yield get_shards_total_async(name)
+        # add, so a total incremented meanwhile is not overwritten
+        yield ctx.memcache_add(name, total, time=MEMCACHE_TTL, namespace=MEMCACHE_NAMESPACE)
+    raise ndb.Return(total)
+
+
+def get_count(name):
+    return get_count_async(name).get_result()
+
+
+@ndb.tasklet
+def get_shards_total_async(name):
+    """
+    Gets the total of the counter from the shards, skipping the caches.
+
+    Returns:
+        Future, total
+    """
+    state, shards = yield (ndb.Key(Counter, name).get_async(use_cache=False, use_memcache=False),
+                           ndb.get_multi_async(CounterShard.shard_keys(name), use_cache=False, use_memcache=False))
+    raise ndb.Return((state.base if state else 0) + sum(s.count + s.closed for s in shards if s))
+
+
+def get_shards_total(name):
+    return get_shards_total_async(name).get_result()
+
+
+@ndb.transactional(xg=True)
+def close_generation(name):
+    """
+    Starts a new generation of the counter in all its shards, the current one is closed and can be recounted. Used by
+    the reconciliation jobs.
+
+    Returns:
+        Closed generation, None if another one is still being recounted
+    """
+    key = ndb.Key(Counter, name)
+    keys = CounterShard.shard_keys(name)
+    state, shards = key.get(), ndb.get_multi(keys)
+    state = state or Counter(key=key)
+    if state.closing is not None:
+        logging.warning('[Counter] - {0}: generation {1} is still being recounted'.format(name, state.closing))
+        return None
+    shards = [s or CounterShard(key=k, name=name) for k, s in zip(keys, shards)]
+    for s in shards:
+        s.closed, s.count = s.count, 0
+        s.generation = state.generation + 1
+    state.closing = state.generation
+    state.generation += 1
+    ndb.put_multi([state] + shards)
+    return state.closing
+
+
+@ndb.transactional(xg=True)
+def set_closed_total(name, closing, total):
+    """
+    Replaces the closed generation (and the ones before it) with total, the recount of the entities it counted. The
+    increments of the current generation are kept.
+
+    Args:
+        - name:     Counter name
+        - closing:  Generation returned by close_generation
+        - total:    Recounted entities of that generation and the ones before
+    """
+    key = ndb.Key(Counter, name)
+    state, shards = key.get(), [s for s in ndb.get_multi(CounterShard.shard_keys(name)) if s]
+    if state is None or state.closing != closing:
+        logging.warning('[Counter] - {0}: generation {1} is not being recounted'.format(name, closing))
+        return
+    logging.info('[Counter] - {0}: generation {1} recounted, {2} -> {3}'
+                 .format(name, closing, state.base + sum(s.closed for s in shards), total))
+    for s in shards:
+        s.closed = 0
+    state.base = total
+    state.closing = None
+    ndb.put_multi([state] + shards)
+    ndb.get_context().call_on_commit(lambda: memcache.delete(name, namespace=MEMCACHE_NAMESPACE))
@@ -4,13 +4,21 @@ Defines the datastore and all interfaces needed for a Distrito in the Observador
 __author__ = 'Cesar'
 
 
+import time
 import logging
+import threading
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 
+GENERATION_NAMESPACE = 'distrito-generation'
+# Seconds an instance trusts its distritos before checking the generation in memcache
+GENERATION_CHECK_SECONDS = 30
+
+
 class Distrito(ndb.Model):
     """
-    Represents a distrito within the platform.
+    Represents a distrito within the platform. Keyed by national_id.
 
         - national_id: Unique national_id for the distrito in the national database
         - name:
@@ -31,7 +39,7 @@ class Distrito(ndb.Model):
         Returns:
             True if national_id exist False otherwise
         """
-        return cls.query(cls.national_id == national_id).count(1) == 1
+        return cls.get_by_id(national_id) is not None
 
     @classmethod
     def create(cls, national_id, name):
@@ -44,13 +52,16 @@ class Distrito(ndb.Model):
         Returns:
             Key of new entity
         """
-        try:
-            if Distrito.exists(national_id):
+        @ndb.transactional
+        def txn():
+            if Distrito.get_by_id(national_id):
                 raise DistritoCreationError('Distrito already in platform')
-            else:
-                d = Distrito(national_id=national_id, name=name)
-                key = d.put()
+            d = Distrito(id=national_id, national_id=national_id, name=name)
+            return d.put()
 
+        try:
+            key = txn()
+            distrito_cache.invalidate()
         except Exception:
             logging.exception("[distrito] - Error in create Distrito", exc_info=True)
             raise DistritoCreationError('Error creating the Distrito in platform')
@@ -58,23 +69,142 @@ class Distrito(ndb.Model):
             return key
 
     @classmethod
-    def get_from_datastore(cls, national_id):
+    @ndb.tasklet
+    def get_from_datastore_async(cls, national_id):
         """
         Gets a distrito from datastore based on its unique national_id (from national database)
         """
         try:
-            if Distrito.exists(national_id):
-                query = Distrito.query(Distrito.national_id == national_id).fetch(limit=1)
-                u = query
-            else:
+            u = yield Distrito.get_by_id_async(national_id)
+            if not u:
                 raise GetDistritoError('Distrito does not exist')
         except Exception as e:
                 raise GetDistritoError('Error getting Distrito: '+e.__str__())
         else:
-            logging.debug("[Distrito] - Key = {0}".format(u[0].key))
-            logging.debug("[Distrito] - national_id = {0}".format(u[0].national_id))
-            logging.debug("[Distrito] - name = {0}".format(u[0].name))
-            return u[0]
+            logging.debug("[Distrito] - Key = {0}".format(u.key))
+            logging.debug("[Distrito] - national_id = {0}".format(u.national_id))
+            logging.debug("[Distrito] - name = {0}".format(u.name))
+            raise ndb.Return(u)
+
+    @classmethod
+    def get_from_datastore(cls, national_id):
+        return cls.get_from_datastore_async(national_id).get_result()
+
+    @classmethod
+    def get_cached(cls, national_id):
+        """
+        Gets a distrito from distrito_cache, no datastore RPC once the instance has the distritos loaded
+            :returns Distrito object
+        """
+        d = distrito_cache.get(national_id)
+        if not d:
+            raise GetDistritoError('Distrito does not exist')
+        return d
+
+
+class DistritoCache(object):
+    """
+    All the distritos, by national_id and by key, shared by the requests of an instance. Loaded with one query on
+    warmup (or first use) and reloaded when the generation in memcache changes: Distrito.create drops it, so every
+    instance reloads within GENERATION_CHECK_SECONDS. A distrito missing from the cache is read from the datastore,
+    so the ones created on other instances are found before the reload.
+
+    The lock only guards swapping the (by_id, by_key) snapshot, which is replaced and never modified: the memcache and
+    datastore reads run outside of it, because a synchronous datastore call runs the tasklets of the request, and
+    one of them could ask for the lock again.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.generation = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self, national_id):
+        """
+        Distrito with the national_id, None if it does not exist
+        """
+        by_id, by_key = self._current()
+        d = by_id.get(national_id)
+        if d is None:
+            d = Distrito.get_by_id(national_id)
+            if d:
+                self._add(d)
+        return d
+
+    def get_by_key(self, key):
+        """
+        Distrito with the key, None if it does not exist
+        """
+        by_id, by_key = self._current()
+        d = by_key.get(key)
+        return d if d else self.get(key.id())
+
+    def get_all(self):
+        """
+        All the distritos, national_id -> Distrito
+        """
+        by_id, by_key = self._current()
+        with self._lock:
+            return dict(by_id)
+
+    def load(self):
+        self._load(self._generation())
+
+    def invalidate(self):
+        """
+        Drops the distritos of the instance and the generation, so every instance reloads them
+        """
+        with self._lock:
+            self.snapshot = None
+        memcache.delete('generation', namespace=GENERATION_NAMESPACE)
+
+    def _current(self):
+        with self._lock:
+            snapshot, generation, checked_at = self.snapshot, self.generation, self.checked_at
+        if snapshot is None:
+            return self._load(self._generation())
+        if time.time() - checked_at > GENERATION_CHECK_SECONDS:
+            current = self._generation()
+            if current != generation:
+                return self._load(current)
+            with self._lock:
+                self.checked_at = time.time()
+        return snapshot
+
+    def _add(self, d):
+        with self._lock:
+            if self.snapshot is not None:
+                by_id, by_key = dict(self.snapshot[0]), dict(self.snapshot[1])
+                by_id[d.key.id()] = d
+                by_key[d.key] = d
+                self.snapshot = (by_id, by_key)
+
+    @staticmethod
+    def _generation():
+        generation = memcache.get('generation', namespace=GENERATION_NAMESPACE)
+        if generation is None:
+            generation = int(time.time() * 1000)
+            if not memcache.add('generation', generation, namespace=GENERATION_NAMESPACE):
+                generation = memcache.get('generation', namespace=GENERATION_NAMESPACE)
+        return generation
+
+    def _load(self, generation):
+        """
+        Queries all the distritos and swaps them in, returns the new snapshot
+        """
+        started = time.time()
+        distritos = Distrito.query().fetch()
+        snapshot = (dict((d.key.id(), d) for d in distritos), dict((d.key, d) for d in distritos))
+        with self._lock:
+            self.snapshot = snapshot
+            self.generation = generation
+            self.checked_at = time.time()
+        logging.info('[Distrito] - {0} distritos loaded in {1:.3f}s'.format(len(distritos), time.time() - started))
+        return snapshot
+
+
+distrito_cache = DistritoCache()
 
 
 
@@ -0,0 +1,359 @@
+"""
+Defines the export of observaciones in the Observador-Electoral platform.
+
+Observaciones are read in pages of PAGE_SIZE with query cursors. For every page the referenced casillas and
+observadores are read with one get_multi each, the clasificaciones come from the cached catalogue and the filled
+checklists are decoded with Observacion.get_filled_checklists. Rows are formatted as NDJSON (one JSON object per line)
+or CSV (FIELDS columns, the filled checklist as JSON) a page at a time, so memory does not grow with the export:
+
+    - get_page() returns one page of rows and the cursor of the next one (observacion.export)
+    - ObservacionExport writes a whole export to a Cloud Storage file as a chain of deferred tasks, checkpointing the
+      cursor and the open file after every page, and can be resumed from the last checkpoint
+
+The job writes through WRITER: 'gcs' (Cloud Storage, GcsWriter) or 'local' (LocalWriter, a stub keeping the file in
+the datastore, the default on the development server). The Cloud Storage client library (cloudstorage) is vendored in
+lib/ (pip install -t lib -r requirements.txt, see appengine_config.py), a job without it fails permanently.
+"""
+__author__ = 'Cesar'
+
+
+import os
+import csv
+import json
+import time
+import pickle
+import datetime
+import logging
+import StringIO
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+
+from observacion import Observacion
+from clasificacion import Clasificacion
+from distrito import Distrito
+
+
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+FORMATS = ('csv', 'ndjson')
+FIELDS = ['key', 'date', 'casilla', 'casilla_name', 'distrito', 'observador', 'observador_name', 'clasificacion',
+          'clasificacion_name', 'filled_checklist']
+# Leave room before the 10 minutes deadline of a push task
+TASK_BUDGET_SECONDS = 8 * 60
+# A pending or running job without progress for this long can be resumed (seconds), its task chain was lost
+RESUME_STALE_SECONDS = 15 * 60
+# 'gcs' or 'local', see GcsWriter and LocalWriter
+WRITER = 'local' if os.environ.get('SERVER_SOFTWARE', '').startswith('Development') else 'gcs'
+
+
+class ObservacionExport(ndb.Model):
+    """
+    Represents an export job of observaciones to Cloud Storage.
+
+        - destination: Cloud Storage file (/bucket/object)
+        - file_format: csv or ndjson
+        - distrito, clasificacion: Optional filters
+        - cursor: URL safe cursor of the first page not yet written (checkpoint)
+        - writer: Pickled Cloud Storage file being written, as of the checkpoint
+        - rows: Rows written so far
+        - seconds: Processing time spent so far
+    """
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    destination = ndb.StringProperty()
+    file_format = ndb.StringProperty(choices=list(FORMATS))
+    distrito = ndb.KeyProperty(kind=Distrito)
+    clasificacion = ndb.KeyProperty(kind=Clasificacion)
+    status = ndb.StringProperty(choices=['pending', 'running', 'done', 'failed'], default='pending')
+    cursor = ndb.StringProperty(indexed=False)
+    writer = ndb.BlobProperty(compressed=True)
+    rows = ndb.IntegerProperty(default=0)
+    seconds = ndb.FloatProperty(default=0.0)
+
+    @classmethod
+    def start(cls, destination, file_format, distrito=None, clasificacion=None):
+        """
+        Creates a new export job and enqueues its first task.
+        :param:
+            - destination: Cloud Storage file (/bucket/object)
+            - file_format: csv or ndjson
+            - distrito: Optional national_id of the distrito to export
+            - clasificacion: Optional URL safe key of the clasificacion to export
+
+        :return:
+            Key of the new job
+        """
+        try:
+            if file_format not in FORMATS:
+                raise ExportError('Unknown format: {0}'.format(file_format))
+            if not destination or not destination.startswith('/'):
+                raise ExportError('Destination must be /bucket/object')
+            job = ObservacionExport(destination=destination,
+                                    file_format=file_format,
+                                    distrito=ndb.Key(Distrito, distrito) if distrito else None,
+                                    clasificacion=ndb.Key(urlsafe=clasificacion) if clasificacion else None)
+            key = job.put()
+            deferred.defer(run, key.urlsafe())
+        except ExportError:
+            raise
+        except Exception as e:
+            logging.exception("[Export] - Error starting export", exc_info=True)
+            raise ExportError('Error starting the export: '+e.__str__())
+        else:
+            logging.info('[Export] - New export {0} to {1}'.format(key, destination))
+            return key
+
+    @classmethod
+    def resume(cls, url_safe_key):
+        """
+        Enqueues a new task for a failed job, or a pending or running one without progress in RESUME_STALE_SECONDS
+        (its task was lost), continuing from its last checkpoint and the file as of that checkpoint. The job is
+        flipped to pending in the transaction enqueueing the task, so a job never runs two task chains.
+        """
+        @ndb.transactional
+        def txn(key):
+            job = key.get()
+            if not job:
+                raise ExportError('Export does not exist')
+            stale = datetime.datetime.utcnow() - job.updated > datetime.timedelta(seconds=RESUME_STALE_SECONDS)
+            if job.status != 'failed' and not (job.status in ('pending', 'running') and stale):
+                raise ExportError('Export is {0}, only failed or stalled exports can be resumed'.format(job.status))
+            job.status = 'pending'
+            job.put()
+            deferred.defer(run, key.urlsafe(), _transactional=True)
+            return job
+
+        try:
+            job = txn(ndb.Key(urlsafe=url_safe_key))
+        except ExportError:
+            raise
+        except Exception as e:
+            raise ExportError('Error resuming the export: '+e.__str__())
+        else:
+            return job
+
+    @classmethod
+    def get_status(cls, url_safe_key):
+        """
+        Gets an export job from its URL safe key
+        """
+        try:
+            job = ndb.Key(urlsafe=url_safe_key).get()
+            if not job:
+                raise ExportError('Export does not exist')
+        except ExportError:
+            raise
+        except Exception as e:
+            raise ExportError('Error getting the export: '+e.__str__())
+        else:
+            return job
+
+
+class ExportChunk(ndb.Model):
+    """
+    Represents a piece of an export file written by LocalWriter. Child of the ObservacionExport, keyed by its position.
+    """
+
+    data = ndb.BlobProperty(compressed=True)
+
+
+class GcsWriter(object):
+    """
+    Export file in Cloud Storage, pickled with the job at every checkpoint
+    """
+
+    def __init__(self, job):
+        import cloudstorage
+
+        content_type = 'text/csv' if job.file_format == 'csv' else 'application/x-ndjson'
+        self.f = cloudstorage.open(job.destination, 'w', content_type=content_type)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+class LocalWriter(object):
+    """
+    Local stub of GcsWriter: the file is kept as ExportChunk entities of the job, read it with read_local(). A page
+    written again after a failure replaces its chunk.
+    """
+
+    def __init__(self, job):
+        self.job = job.key
+        self.chunks = 0
+
+    def write(self, data):
+        ExportChunk(parent=self.job, id=self.chunks + 1, data=data).put()
+        self.chunks += 1
+
+    def close(self):
+        pass
+
+
+WRITERS = {'gcs': GcsWriter, 'local': LocalWriter}
+
+
+def read_local(url_safe_key):
+    """
+    Contents of the file of an export written by LocalWriter
+    """
+    chunks = ExportChunk.query(ancestor=ndb.Key(urlsafe=url_safe_key)).fetch()
+    return ''.join(c.data for c in sorted(chunks, key=lambda c: c.key.id()))
+
+
+def _query(distrito=None, clasificacion=None):
+    query = Observacion.query()
+    if distrito:
+        query = query.filter(Observacion.distrito == distrito)
+    if clasificacion:
+        query = query.filter(Observacion.clasificacion == clasificacion)
+    return query
+
+
+@ndb.tasklet
+def get_page_async(file_format, cursor=None, page_size=PAGE_SIZE, distrito=None, clasificacion=None, header=None):
+    """
+    Gets one page of the export.
+
+    Args:
+        - file_format:      csv or ndjson
+        - cursor:           URL safe cursor of the page, the first page if None
+        - page_size:        Observaciones in the page, at most MAX_PAGE_SIZE
+        - distrito:         Optional Distrito key filter
+        - clasificacion:    Optional Clasificacion key filter
+        - header:           Start the CSV page with the header row, by default only the first page has it
+
+    Returns:
+        Future, (data (String), rows in data, URL safe cursor of the next page, more (Boolean))
+    """
+    if file_format not in FORMATS:
+        raise ExportError('Unknown format: {0}'.format(file_format))
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    observaciones, next_cursor, more = yield _query(distrito, clasificacion).fetch_page_async(
+        min(page_size, MAX_PAGE_SIZE), start_cursor=start_cursor)
+    rows = yield _rows_async(observaciones)
+    if header is None:
+        header = cursor is None
+    data = format_rows(rows, file_format, header=header and file_format == 'csv')
+    raise ndb.Return((data, len(rows), next_cursor.urlsafe() if next_cursor and more else None, more))
+
+
+def get_page(file_format, cursor=None, page_size=PAGE_SIZE, distrito=None, clasificacion=None, header=None):
+    return get_page_async(file_format, cursor, page_size, distrito, clasificacion, header).get_result()
+
+
+@ndb.tasklet
+def _rows_async(observaciones):
+    """
+    Export rows (dicts of FIELDS) of a page of observaciones
+    """
+    casilla_keys = list(set(o.casilla for o in observaciones if o.casilla))
+    observador_keys = list(set(o.observador for o in observaciones if o.observador))
+    casillas, observadores, catalogue, filled = yield (ndb.get_multi_async(casilla_keys),
+                                                       ndb.get_multi_async(observador_keys),
+                                                       Clasificacion.get_catalogue_async(),
+                                                       Observacion.get_filled_checklists_async(observaciones))
+    casillas = dict(zip(casilla_keys, casillas))
+    observadores = dict(zip(observador_keys, observadores))
+    clasificaciones = dict((c.key, c) for c in catalogue)
+
+    rows = []
+    for o, checklist in zip(observaciones, filled):
+        c = casillas.get(o.casilla)
+        obs = observadores.get(o.observador)
+        clasificacion = clasificaciones.get(o.clasificacion)
+        rows.append({'key': o.key.urlsafe(),
+                     'date': o.date.isoformat() if o.date else None,
+                     'casilla': o.casilla.id() if o.casilla else None,
+                     'casilla_name': c.name if c else None,
+                     'distrito': o.distrito.id() if o.distrito else None,
+                     'observador': o.observador.id() if o.observador else None,
+                     'observador_name': obs.name if obs else None,
+                     'clasificacion': o.clasificacion.urlsafe() if o.clasificacion else None,
+                     'clasificacion_name': clasificacion.name if clasificacion else None,
+                     'filled_checklist': checklist})
+    raise ndb.Return(rows)
+
+
+def format_rows(rows, file_format, header=False):
+    """
+    Formats rows as NDJSON or CSV (UTF-8), optionally starting with the CSV header row
+    """
+    if file_format == 'ndjson':
+        return ''.join(json.dumps(row, sort_keys=True) + '\n' for row in rows)
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(FIELDS)
+    for row in rows:
+        values = [json.dumps(row[f]) if f == 'filled_checklist' else row[f] for f in FIELDS]
+        writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else ('' if v is None else v) for v in values])
+    return out.getvalue()
+
+
+def run(url_safe_key):
+    """
+    Writes pages until the export is complete or the task budget is spent, in that case the job chains itself from
+    the checkpoint.
+    """
+    job = ndb.Key(urlsafe=url_safe_key).get()
+    if not job or job.status == 'done':
+        return
+
+    task_started = time.time()
+    job.status = 'running'
+    try:
+        f = pickle.loads(job.writer) if job.writer else WRITERS[WRITER](job)
+    except ImportError as e:
+        # Retrying does not help without the library
+        logging.error('[Export] - Export {0}: Cloud Storage client library unavailable'.format(url_safe_key))
+        job.status = 'failed'
+        job.put()
+        raise deferred.PermanentTaskFailure('Cloud Storage client library unavailable: '+e.__str__())
+    try:
+        cursor = job.cursor
+        rows = job.rows
+        while True:
+            page_started = time.time()
+            data, count, cursor, more = get_page(job.file_format, cursor, PAGE_SIZE, job.distrito, job.clasificacion,
+                                                 header=rows == 0)
+            f.write(data)
+            rows += count
+            if not more:
+                f.close()
+                job.rows = rows
+                job.cursor = None
+                job.writer = None
+                job.seconds += time.time() - page_started
+                job.status = 'done'
+                job.put()
+                logging.info('[Export] - Export {0} done: {1} rows in {2:.1f}s'
+                             .format(url_safe_key, job.rows, job.seconds))
+                return
+            # Checkpoint, the job only records progress written to the pickled file
+            job.cursor = cursor
+            job.rows = rows
+            job.writer = pickle.dumps(f)
+            job.seconds += time.time() - page_started
+            job.put()
+            if time.time() - task_started > TASK_BUDGET_SECONDS:
+                break
+    except Exception:
+        logging.exception('[Export] - Export {0} failed at cursor {1}'.format(url_safe_key, job.cursor))
+        job.status = 'failed'
+        job.put()
+        return
+
+    deferred.defer(run, url_safe_key)
+
+
+class ExportError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
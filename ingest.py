@@ -0,0 +1,268 @@
+"""
+Defines the write-behind ingestion of observaciones in the Observador-Electoral platform.
+
+In background mode observacion.create validates the request without datastore reads (the filled checklist with the
+compiled checklist of its clasificacion, cached per instance), pre-allocates the key of the observacion, adds the
+submission to PULL_QUEUE and replies with the key. A worker task on PUSH_QUEUE, scheduled once per
+BATCH_WINDOW_SECONDS (tasks are named after the window, so concurrent requests do not schedule it twice), leases the
+submissions BATCH_SIZE at a time and writes them with Observacion.save_batch.
+
+Submissions that cannot be written (unknown casilla or observador, invalid checklist, id used by another submission)
+are dropped on the first attempt, the ones whose write transaction failed after MAX_RETRIES leases. Both are recorded
+as an IngestFailure keyed like the observacion, get_status() reports whether the key was written, failed (and why) or
+is still pending. Writes are keyed
+by the pre-allocated id (or the client submission id) and skip observaciones already written, so a submission leased
+twice is written once.
+
+With QUEUE = 'local' the pull queue is LocalQueue, an in-process stub, and no worker task is scheduled: drain() runs
+the worker in the same process, so the whole path runs without the task queue service (tests, remote api shell).
+"""
+__author__ = 'Cesar'
+
+
+import json
+import time
+import logging
+import threading
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+
+from observacion import Observacion, WRITE_ERROR, ALREADY_EXISTS
+from clasificacion import Clasificacion, GetClasificacionError
+from checklist import FilledChecklistError
+from cache import submission_cache
+
+
+# Queues defined in queue.yaml
+PULL_QUEUE = 'observaciones-pull'
+PUSH_QUEUE = 'observaciones-ingest'
+BATCH_SIZE = 100
+BATCH_WINDOW_SECONDS = 2
+LEASE_SECONDS = 120
+MAX_RETRIES = 5
+# Leave room before the 10 minutes deadline of a push task
+TASK_BUDGET_SECONDS = 8 * 60
+# 'taskqueue' or 'local' (LocalQueue)
+QUEUE = 'taskqueue'
+
+
+class IngestFailure(ndb.Model):
+    """
+    Represents a queued observacion that could not be written. Keyed by the id of the observacion.
+
+        - error: Error of the last attempt
+        - payload: The submission (JSON)
+    """
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    error = ndb.StringProperty(indexed=False)
+    payload = ndb.TextProperty()
+
+
+class LocalTask(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.retry_count = 0
+        self.leased_until = 0
+
+
+class LocalQueue(object):
+    """
+    In-process stub of the pull queue: the add, lease_tasks and delete_tasks used by the ingestion
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self._lock = threading.Lock()
+
+    def add(self, task):
+        with self._lock:
+            self.tasks.append(LocalTask(task.payload))
+
+    def lease_tasks(self, lease_seconds, max_tasks):
+        now = time.time()
+        with self._lock:
+            leased = [t for t in self.tasks if t.leased_until <= now][:max_tasks]
+            for t in leased:
+                if t.leased_until:
+                    t.retry_count += 1
+                t.leased_until = now + lease_seconds
+        return leased
+
+    def delete_tasks(self, tasks):
+        with self._lock:
+            self.tasks = [t for t in self.tasks if t not in tasks]
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+local_queue = LocalQueue()
+
+
+def _pull_queue():
+    return local_queue if QUEUE == 'local' else taskqueue.Queue(PULL_QUEUE)
+
+
+def enqueue_observacion(observador, casilla, clasificacion, filled_checklist, submission_id=None):
+    """
+    Queues a new observacion to be written by the ingestion worker.
+        :param observador: (String) email
+        :param casilla: (String) national id
+        :param clasificacion: URL safe key of the Observador selected clasificacion
+        :param filled_checklist: JSON of checklist filled by the Observador
+        :param submission_id: Optional client generated id, used as key instead of a pre-allocated one
+
+        :return: URL safe key the observacion will be written with
+    """
+    if submission_id:
+        # Replays are answered from the dedup cache, and are not queued again
+        cache_key = Observacion.submission_cache_key(submission_id, observador, casilla, clasificacion)
+        cached = submission_cache.peek_async(cache_key).get_result()
+        if cached:
+            return cached
+    try:
+        if not observador or not casilla:
+            raise IngestError('Observador and casilla are required')
+        if _kind(clasificacion) != 'Clasificacion':
+            raise IngestError('Invalid clasificacion key')
+        # Compiled checklist from the instance cache, invalid checklists are never queued
+        Clasificacion.get_checklist_async(clasificacion).get_result().validate(filled_checklist)
+        if submission_id:
+            observacion_id = submission_id
+        else:
+            observacion_id = Observacion.allocate_ids(1)[0]
+        payload = json.dumps({'id': observacion_id,
+                              'date': time.time(),
+                              'observador': observador,
+                              'casilla': casilla,
+                              'clasificacion': clasificacion,
+                              'filled_checklist': filled_checklist})
+        _pull_queue().add(taskqueue.Task(payload=payload, method='PULL'))
+        schedule_worker()
+        url_safe_key = ndb.Key(Observacion, observacion_id).urlsafe()
+        if submission_id:
+            submission_cache.set(cache_key, url_safe_key)
+    except IngestError:
+        raise
+    except (GetClasificacionError, FilledChecklistError) as e:
+        raise IngestError(e.value)
+    except Exception as e:
+        logging.exception('[Ingest] - Error queueing observacion', exc_info=True)
+        raise IngestError('Error queueing the observacion: '+e.__str__())
+    else:
+        return url_safe_key
+
+
+def _kind(url_safe_key):
+    try:
+        return ndb.Key(urlsafe=url_safe_key).kind()
+    except Exception:
+        return None
+
+
+def schedule_worker(delay=0):
+    """
+    Schedules the worker at the end of the current BATCH_WINDOW_SECONDS window (plus delay), unless it already is
+    """
+    if QUEUE == 'local':
+        # drain() runs the worker
+        return
+    run_at = time.time() + delay
+    window = int(run_at / BATCH_WINDOW_SECONDS)
+    countdown = (window + 1) * BATCH_WINDOW_SECONDS - time.time() + 1
+    try:
+        deferred.defer(process_queue,
+                       _queue=PUSH_QUEUE,
+                       _name='ingest-{0}'.format(window),
+                       _countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def process_queue():
+    """
+    Writes the queued submissions in batches of BATCH_SIZE until the queue is empty or the task budget is spent.
+    """
+    queue = _pull_queue()
+    started = time.time()
+    retry = False
+    while time.time() - started < TASK_BUDGET_SECONDS:
+        tasks = queue.lease_tasks(LEASE_SECONDS, BATCH_SIZE)
+        if not tasks:
+            break
+        batch_started = time.time()
+        results = Observacion.save_batch([json.loads(t.payload) for t in tasks])
+        done = []
+        failures = []
+        for task, (url_safe_key, error) in zip(tasks, results):
+            if not error:
+                done.append(task)
+            elif error.startswith(WRITE_ERROR) and task.retry_count < MAX_RETRIES:
+                # Leased again once the lease expires
+                retry = True
+            else:
+                if error.startswith(WRITE_ERROR):
+                    logging.error('[Ingest] - Dropping submission after {0} attempts: {1} - {2}'
+                                  .format(task.retry_count, error, task.payload))
+                else:
+                    # Fails the same way on every attempt
+                    logging.warning('[Ingest] - Rejected submission: {0} - {1}'.format(error, task.payload))
+                failures.append(IngestFailure(id=json.loads(task.payload)['id'], error=error, payload=task.payload))
+                done.append(task)
+        # Recorded before the submissions are deleted, so a key never stays pending for good
+        ndb.put_multi(failures)
+        queue.delete_tasks(done)
+        logging.info('[Ingest] - Wrote {0}/{1} observaciones in {2:.2f}s'
+                     .format(len([r for r in results if not r[1]]), len(tasks), time.time() - batch_started))
+    else:
+        # Budget spent with submissions left
+        schedule_worker()
+    if retry:
+        schedule_worker(delay=LEASE_SECONDS)
+
+
+def drain(max_seconds=60):
+    """
+    Runs the worker in this process until the queue is empty (failed submissions wait for their lease to expire) or
+    max_seconds have passed. Meant for QUEUE = 'local'.
+    """
+    started = time.time()
+    while len(local_queue) and time.time() - started < max_seconds:
+        process_queue()
+        if len(local_queue):
+            time.sleep(0.1)
+
+
+def get_status(url_safe_key):
+    """
+    Gets the status of a queued observacion.
+        :param url_safe_key: Key returned by enqueue_observacion
+
+        :return: (status, error): ('written', None), ('failed', error of the last attempt) or ('pending', None)
+    """
+    try:
+        key = ndb.Key(urlsafe=url_safe_key)
+    except Exception:
+        key = None
+    if key is None or key.kind() != 'Observacion':
+        raise IngestError('Invalid observacion key')
+    try:
+        observacion, failure = ndb.get_multi([key, ndb.Key(IngestFailure, key.id())])
+    except Exception as e:
+        raise IngestError('Error getting the observacion: '+e.__str__())
+    # The observacion of a rejected id belongs to another submission
+    if observacion and not (failure and failure.error == ALREADY_EXISTS):
+        return 'written', None
+    if failure:
+        return 'failed', failure.error
+    return 'pending', None
+
+
+class IngestError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -8,6 +8,7 @@ __author__ = 'Cesar'
 import logging
 from google.appengine.ext import ndb
 from observador import Observador
+from cache import submission_cache
 
 
 class Location(ndb.Model):
@@ -22,26 +23,111 @@ class Location(ndb.Model):
     loc = ndb.GeoPtProperty()
 
     @classmethod
-    def create(cls, observador, loc):
+    @ndb.tasklet
+    def create_async(cls, observador, loc, submission_id=None):
         """
-        Creates a new location in the datastore.
+        Creates a new location in the datastore. A replay (same submission_id and observador) returns the existing
+        location.
         :param:
             - loc: Geographic coordinates of a location
+            - submission_id: Optional client generated id, used as key so retries do not create duplicates. A location
+              already written with it by another observador is a conflict
 
         :return:
-            Key of new entity
+            Future, key of new entity
         """
+        @ndb.transactional_tasklet
+        def txn(new):
+            current = yield new.key.get_async()
+            if current:
+                if current.observador == new.observador:
+                    raise ndb.Return(current)
+                raise LocationCreationError('Location already exists in platform')
+            yield new.put_async()
+            raise ndb.Return(new)
+
+        if submission_id:
+            # Replays are answered from the dedup cache
+            cache_key = cls.submission_cache_key(submission_id, observador)
+            cached = yield submission_cache.peek_async(cache_key)
+            if cached:
+                raise ndb.Return(ndb.Key(urlsafe=cached))
         try:
-            o = Observador.get_from_datastore(email=observador)
+            o = yield Observador.get_from_datastore_async(email=observador)
             geo_pt = ndb.GeoPt(str(loc))
-            l = Location(loc=geo_pt, observador=o.key)
-            key = l.put()
+            if submission_id:
+                location = yield txn(Location(id=submission_id, loc=geo_pt, observador=o.key))
+                yield submission_cache.set_async(cache_key, location.key.urlsafe())
+            else:
+                location = Location(loc=geo_pt, observador=o.key)
+                yield location.put_async()
 
+        except LocationCreationError:
+            raise
         except Exception:
             logging.exception("[location] - Error in create location", exc_info=True)
             raise LocationCreationError('Error creating the location in platform')
-        else:
-            return key
+        try:
+            yield LastLocation.record_async(location)
+        except Exception:
+            # The location is written, a retry without submission_id would duplicate it
+            logging.exception("[location] - Error recording the last location", exc_info=True)
+        raise ndb.Return(location.key)
+
+    @classmethod
+    def create(cls, observador, loc, submission_id=None):
+        return cls.create_async(observador, loc, submission_id).get_result()
+
+    @classmethod
+    def submission_cache_key(cls, submission_id, observador):
+        """
+        Dedup cache key of a submission, only a replay by the same observador is answered from the cache
+        """
+        return u'Location:{0}:{1}'.format(submission_id, observador)
+
+
+class LastLocation(ndb.Model):
+    """
+    Represents the last location reported by an Observador, so its position is read with a get instead of a query
+    over the locations. Keyed by the email of the Observador.
+
+        - created: When the location was reported
+        - loc: Geographic coordinates of the location
+    """
+
+    created = ndb.DateTimeProperty(indexed=False)
+    loc = ndb.GeoPtProperty(indexed=False)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def record_async(cls, location):
+        """
+        Records a written location unless a newer one is recorded for its Observador (a replayed location never moves
+        it backwards).
+        :param:
+            - location: Location already written
+
+        :return:
+            Future
+        """
+        key = ndb.Key(cls, location.observador.id())
+        last = yield key.get_async()
+        if last is None or last.created < location.created:
+            yield cls(key=key, created=location.created, loc=location.loc).put_async()
+
+    @classmethod
+    def get_positions(cls, emails, since):
+        """
+        Last coordinates reported since a date by the observadores, one get_multi
+        :param:
+            - emails: Observadores
+            - since: Oldest location considered (datetime)
+
+        :return:
+            dict email -> (lat, lon), observadores without a location since then are left out
+        """
+        lasts = ndb.get_multi([ndb.Key(cls, e) for e in emails])
+        return dict((l.key.id(), (l.loc.lat, l.loc.lon)) for l in lasts if l and l.created >= since)
 
 
 class LocationCreationError(Exception):
@@ -7,24 +7,29 @@ __author__ = 'Cesar'
 import logging
 from google.appengine.ext import ndb
 from observacion import Observacion
+from casilla import Casilla
+from cache import submission_cache
 
 
 class Media(ndb.Model):
     """
-    Represents a media within the platform.
+    Represents a media within the platform. Keyed by name.
 
         - observacion:
         - m_type: type of media [video, photo, audio]
         - name: unique id for media file in bucket
+        - casilla: Casilla of the observacion (denormalized for the casilla timeline)
     """
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     observacion = ndb.KeyProperty(kind=Observacion)
+    casilla = ndb.KeyProperty(kind=Casilla)
     m_type = ndb.StringProperty(choices=['video', 'photo', 'audio'])
     name = ndb.StringProperty()
 
     @classmethod
-    def exists(cls, name):
+    @ndb.tasklet
+    def exists_async(cls, name):
         """
         Checks the datastore to find if the media (name) is already on it.
 
@@ -32,55 +37,83 @@ class Media(ndb.Model):
             name: (String) name from request
 
         Returns:
-            True if name exist False otherwise
+            Future, True if name exist False otherwise
         """
-        return cls.query(cls.name == name).count(1) == 1
+        m = yield cls.get_by_id_async(name)
+        raise ndb.Return(m is not None)
+
+    @classmethod
+    def exists(cls, name):
+        return cls.exists_async(name).get_result()
 
     @classmethod
-    def create(cls, m_type, name, observacion):
+    @ndb.tasklet
+    def create_async(cls, m_type, name, observacion, submission_id=None):
         """
-        Creates a new media in the datastore.
+        Creates a new media in the datastore. A replay (same name and observacion) returns the existing media.
         Args:
             - observacion: URL safe key of the related observacion
             - m_type: String holding the type for media
-            - name: String holding the unique name of the media (app created)
+            - name: String holding the unique name of the media (app created), used as key
+            - submission_id: Optional client generated id of the request, replays are answered from the dedup cache
 
         Returns:
-            Key of new entity
+            Future, key of new entity
         """
-        try:
-            if Media.exists(name):
+        @ndb.transactional_tasklet
+        def txn():
+            current = yield Media.get_by_id_async(name)
+            if current:
+                if current.observacion == o_key:
+                    raise ndb.Return(current.key)
                 raise MediaCreationError('Media already exists in platform')
-            else:
-                o_key = ndb.Key(urlsafe=observacion)
-                m = Media(observacion=o_key, m_type=m_type, name=name)
-                key = m.put()
-
+            m = Media(id=name, observacion=o_key, casilla=o.casilla if o else None, m_type=m_type, name=name)
+            key = yield m.put_async()
+            raise ndb.Return(key)
+
+        if submission_id:
+            # Replays are answered from the dedup cache
+            cached = yield submission_cache.peek_async('Media:' + submission_id)
+            if cached:
+                raise ndb.Return(ndb.Key(urlsafe=cached))
+        try:
+            o_key = ndb.Key(urlsafe=observacion)
+            o = yield o_key.get_async()
+            key = yield txn()
+            if submission_id:
+                yield submission_cache.set_async('Media:' + submission_id, key.urlsafe())
         except Exception:
             logging.exception("[media] - Error in create Media", exc_info=True)
             raise MediaCreationError('Error creating the Media in platform')
         else:
-            return key
+            raise ndb.Return(key)
 
     @classmethod
-    def get_from_datastore(cls, name):
+    def create(cls, m_type, name, observacion, submission_id=None):
+        return cls.create_async(m_type, name, observacion, submission_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_from_datastore_async(cls, name):
         """
         Gets a media from datastore based on its name
         """
         try:
-            if Media.exists(name):
-                query = Media.query(Media.name == name).fetch(limit=1)
-                m = query
-            else:
+            m = yield Media.get_by_id_async(name)
+            if not m:
                 raise GetMediaError('Media does not exist')
         except Exception as e:
                 raise GetMediaError('Error getting Media: '+e.__str__())
         else:
-            logging.debug("[Media] - Key = {0}".format(m[0].key))
-            logging.debug("[Media] - Observacion = {0}".format(m[0].observacion))
-            logging.debug("[Media] - type = {0}".format(m[0].type))
-            logging.debug("[Media] - name = {0}".format(m[0].name))
-            return m[0]
+            logging.debug("[Media] - Key = {0}".format(m.key))
+            logging.debug("[Media] - Observacion = {0}".format(m.observacion))
+            logging.debug("[Media] - type = {0}".format(m.m_type))
+            logging.debug("[Media] - name = {0}".format(m.name))
+            raise ndb.Return(m)
+
+    @classmethod
+    def get_from_datastore(cls, name):
+        return cls.get_from_datastore_async(name).get_result()
 
 
 
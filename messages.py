@@ -19,12 +19,14 @@ class CreateObservador(messages.Message):
         age: (Integer)
         account_type: (String)
         installation_id: (String) Parse ID for Push notifications
+        home: (String) Optional home coordinates (lat,long), used to plan casilla assignments
     """
     email = messages.StringField(1, required=True)
     name = messages.StringField(2, required=True)
     age = messages.IntegerField(3)
     account_type = messages.StringField(4, required=True)
     installation_id = messages.StringField(5, required=True)
+    home = messages.StringField(6)
 
 
 class CreateObservadorResponse(messages.Message):
@@ -56,6 +58,7 @@ class GetObservadorResponse(messages.Message):
         age = (Integer)
         account_type = (String)
         installation_id = (String) Parse ID for Push notifications
+        home = (String) Home coordinates (lat,long)
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
@@ -65,6 +68,55 @@ class GetObservadorResponse(messages.Message):
     age = messages.IntegerField(5)
     account_type = messages.StringField(6)
     installation_id = messages.StringField(7)
+    home = messages.StringField(8)
+
+
+class UpdateObservador(messages.Message):
+    """
+    Message containing the profile fields to update for a observador, only the fields sent are updated
+        email: (String)
+        name: (String)
+        age: (Integer)
+        installation_id: (String) Parse ID for Push notifications
+        home: (String) Home coordinates (lat,long)
+    """
+    email = messages.StringField(1, required=True)
+    name = messages.StringField(2)
+    age = messages.IntegerField(3)
+    installation_id = messages.StringField(4)
+    home = messages.StringField(5)
+
+
+class UpdateObservadorResponse(messages.Message):
+    """
+    Response to observador update request
+        ok: (Boolean) Update successful or failed
+        error: (String) If update failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+
+
+class GetObservadorCacheStats(messages.Message):
+    """
+    Message requesting the observador cache counters of the instance serving the request
+    """
+
+
+class GetObservadorCacheStatsResponse(messages.Message):
+    """
+    Response to observador cache counters request.
+        ok: (Boolean)
+        local_hits: (Integer) Lookups served by the instance LRU
+        memcache_hits: (Integer) Lookups served by memcache
+        misses: (Integer) Lookups that reached the datastore
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    local_hits = messages.IntegerField(2)
+    memcache_hits = messages.IntegerField(3)
+    misses = messages.IntegerField(4)
+    error = messages.StringField(5)
 
 """
 CASILLA
@@ -98,6 +150,7 @@ class CreateCasillaResponse(messages.Message):
 class Casilla(messages.Message):
     """
     Casilla entity for details response
+        distrito_name, observador_email, observador_name and url_safe_key are only filled in expanded listings
     """
     observador = messages.StringField(1)
     distrito = messages.StringField(2)
@@ -106,6 +159,10 @@ class Casilla(messages.Message):
     name = messages.StringField(5)
     address = messages.StringField(6)
     picture_url = messages.StringField(7)
+    distrito_name = messages.StringField(8)
+    observador_email = messages.StringField(9)
+    observador_name = messages.StringField(10)
+    url_safe_key = messages.StringField(11)
 
 
 class GetCasillaDetail(messages.Message):
@@ -128,13 +185,55 @@ class GetCasillaDetailResponse(messages.Message):
     error = messages.StringField(3)
 
 
+class GetNearbyCasillas(messages.Message):
+    """
+    Message requesting the casillas nearest to a location
+        loc: (String) lat,long
+        limit: (Integer) page size
+        radius: (Float) optional maximum distance in meters
+        cursor: (String) cursor returned by the previous page
+    """
+    loc = messages.StringField(1, required=True)
+    limit = messages.IntegerField(2, default=20)
+    radius = messages.FloatField(3)
+    cursor = messages.StringField(4)
+
+
+class NearbyCasilla(messages.Message):
+    """
+    A casilla near the requested location
+        url_safe_key: (String) key of the casilla
+        distance: (Float) distance in meters to the requested location
+        casilla: Casilla details
+    """
+    url_safe_key = messages.StringField(1)
+    distance = messages.FloatField(2)
+    casilla = messages.MessageField(Casilla, 3)
+
+
+class GetNearbyCasillasResponse(messages.Message):
+    """
+    Response to nearby casillas request.
+        ok: (Boolean)
+        casillas: Casillas nearest first
+        cursor: (String) cursor for the next page, empty if there are no more casillas
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    casillas = messages.MessageField(NearbyCasilla, 2, repeated=True)
+    cursor = messages.StringField(3)
+    error = messages.StringField(4)
+
+
 class GetCasillasAssignedToObservador(messages.Message):
     """
     Message the casillas assigned to a given observador
         email: observador
+        expand: (Boolean) Also return the details of every casilla in casillas_detail
 
     """
     email = messages.StringField(1, required=True)
+    expand = messages.BooleanField(2)
 
 class GetCasillasAssignedToObservadorResponse(messages.Message):
     """
@@ -142,10 +241,12 @@ class GetCasillasAssignedToObservadorResponse(messages.Message):
         ok: (Boolean)
         Casilla (String): List of urlsafe casilla keys
         error: (String) If request failed, contains the reason, otherwise empty.
+        casillas_detail: List of Casilla details, with distrito and observador resolved (only if expand)
     """
     ok = messages.BooleanField(1)
     casillas = messages.StringField(2, repeated=True)
     error = messages.StringField(3)
+    casillas_detail = messages.MessageField(Casilla, 4, repeated=True)
 
 
 class AssignCasillaToObservador(messages.Message):
@@ -169,6 +270,268 @@ class AssignCasillaToObservadorResponse(messages.Message):
     error = messages.StringField(2)
 
 
+class CasillaAssignment(messages.Message):
+    """
+    A casilla to assign to a observador
+        casilla: national_id key for the casilla
+        observador: email
+    """
+    casilla = messages.StringField(1, required=True)
+    observador = messages.StringField(2, required=True)
+
+
+class CasillaAssignmentResult(messages.Message):
+    """
+    Result of a casilla assignment
+        casilla: national_id key for the casilla
+        observador: email
+        ok: (Boolean) Assignment successful or failed
+        error: (String) If assignment failed, contains the reason, otherwise empty.
+        distance: (Float) Meters between the observador and the casilla (only for planned assignments)
+    """
+    casilla = messages.StringField(1)
+    observador = messages.StringField(2)
+    ok = messages.BooleanField(3)
+    error = messages.StringField(4)
+    distance = messages.FloatField(5)
+
+
+class AssignCasillasBulk(messages.Message):
+    """
+    Message to assign casillas to observadores in bulk
+        assignments: (casilla, observador) pairs
+        background: (Boolean) Run the assignment as a background job, needed for large lists
+    """
+    assignments = messages.MessageField(CasillaAssignment, 1, repeated=True)
+    background = messages.BooleanField(2)
+
+
+class AssignCasillasBulkResponse(messages.Message):
+    """
+    Response to bulk assignment request.
+        ok: (Boolean)
+        results: Result of every pair (only if not background)
+        job: (String) URL safe key of the background job (only if background)
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    results = messages.MessageField(CasillaAssignmentResult, 2, repeated=True)
+    job = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class GetAssignmentJob(messages.Message):
+    """
+    Message requesting the status of a background bulk assignment
+        job: (String) URL safe key of the job
+    """
+    job = messages.StringField(1, required=True)
+
+
+class GetAssignmentJobResponse(messages.Message):
+    """
+    Response to background bulk assignment status request.
+        ok: (Boolean)
+        status: (String) pending, running or done
+        total: (Integer) Number of pairs in the job
+        results: Result of the pairs applied so far
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    status = messages.StringField(2)
+    total = messages.IntegerField(3)
+    results = messages.MessageField(CasillaAssignmentResult, 4, repeated=True)
+    error = messages.StringField(5)
+
+
+class AutoAssignCasillas(messages.Message):
+    """
+    Message requesting an automatic assignment of casillas to the nearest observadores
+        distritos: national_id keys of the distritos to plan
+        observadores: emails of the observadores available, all the observadores if empty
+        capacity: (Integer) Casillas per observador
+        keep_existing: (Boolean) Keep the casillas already assigned to an available observador
+        dry_run: (Boolean) Only compute the plan, nothing is written
+        background: (Boolean) Apply the plan as a background job, needed for large plans
+    """
+    distritos = messages.StringField(1, repeated=True)
+    observadores = messages.StringField(2, repeated=True)
+    capacity = messages.IntegerField(3, default=1)
+    keep_existing = messages.BooleanField(4, default=True)
+    dry_run = messages.BooleanField(5)
+    background = messages.BooleanField(6)
+
+
+class AutoAssignCasillasResponse(messages.Message):
+    """
+    Response to automatic assignment request.
+        ok: (Boolean)
+        results: Planned assignments, with the result of applying them (only if not background)
+        total_distance: (Float) Sum of the meters between every observador and its planned casillas
+        unassigned: national_id keys of the casillas left without observador
+        job: (String) URL safe key of the background job (only if background)
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    results = messages.MessageField(CasillaAssignmentResult, 2, repeated=True)
+    total_distance = messages.FloatField(3)
+    unassigned = messages.StringField(4, repeated=True)
+    job = messages.StringField(5)
+    error = messages.StringField(6)
+
+
+class ImportCasillas(messages.Message):
+    """
+    Message requesting a bulk import of casillas
+        source: (String) Cloud Storage file (/bucket/object)
+        file_format: (String) csv or ndjson
+    """
+    source = messages.StringField(1, required=True)
+    file_format = messages.StringField(2, required=True)
+
+
+class ImportCasillasResponse(messages.Message):
+    """
+    Response to bulk import request
+        ok: (Boolean) Import started or failed
+        job: (String) URL safe key of the import job
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    job = messages.StringField(2)
+    error = messages.StringField(3)
+
+
+class CasillaImportRowError(messages.Message):
+    """
+    A row rejected by a bulk import
+    """
+    row = messages.IntegerField(1)
+    error = messages.StringField(2)
+
+
+class GetCasillaImportStatus(messages.Message):
+    """
+    Message requesting the status of a bulk import
+        job: (String) URL safe key of the import job
+        resume: (Boolean) Continue the job from its last checkpoint
+    """
+    job = messages.StringField(1, required=True)
+    resume = messages.BooleanField(2)
+
+
+class GetCasillaImportStatusResponse(messages.Message):
+    """
+    Response to bulk import status request
+        ok: (Boolean)
+        status: (String) pending, running, done or failed
+        rows_ok: (Integer) Rows imported so far
+        rows_failed: (Integer) Rows rejected so far
+        rows_per_second: (Float) Throughput of the import
+        errors: Rejected rows
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    status = messages.StringField(2)
+    rows_ok = messages.IntegerField(3)
+    rows_failed = messages.IntegerField(4)
+    rows_per_second = messages.FloatField(5)
+    errors = messages.MessageField(CasillaImportRowError, 6, repeated=True)
+    error = messages.StringField(7)
+
+
+class GetCasillaTimeline(messages.Message):
+    """
+    Message requesting a page of the timeline of a casilla (observaciones, notas and medias), latest first
+        casilla: (String) national_id of the casilla
+        cursor: (String) cursor of the page, from the previous response, the first page if empty
+        page_size: (Integer) Items in the page, 20 by default, at most 100
+    """
+    casilla = messages.StringField(1, required=True)
+    cursor = messages.StringField(2)
+    page_size = messages.IntegerField(3)
+
+
+class TimelineItem(messages.Message):
+    """
+    An item of the timeline of a casilla
+        kind: (String) observacion, nota or media
+        url_safe_key: (String)
+        date: (String) UTC ISO 8601
+        observacion: (String) url safe key of the observacion of a nota or media
+        observador: (String) email of the observador of an observacion
+        clasificacion: (String) url safe key of the clasificacion of an observacion
+        name: (String) name of the file of a nota or media
+        m_type: (String) type of a media [video, photo, audio]
+    """
+    kind = messages.StringField(1)
+    url_safe_key = messages.StringField(2)
+    date = messages.StringField(3)
+    observacion = messages.StringField(4)
+    observador = messages.StringField(5)
+    clasificacion = messages.StringField(6)
+    name = messages.StringField(7)
+    m_type = messages.StringField(8)
+
+
+class GetCasillaTimelineResponse(messages.Message):
+    """
+    Response to casilla timeline request.
+        ok: (Boolean)
+        items: Items in the page
+        cursor: (String) cursor of the next page
+        more: (Boolean) There are more pages
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    items = messages.MessageField(TimelineItem, 2, repeated=True)
+    cursor = messages.StringField(3)
+    more = messages.BooleanField(4)
+    error = messages.StringField(5)
+
+
+class GetStaleCasillas(messages.Message):
+    """
+    Message requesting a page of the casillas without observaciones in the last minutes, least recently observed first
+        minutes: (Integer) Minutes without observaciones
+        distrito: (String) Optional national_id of the distrito
+        cursor: (String) cursor of the page, from the previous response, the first page if empty
+        page_size: (Integer) Casillas in the page, 100 by default, at most 500
+    """
+    minutes = messages.IntegerField(1, required=True)
+    distrito = messages.StringField(2)
+    cursor = messages.StringField(3)
+    page_size = messages.IntegerField(4)
+
+
+class StaleCasilla(messages.Message):
+    """
+    A casilla without recent observaciones
+        national_id: (String)
+        distrito: (String) national_id of the distrito
+        last_observed: (String) UTC ISO 8601 date of the latest observacion, empty if never observed
+    """
+    national_id = messages.StringField(1)
+    distrito = messages.StringField(2)
+    last_observed = messages.StringField(3)
+
+
+class GetStaleCasillasResponse(messages.Message):
+    """
+    Response to stale casillas request.
+        ok: (Boolean)
+        casillas: Casillas in the page
+        cursor: (String) cursor of the next page
+        more: (Boolean) There are more pages
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    casillas = messages.MessageField(StaleCasilla, 2, repeated=True)
+    cursor = messages.StringField(3)
+    more = messages.BooleanField(4)
+    error = messages.StringField(5)
+
+
 """
 DISTRITO
 """
@@ -204,11 +567,15 @@ class CreateObservacion(messages.Message):
         observador: email
         media: file name
         nota: file name
+        background: (Boolean) Reply as soon as the observacion is queued, it is written by the ingestion worker
+        submission_id: (String) Client generated unique id, retries with the same id do not create duplicates
     """
     casilla = messages.StringField(1, required=True)
     observador = messages.StringField(2, required=True)
     clasificacion = messages.StringField(3, required=True)
     filled_checklist = messages.StringField(4, required=True)
+    background = messages.BooleanField(5)
+    submission_id = messages.StringField(6)
 
 
 class CreateObservacionResponse(messages.Message):
@@ -223,6 +590,74 @@ class CreateObservacionResponse(messages.Message):
     error = messages.StringField(3)
 
 
+class GetIngestStatus(messages.Message):
+    """
+    Message requesting the status of an observacion created in background mode
+        url_safe_key: (String) url safe key returned by the creation request
+    """
+    url_safe_key = messages.StringField(1, required=True)
+
+
+class GetIngestStatusResponse(messages.Message):
+    """
+    Response to ingestion status request
+        ok: (Boolean)
+        status: (String) pending, written or failed
+        reason: (String) If the observacion failed, why
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    status = messages.StringField(2)
+    reason = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class ListObservaciones(messages.Message):
+    """
+    Message requesting a page of the observaciones of a casilla, latest first
+        casilla: (String) national_id of the casilla
+        cursor: (String) cursor of the page, from the previous response, the first page if empty
+        page_size: (Integer) Observaciones in the page, 20 by default, at most 100
+        projection: (Boolean) Leave out the filled checklists
+    """
+    casilla = messages.StringField(1, required=True)
+    cursor = messages.StringField(2)
+    page_size = messages.IntegerField(3)
+    projection = messages.BooleanField(4)
+
+
+class Observacion(messages.Message):
+    """
+    Observacion entity for listing response
+        url_safe_key: (String)
+        date: (String) UTC ISO 8601
+        observador: (String) email of the observador
+        clasificacion: (String) url safe key of the clasificacion
+        filled_checklist: (String) JSON of the filled checklist, empty in projection mode
+    """
+    url_safe_key = messages.StringField(1)
+    date = messages.StringField(2)
+    observador = messages.StringField(3)
+    clasificacion = messages.StringField(4)
+    filled_checklist = messages.StringField(5)
+
+
+class ListObservacionesResponse(messages.Message):
+    """
+    Response to observaciones listing request.
+        ok: (Boolean)
+        observaciones: Observaciones in the page
+        cursor: (String) cursor of the next page
+        more: (Boolean) There are more pages
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    observaciones = messages.MessageField(Observacion, 2, repeated=True)
+    cursor = messages.StringField(3)
+    more = messages.BooleanField(4)
+    error = messages.StringField(5)
+
+
 class GetNumberOfObservaciones(messages.Message):
     """
     Message the casillas assigned to a given observador
@@ -242,6 +677,254 @@ class GetNumberOfObservacionesResponse(messages.Message):
     number_of_observaciones = messages.IntegerField(2)
     error = messages.StringField(3)
 
+
+class ReconcileNumberOfObservaciones(messages.Message):
+    """
+    Message requesting the observaciones counter to be recomputed from the datastore
+    """
+
+
+class ReconcileNumberOfObservacionesResponse(messages.Message):
+    """
+    Response to counter reconciliation request.
+        ok: (Boolean) Reconciliation job started or failed
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+
+
+class GetObservacionRollups(messages.Message):
+    """
+    Message requesting the observaciones rollups
+        distrito: (String) national_id of the distrito, all the distritos if empty
+        clasificacion: (String) url safe key of the clasificacion, all the clasificaciones if empty
+        start: (String) first bucket, UTC YYYY-MM-DDTHH:MM, required to get the buckets
+        end: (String) end of the range (excluded), UTC YYYY-MM-DDTHH:MM, at most 24 hours after start (the default)
+        casillas: national_ids of the casillas to get the totals of
+    """
+    distrito = messages.StringField(1)
+    clasificacion = messages.StringField(2)
+    start = messages.StringField(3)
+    end = messages.StringField(4)
+    casillas = messages.StringField(5, repeated=True)
+
+
+class RollupBucket(messages.Message):
+    """
+    Observaciones of a distrito and clasificacion in a 15 minutes bucket
+        distrito: national_id of the distrito
+        clasificacion: url safe key of the clasificacion
+        bucket: (String) start of the bucket, UTC YYYY-MM-DDTHH:MM
+        count: (Integer)
+    """
+    distrito = messages.StringField(1)
+    clasificacion = messages.StringField(2)
+    bucket = messages.StringField(3)
+    count = messages.IntegerField(4)
+
+
+class CasillaRollup(messages.Message):
+    """
+    Observaciones of a casilla
+        casilla: national_id of the casilla
+        count: (Integer)
+        last_observed: (String) date of the latest observacion, UTC ISO 8601
+    """
+    casilla = messages.StringField(1)
+    count = messages.IntegerField(2)
+    last_observed = messages.StringField(3)
+
+
+class GetObservacionRollupsResponse(messages.Message):
+    """
+    Response to observaciones rollups request.
+        ok: (Boolean)
+        buckets: Buckets matching the request, oldest first
+        total: (Integer) Observaciones in the buckets
+        casillas: Totals of the requested casillas
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    buckets = messages.MessageField(RollupBucket, 2, repeated=True)
+    total = messages.IntegerField(3)
+    casillas = messages.MessageField(CasillaRollup, 4, repeated=True)
+    error = messages.StringField(5)
+
+
+class GetChecklistTallies(messages.Message):
+    """
+    Message requesting the answer tallies of the checklist of a clasificacion
+        clasificacion: (String) url safe key of the clasificacion
+        distrito: (String) national_id of the distrito, all the distritos if empty
+    """
+    clasificacion = messages.StringField(1, required=True)
+    distrito = messages.StringField(2)
+
+
+class AnswerCount(messages.Message):
+    """
+    Observaciones giving an answer to a question
+        answer: (String) JSON of the answer, * for the free text and uncommon answers
+        count: (Integer)
+    """
+    answer = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class QuestionTally(messages.Message):
+    """
+    Answers to a question of the checklist
+        question: (String)
+        answered: (Integer) Observaciones answering the question
+        answers: Observaciones per answer, most given first
+    """
+    question = messages.StringField(1)
+    answered = messages.IntegerField(2)
+    answers = messages.MessageField(AnswerCount, 3, repeated=True)
+
+
+class ChecklistTally(messages.Message):
+    """
+    Answers to the checklist in a distrito
+        distrito: national_id of the distrito, empty for the totals
+        count: (Integer) Observaciones tallied
+        questions: Tally of each question
+    """
+    distrito = messages.StringField(1)
+    count = messages.IntegerField(2)
+    questions = messages.MessageField(QuestionTally, 3, repeated=True)
+
+
+class GetChecklistTalliesResponse(messages.Message):
+    """
+    Response to answer tallies request.
+        ok: (Boolean)
+        distritos: Tallies per distrito
+        total: Tallies of all the requested distritos
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    distritos = messages.MessageField(ChecklistTally, 2, repeated=True)
+    total = messages.MessageField(ChecklistTally, 3)
+    error = messages.StringField(4)
+
+
+class ExportObservaciones(messages.Message):
+    """
+    Message requesting a page of the observaciones export
+        file_format: (String) csv or ndjson
+        cursor: (String) cursor of the page, from the previous response, the first page if empty
+        page_size: (Integer) Observaciones in the page, 500 by default, at most 1000
+        distrito: (String) national_id of the distrito, all the distritos if empty
+        clasificacion: (String) url safe key of the clasificacion, all the clasificaciones if empty
+    """
+    file_format = messages.StringField(1, required=True)
+    cursor = messages.StringField(2)
+    page_size = messages.IntegerField(3)
+    distrito = messages.StringField(4)
+    clasificacion = messages.StringField(5)
+
+
+class ExportObservacionesResponse(messages.Message):
+    """
+    Response to export page request.
+        ok: (Boolean)
+        data: (String) Rows of the page, CSV (header in the first page) or NDJSON
+        rows: (Integer) Rows in data
+        cursor: (String) cursor of the next page
+        more: (Boolean) There are more pages
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    data = messages.StringField(2)
+    rows = messages.IntegerField(3)
+    cursor = messages.StringField(4)
+    more = messages.BooleanField(5)
+    error = messages.StringField(6)
+
+
+class StartObservacionesExport(messages.Message):
+    """
+    Message requesting an export of observaciones to Cloud Storage
+        destination: (String) Cloud Storage file (/bucket/object)
+        file_format: (String) csv or ndjson
+        distrito: (String) national_id of the distrito, all the distritos if empty
+        clasificacion: (String) url safe key of the clasificacion, all the clasificaciones if empty
+    """
+    destination = messages.StringField(1, required=True)
+    file_format = messages.StringField(2, required=True)
+    distrito = messages.StringField(3)
+    clasificacion = messages.StringField(4)
+
+
+class StartObservacionesExportResponse(messages.Message):
+    """
+    Response to export request
+        ok: (Boolean) Export started or failed
+        job: (String) URL safe key of the export job
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    job = messages.StringField(2)
+    error = messages.StringField(3)
+
+
+class GetObservacionesExportStatus(messages.Message):
+    """
+    Message requesting the status of an export
+        job: (String) URL safe key of the export job
+        resume: (Boolean) Continue the job from its last checkpoint
+    """
+    job = messages.StringField(1, required=True)
+    resume = messages.BooleanField(2)
+
+
+class GetObservacionesExportStatusResponse(messages.Message):
+    """
+    Response to export status request
+        ok: (Boolean)
+        status: (String) pending, running, done or failed
+        rows: (Integer) Rows written so far
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    status = messages.StringField(2)
+    rows = messages.IntegerField(3)
+    error = messages.StringField(4)
+
+
+class BackfillObservacionRollups(messages.Message):
+    """
+    Message requesting the observaciones written before the rollups existed to be added to them
+    """
+
+
+class BackfillObservacionRollupsResponse(messages.Message):
+    """
+    Response to rollups backfill request.
+        ok: (Boolean) Backfill job started or failed
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+
+
+class CompactObservacionChecklists(messages.Message):
+    """
+    Message requesting the filled checklists stored before the compact encoding to be encoded
+    """
+
+
+class CompactObservacionChecklistsResponse(messages.Message):
+    """
+    Response to checklists compaction request.
+        ok: (Boolean) Compaction job started or failed
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+
 """
 MEDIA
 """
@@ -252,11 +935,13 @@ class CreateMedia(messages.Message):
         name: unique name of the media in the bucket. App created
         observacion: url safe key of the observacion
         m_type: type of media [video, photo, audio]
+        submission_id: (String) Client generated unique id, retries with the same id do not create duplicates
 
     """
     name = messages.StringField(1, required=True)
     observacion = messages.StringField(2, required=True)
     m_type = messages.StringField(3, required=True)
+    submission_id = messages.StringField(4)
 
 
 
@@ -278,10 +963,12 @@ class CreateNota(messages.Message):
     Message containing the information of a new Nota
         name: unique name of the media in the bucket. App created
         observacion: url safe key of the observacion
+        submission_id: (String) Client generated unique id, retries with the same id do not create duplicates
 
     """
     name = messages.StringField(1, required=True)
     observacion = messages.StringField(2, required=True)
+    submission_id = messages.StringField(3)
 
 
 
@@ -303,10 +990,12 @@ class CreateLocation(messages.Message):
     Message containing the information of a Location
         loc: coordinates
         observador: email
+        submission_id: (String) Client generated unique id, retries with the same id do not create duplicates
 
     """
     loc = messages.StringField(1, required=True)
     observador = messages.StringField(2, required=True)
+    submission_id = messages.StringField(3)
 
 
 
@@ -394,10 +1083,36 @@ class GetAllClasificacionesResponse(messages.Message):
 class Clasificacion(messages.Message):
     """
     Clasificacion entity for details response
+        url_safe_key is only filled in the catalogue
     """
     name = messages.StringField(1)
     checklist = messages.StringField(2)
     repeatable = messages.BooleanField(3)
+    url_safe_key = messages.StringField(4)
+
+
+class GetClasificacionCatalogue(messages.Message):
+    """
+    Message requesting the catalogue of clasificaciones
+        version: (String) version (ETag) of the catalogue the client already has, if any
+    """
+    version = messages.StringField(1)
+
+
+class GetClasificacionCatalogueResponse(messages.Message):
+    """
+    Response to catalogue request.
+        ok: (Boolean)
+        not_modified: (Boolean) The client version is current, clasificaciones is empty
+        version: (String) version (ETag) of the catalogue
+        clasificaciones: Every clasificacion with its details
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    not_modified = messages.BooleanField(2)
+    version = messages.StringField(3)
+    clasificaciones = messages.MessageField(Clasificacion, 4, repeated=True)
+    error = messages.StringField(5)
 
 
 class GetClasificacionDetails(messages.Message):
@@ -419,3 +1134,52 @@ class GetClasificacionDetailsResponse(messages.Message):
     ok = messages.BooleanField(1)
     clasificacion = messages.MessageField(Clasificacion, 2)
     error = messages.StringField(3)
+
+"""
+SYNC
+"""
+
+class SyncItem(messages.Message):
+    """
+    A queued submission, only the field of its kind is set
+        ref: (String) client reference of the item, notas and medias later in the batch can use it as observacion
+        observacion, nota, media, location: the create request
+    """
+    ref = messages.StringField(1)
+    observacion = messages.MessageField(CreateObservacion, 2)
+    nota = messages.MessageField(CreateNota, 3)
+    media = messages.MessageField(CreateMedia, 4)
+    location = messages.MessageField(CreateLocation, 5)
+
+
+class SyncItemResult(messages.Message):
+    """
+    Result of a queued submission
+        ref: (String) client reference of the item
+        ok: (Boolean) Creation successful or failed
+        url_safe_key: (String) If creation successful the url safe key of the new entity
+        error: (String) If creation failed, contains the reason, otherwise empty.
+    """
+    ref = messages.StringField(1)
+    ok = messages.BooleanField(2)
+    url_safe_key = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class SyncUpload(messages.Message):
+    """
+    Message containing the submissions queued while offline, in the order they were made
+    """
+    items = messages.MessageField(SyncItem, 1, repeated=True)
+
+
+class SyncUploadResponse(messages.Message):
+    """
+    Response to sync upload request.
+        ok: (Boolean) Batch processed or failed
+        results: Result of every item, in the order of the request
+        error: (String) If request failed, contains the reason, otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    results = messages.MessageField(SyncItemResult, 2, repeated=True)
+    error = messages.StringField(3)
@@ -0,0 +1,195 @@
+"""
+Defines the migration job that re-keys legacy entities (auto generated integer ids) to their natural keys in the
+Observador-Electoral platform, and rewrites the KeyProperty references pointing to them.
+
+    - Observador:   keyed by email
+    - Distrito:     keyed by national_id
+    - Casilla:      keyed by national_id
+    - Media:        keyed by name
+    - Nota:         keyed by name
+
+The job runs in batches chained through the deferred library, start it (e.g. from the remote api shell) with:
+
+    from google.appengine.ext import deferred
+    import migration
+    deferred.defer(migration.run)
+"""
+__author__ = 'Cesar'
+
+
+import logging
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.api import search
+
+from observador import Observador
+from distrito import Distrito
+from casilla import Casilla
+from observacion import Observacion
+from location import Location
+from media import Media
+from nota import Nota
+
+
+BATCH_SIZE = 100
+SEARCH_BATCH_SIZE = 200
+
+# (model, property holding the natural key)
+REKEY = [(Observador, 'email'),
+         (Distrito, 'national_id'),
+         (Casilla, 'national_id'),
+         (Media, 'name'),
+         (Nota, 'name')]
+
+# (model, KeyProperties that may point to a legacy key)
+REFERENCES = [(Casilla, ['observador', 'distrito']),
+              (Observacion, ['casilla', 'observador']),
+              (Location, ['observador'])]
+
+STEPS = [('rekey', model, field) for model, field in REKEY] + \
+        [('references', model, props) for model, props in REFERENCES] + \
+        [('delete', model, field) for model, field in REKEY] + \
+        [('search', Casilla, None)]
+
+
+def run(step=0, cursor=None):
+    """
+    Runs one batch of the given migration step and chains the next batch (or step) as a deferred task.
+
+    Args:
+        - step:     Index of the step in STEPS
+        - cursor:   URL safe cursor (or last document id for the search step) to resume from
+    """
+    if step >= len(STEPS):
+        logging.info('[Migration] - Natural keys migration finished')
+        return
+
+    action, model, arg = STEPS[step]
+    logging.info('[Migration] - Step {0}: {1} {2}, cursor = {3}'.format(step, action, model._get_kind(), cursor))
+    if action == 'search':
+        next_cursor, more = _delete_legacy_documents(cursor)
+    else:
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        entities, next_cursor, more = model.query().fetch_page(BATCH_SIZE, start_cursor=start)
+        if action == 'rekey':
+            _rekey(model, arg, entities)
+        elif action == 'references':
+            _rewrite_references(arg, entities)
+        else:
+            _delete_legacy(model, arg, entities)
+        next_cursor = next_cursor.urlsafe() if next_cursor else None
+
+    if more and next_cursor:
+        deferred.defer(run, step, next_cursor)
+    else:
+        deferred.defer(run, step + 1)
+
+
+def _is_legacy(key):
+    return key is not None and key.integer_id() is not None
+
+
+def _rekey(model, field, entities):
+    """
+    Copies the legacy entities of the batch to new entities keyed by their natural key. The legacy entities are kept
+    until the references are rewritten.
+    """
+    legacy = {}
+    for e in entities:
+        if not _is_legacy(e.key):
+            continue
+        natural_id = getattr(e, field)
+        if not natural_id:
+            logging.warning('[Migration] - {0} has no {1}, not migrated'.format(e.key, field))
+            continue
+        # First one wins if the old exists()/put() race left duplicates
+        legacy.setdefault(natural_id, e)
+
+    new_keys = [ndb.Key(model, natural_id) for natural_id in legacy]
+    existing = ndb.get_multi(new_keys)
+    copies = []
+    for key, current in zip(new_keys, existing):
+        if current:
+            continue
+        copies.append(model(id=key.id(), **legacy[key.id()].to_dict()))
+    ndb.put_multi(copies)
+
+    if model is Casilla and copies:
+        search.Index(name="CasillasIndex").put([Casilla.search_document(c.key, c.loc) for c in copies if c.loc])
+    logging.info('[Migration] - {0}: {1} entities re-keyed'.format(model._get_kind(), len(copies)))
+
+
+def _delete_legacy(model, field, entities):
+    """
+    Deletes the legacy entities of the batch whose natural key copy exists. The ones without a copy (no or invalid
+    natural id) are kept and logged.
+    """
+    legacy = []
+    for e in entities:
+        if not _is_legacy(e.key):
+            continue
+        natural_id = getattr(e, field)
+        if not natural_id:
+            logging.warning('[Migration] - {0} has no {1}, kept'.format(e.key, field))
+            continue
+        try:
+            legacy.append((e.key, ndb.Key(model, natural_id)))
+        except Exception:
+            logging.warning('[Migration] - {0} has an invalid {1} ({2!r}), kept'.format(e.key, field, natural_id))
+
+    copies = ndb.get_multi([natural for key, natural in legacy])
+    deleted = []
+    for (key, natural), copy in zip(legacy, copies):
+        if copy:
+            deleted.append(key)
+        else:
+            logging.warning('[Migration] - {0} has no copy {1}, kept'.format(key, natural))
+    ndb.delete_multi(deleted)
+    logging.info('[Migration] - {0}: {1} legacy entities deleted'.format(model._get_kind(), len(deleted)))
+
+
+def _rewrite_references(props, entities):
+    """
+    Points the KeyProperties of the batch to the natural keys of the entities they reference.
+    """
+    legacy_keys = set()
+    for e in entities:
+        for prop in props:
+            ref = getattr(e, prop)
+            if _is_legacy(ref):
+                legacy_keys.add(ref)
+    legacy_keys = list(legacy_keys)
+
+    natural = {}
+    fields = dict((model._get_kind(), field) for model, field in REKEY)
+    for key, ref in zip(legacy_keys, ndb.get_multi(legacy_keys)):
+        if ref:
+            natural[key] = ndb.Key(key.kind(), getattr(ref, fields[key.kind()]))
+        else:
+            logging.warning('[Migration] - Dangling reference {0}'.format(key))
+
+    changed = []
+    for e in entities:
+        dirty = False
+        for prop in props:
+            ref = getattr(e, prop)
+            if ref in natural:
+                setattr(e, prop, natural[ref])
+                dirty = True
+        if dirty:
+            changed.append(e)
+    ndb.put_multi(changed)
+    logging.info('[Migration] - {0} references rewritten'.format(len(changed)))
+
+
+def _delete_legacy_documents(start_id):
+    """
+    Removes the CasillasIndex documents that still reference a casilla by its legacy key.
+    """
+    index = search.Index(name="CasillasIndex")
+    docs = index.get_range(start_id=start_id, include_start_object=False, limit=SEARCH_BATCH_SIZE)
+    legacy = [d.doc_id for d in docs if d.field('key').value.startswith('Key(')]
+    if legacy:
+        index.delete(legacy)
+    last_id = docs.results[-1].doc_id if docs.results else None
+    return last_id, len(docs.results) == SEARCH_BATCH_SIZE
@@ -7,21 +7,26 @@ __author__ = 'Cesar'
 import logging
 from google.appengine.ext import ndb
 from observacion import Observacion
+from casilla import Casilla
+from cache import submission_cache
 
 
 class Nota(ndb.Model):
     """
-    Represents a nota within the platform.
+    Represents a nota within the platform. Keyed by name.
 
         - name: unique id for nota file in bucket
+        - casilla: Casilla of the observacion (denormalized for the casilla timeline)
     """
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     observacion = ndb.KeyProperty(kind=Observacion)
+    casilla = ndb.KeyProperty(kind=Casilla)
     name = ndb.StringProperty()
 
     @classmethod
-    def exists(cls, name):
+    @ndb.tasklet
+    def exists_async(cls, name):
         """
         Checks the datastore to find if the nota (name) is already on it.
 
@@ -29,53 +34,81 @@ class Nota(ndb.Model):
             name: (String) type name request
 
         Returns:
-            True if name exist False otherwise
+            Future, True if name exist False otherwise
         """
-        return cls.query(cls.name == name).count(1) == 1
+        n = yield cls.get_by_id_async(name)
+        raise ndb.Return(n is not None)
+
+    @classmethod
+    def exists(cls, name):
+        return cls.exists_async(name).get_result()
 
     @classmethod
-    def create(cls, observacion, name):
+    @ndb.tasklet
+    def create_async(cls, observacion, name, submission_id=None):
         """
-        Creates a new nota in the datastore.
+        Creates a new nota in the datastore. A replay (same name and observacion) returns the existing nota.
         Args:
-            - name: String holding the unique name of the nota (app created)
+            - name: String holding the unique name of the nota (app created), used as key
             - observacion: url safe key for the related observacion
+            - submission_id: Optional client generated id of the request, replays are answered from the dedup cache
 
         Returns:
-            Key of new entity
+            Future, key of new entity
         """
-        try:
-            if Nota.exists(name):
+        @ndb.transactional_tasklet
+        def txn():
+            current = yield Nota.get_by_id_async(name)
+            if current:
+                if current.observacion == o_key:
+                    raise ndb.Return(current.key)
                 raise NotaCreationError('Nota already exists in platform')
-            else:
-                o_key = ndb.Key(urlsafe=observacion)
-                m = Nota(observacion=o_key, name=name)
-                key = m.put()
-
+            n = Nota(id=name, observacion=o_key, casilla=o.casilla if o else None, name=name)
+            key = yield n.put_async()
+            raise ndb.Return(key)
+
+        if submission_id:
+            # Replays are answered from the dedup cache
+            cached = yield submission_cache.peek_async('Nota:' + submission_id)
+            if cached:
+                raise ndb.Return(ndb.Key(urlsafe=cached))
+        try:
+            o_key = ndb.Key(urlsafe=observacion)
+            o = yield o_key.get_async()
+            key = yield txn()
+            if submission_id:
+                yield submission_cache.set_async('Nota:' + submission_id, key.urlsafe())
         except Exception:
             logging.exception("[nota] - Error in create Nota", exc_info=True)
             raise NotaCreationError('Error creating the Nota in platform')
         else:
-            return key
+            raise ndb.Return(key)
 
     @classmethod
-    def get_from_datastore(cls, name):
+    def create(cls, observacion, name, submission_id=None):
+        return cls.create_async(observacion, name, submission_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_from_datastore_async(cls, name):
         """
         Gets a nota from datastore based on its name
         """
         try:
-            if Nota.exists(name):
-                query = Nota.query(Nota.name == name).fetch(limit=1)
-                n = query
-            else:
+            n = yield Nota.get_by_id_async(name)
+            if not n:
                 raise GetNotaError('Nota does not exist')
         except Exception as e:
                 raise GetNotaError('Error getting Nota: '+e.__str__())
         else:
-            logging.debug("[Nota] - Key = {0}".format(n[0].key))
-            logging.debug("[Nota] - Observacion = {0}".format(n[0].observacion))
-            logging.debug("[Nota] - name = {0}".format(n[0].name))
-            return n[0]
+            logging.debug("[Nota] - Key = {0}".format(n.key))
+            logging.debug("[Nota] - Observacion = {0}".format(n.observacion))
+            logging.debug("[Nota] - name = {0}".format(n.name))
+            raise ndb.Return(n)
+
+    @classmethod
+    def get_from_datastore(cls, name):
+        return cls.get_from_datastore_async(name).get_result()
 
 
 
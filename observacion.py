@@ -3,11 +3,42 @@ Defines the datastore and all interfaces needed for a Observacion in the platfor
 """
 __author__ = 'Cesar'
 
+import json
+import random
 import logging
+import datetime
 from google.appengine.ext import ndb
-from casilla import Casilla
+from google.appengine.ext import deferred
+
+import counter
+import rollup
+from cache import submission_cache
+from casilla import Casilla, CasillaActivity
+from distrito import Distrito
 from observador import Observador
-from clasificacion import Clasificacion
+from clasificacion import Clasificacion, ChecklistVersion, GetClasificacionError
+import checklist as checklists
+from checklist import FilledChecklistError
+
+
+# Sharded counter holding the total of observaciones
+OBSERVACIONES_COUNTER = 'observaciones'
+# Observaciones read per page / pages per task by the counter reconciliation
+RECONCILE_PAGE_SIZE = 500
+RECONCILE_PAGES_PER_TASK = 10
+# Observaciones are added to the rollups of the distrito of their casilla
+NO_DISTRITO = 'Casilla has no distrito'
+# The id of the submission was already used by another one (other observador, casilla or clasificacion)
+ALREADY_EXISTS = 'Observacion already exists in platform'
+# Prefix of the save_batch errors of a failed write transaction (contention, timeout): the only ones a retry can fix
+WRITE_ERROR = 'Error writing the observacion'
+# Observaciones written per cross-group transaction: each one adds its own group, its bucket and casilla rollups
+WRITE_CHUNK_SIZE = 4
+# Observaciones per task of the rollups backfill
+BACKFILL_BATCH_SIZE = 100
+# Observaciones per page of a casilla listing
+LIST_PAGE_SIZE = 20
+MAX_LIST_PAGE_SIZE = 100
 
 
 class Observacion(ndb.Model):
@@ -16,56 +47,242 @@ class Observacion(ndb.Model):
 
         - observador: Author of this Observacion
         - casilla: The casilla the Observacion is about
+        - distrito: Distrito of the casilla (denormalized for the rollups)
         - clasificacion: The clasificacion related to this Observacion
-        - filled_checklist: The Observador filled checklist for this Observacion (the checklist template should
-          come from the associated Clasificacion)
+        - filled_checklist: The Observador filled checklist for this Observacion, as submitted (legacy, see
+          checklist_data)
+        - checklist_data: The filled checklist encoded against the checklist of the Clasificacion (see checklist.py),
+          read it with get_filled_checklists()
+        - counted: Generation of the observaciones counter that counted it (see counter.py), None if written before
+          the generations
     """
 
     date = ndb.DateTimeProperty(auto_now_add=True)
     casilla = ndb.KeyProperty(kind=Casilla)
+    distrito = ndb.KeyProperty(kind=Distrito)
     observador = ndb.KeyProperty(kind=Observador)
     clasificacion = ndb.KeyProperty(kind=Clasificacion)
     filled_checklist = ndb.JsonProperty()
+    checklist_data = ndb.TextProperty(compressed=True)
+    counted = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def save_to_datastore(cls, observador, casilla, clasificacion, filled_checklist):
+    @ndb.tasklet
+    def save_to_datastore_async(cls, observador, casilla, clasificacion, filled_checklist, submission_id=None):
         """
-        Saves a Observacion as a new entity on the datastore.
+        Saves a Observacion as a new entity on the datastore. The Casilla and Observador lookups and the compiled
+        checklist run concurrently, the observacion, the observaciones counter and the rollups are written in the same
+        transaction. The activity of the casilla is recorded afterwards (coalesced, see CasillaActivity).
             :param observador: (String) email
             :param casilla: (String) national id
             :param clasificacion: URL safe key of the Observador selected clasificacion
             :param filled_checklist: JSON of checklist filled by the Observador
+            :param submission_id: Optional client generated id, used as key so retries do not create duplicates. An
+                                  observacion already written with it by another observador, or for another casilla
+                                  or clasificacion, is a conflict
 
 
-            :return key: If creation successful URL safe key of the new observacion, exception otherwise
+            :return key: Future, if creation successful URL safe key of the new observacion, exception otherwise
         """
+        if submission_id:
+            # Replays are answered from the dedup cache
+            cache_key = cls.submission_cache_key(submission_id, observador, casilla, clasificacion)
+            cached = yield submission_cache.peek_async(cache_key)
+            if cached:
+                raise ndb.Return(cached)
         try:
-            c = Casilla.get_from_datastore(casilla)
-            o = Observador.get_from_datastore(observador)
-            new = Observacion(casilla=c.key,
+            c, o, compiled = yield (Casilla.get_from_datastore_async(casilla),
+                                    Observador.get_from_datastore_async(observador),
+                                    Clasificacion.get_checklist_async(clasificacion))
+            if not c.distrito:
+                raise GetObservacionError(NO_DISTRITO)
+            # Rejected before any write
+            answers = compiled.validate(filled_checklist)
+            new = Observacion(date=datetime.datetime.utcnow(),
+                              casilla=c.key,
+                              distrito=c.distrito,
                               observador=o.key,
                               clasificacion=ndb.Key(urlsafe=clasificacion),
-                              filled_checklist=filled_checklist)
-            key = new.put()
+                              checklist_data=compiled.encode(answers))
+            if submission_id:
+                new.key = ndb.Key(Observacion, submission_id)
+            keys = yield cls._write_async([new], [answers])
+            key = keys[0]
+            if key is None:
+                raise ObservacionCreationError(ALREADY_EXISTS)
+            yield CasillaActivity.record_async([new])
+            if submission_id:
+                yield submission_cache.set_async(cache_key, key.urlsafe())
+        except ObservacionCreationError:
+            raise
         except Exception as e:
             logging.exception("[Observacion] - "+e.message)
             raise ObservacionCreationError('Error creating the observacion in datastore: '+e.__str__())
         else:
             logging.debug('[Observacion] - New Observacion, Key = {0}'.format(key))
-            return key.urlsafe()
+            raise ndb.Return(key.urlsafe())
 
     @classmethod
-    def get_all(cls, casilla):
+    def save_to_datastore(cls, observador, casilla, clasificacion, filled_checklist, submission_id=None):
+        return cls.save_to_datastore_async(observador, casilla, clasificacion, filled_checklist,
+                                           submission_id).get_result()
+
+    @classmethod
+    def submission_cache_key(cls, submission_id, observador, casilla, clasificacion):
+        """
+        Dedup cache key of a submission: only a replay (same observador, casilla and clasificacion) is answered from
+        the cache, any other submission with the same id reaches the datastore and is rejected there
+        """
+        return u'Observacion:{0}:{1}:{2}:{3}'.format(submission_id, observador, casilla, clasificacion)
+
+    @classmethod
+    @ndb.tasklet
+    def save_batch_async(cls, submissions):
+        """
+        Saves a batch of observaciones: one get_multi for the Casillas and one for the Observadores, concurrent with
+        the compiled checklists, then concurrent transactions of WRITE_CHUNK_SIZE observaciones. Observaciones with a
+        pre-allocated key already written are skipped, so a batch can be replayed.
+            :param submissions: list of dicts with observador (email), casilla (national id), clasificacion (URL
+                                safe key), filled_checklist (validated against the checklist of the clasificacion) and
+                                optionally id (pre-allocated id or client submission id) and date (epoch)
+
+            :return: Future, list of (URL safe key, error) in the order of submissions. Only the errors starting with
+                     WRITE_ERROR can succeed on a retry
         """
-        Gets all the observaciones for a given casilla
+        casilla_ids = list(set(s['casilla'] for s in submissions))
+        emails = list(set(s['observador'] for s in submissions))
+        clasificaciones = list(set(s['clasificacion'] for s in submissions))
+        casillas, observadores, compiled = yield (ndb.get_multi_async([ndb.Key(Casilla, n) for n in casilla_ids]),
+                                                  ndb.get_multi_async([ndb.Key(Observador, e) for e in emails]),
+                                                  [cls._get_checklist_async(c) for c in clasificaciones])
+        casillas = dict(zip(casilla_ids, casillas))
+        observadores = dict(zip(emails, observadores))
+        compiled = dict(zip(clasificaciones, compiled))
+
+        results = [None] * len(submissions)
+        pending = []
+        for i, s in enumerate(submissions):
+            c = casillas[s['casilla']]
+            o = observadores[s['observador']]
+            try:
+                if not c:
+                    raise GetObservacionError('Casilla does not exist')
+                if not c.distrito:
+                    raise GetObservacionError(NO_DISTRITO)
+                if not o:
+                    raise GetObservacionError('Observador does not exist')
+                checklist, error = compiled[s['clasificacion']]
+                if error:
+                    raise GetObservacionError(error)
+                answers = checklist.validate(s['filled_checklist'])
+                new = Observacion(date=datetime.datetime.utcfromtimestamp(s['date']) if s.get('date')
+                                  else datetime.datetime.utcnow(),
+                                  casilla=c.key,
+                                  distrito=c.distrito,
+                                  observador=o.key,
+                                  clasificacion=ndb.Key(urlsafe=s['clasificacion']),
+                                  checklist_data=checklist.encode(answers))
+                if s.get('id'):
+                    new.key = ndb.Key(Observacion, s['id'])
+            except (GetObservacionError, FilledChecklistError) as e:
+                results[i] = (None, e.value)
+            except Exception as e:
+                results[i] = (None, e.__str__())
+            else:
+                pending.append((i, new, answers))
+
+        chunks = [pending[i:i + WRITE_CHUNK_SIZE] for i in range(0, len(pending), WRITE_CHUNK_SIZE)]
+        # Consecutive rollup shards, so the concurrent transactions of a casilla (or distrito) do not contend
+        first = random.randint(0, rollup.ROLLUP_SHARDS - 1)
+        written = yield [cls._write_chunk_async([new for i, new, answers in chunk],
+                                                [answers for i, new, answers in chunk],
+                                                (first + n) % rollup.ROLLUP_SHARDS) for n, chunk in enumerate(chunks)]
+        for chunk, (keys, error) in zip(chunks, written):
+            for n, (i, new, answers) in enumerate(chunk):
+                if not keys:
+                    results[i] = (None, error)
+                elif keys[n] is None:
+                    results[i] = (None, ALREADY_EXISTS)
+                else:
+                    results[i] = (keys[n].urlsafe(), None)
+        yield CasillaActivity.record_async([new for chunk, (keys, error) in zip(chunks, written) if keys
+                                            for (i, new, answers), key in zip(chunk, keys) if key])
+        raise ndb.Return(results)
+
+    @classmethod
+    def save_batch(cls, submissions):
+        return cls.save_batch_async(submissions).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def _get_checklist_async(cls, clasificacion):
+        """
+        Clasificacion.get_checklist_async() returning (compiled checklist, None), or (None, error)
+        """
+        try:
+            compiled = yield Clasificacion.get_checklist_async(clasificacion)
+        except GetClasificacionError as e:
+            result = (None, e.value)
+        else:
+            result = (compiled, None)
+        raise ndb.Return(result)
+
+    @classmethod
+    @ndb.tasklet
+    def _write_chunk_async(cls, entities, answers, shard):
+        """
+        _write_async() returning (keys, None), or (None, error) if the transaction failed (error starts with
+        WRITE_ERROR)
+        """
+        try:
+            keys = yield cls._write_async(entities, answers, shard)
+        except Exception as e:
+            logging.exception('[Observacion] - Error writing {0} observaciones'.format(len(entities)))
+            result = (None, '{0}: {1}'.format(WRITE_ERROR, e.__str__()))
+        else:
+            result = (keys, None)
+        raise ndb.Return(result)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _write_async(cls, entities, answers, shard=None):
+        """
+        Writes observaciones together with the observaciones counter and their rollups (answer tallies included). The
+        ones with a complete key already in the datastore are skipped.
+            :param entities: list of Observacion
+            :param answers: their validated filled checklists (dict)
+            :param shard: Shard of the rollups (see rollup.record_async), random if None
+            :return: Future, list of keys, None for the ones already written by another submission (other observador,
+                     casilla or clasificacion)
+        """
+        complete = [o.key for o in entities if o.key]
+        existing = yield ndb.get_multi_async(complete)
+        written = dict((e.key, e) for e in existing if e)
+        new = [(o, a) for o, a in zip(entities, answers) if o.key is None or o.key not in written]
+        if new:
+            # The increment returns the counter generation it went to, recorded for the reconciliation
+            generation, _ = yield (counter.increment_async(OBSERVACIONES_COUNTER, len(new)),
+                                   rollup.record_async([o for o, a in new], [a for o, a in new], shard))
+            for o, a in new:
+                o.counted = generation
+            yield ndb.put_multi_async([o for o, a in new])
+        raise ndb.Return([o.key if o.key not in written or _same_submission(written[o.key], o) else None
+                          for o in entities])
+
+    @classmethod
+    @ndb.tasklet
+    def get_all_async(cls, casilla):
+        """
+        Gets all the observaciones for a given casilla, the Casilla lookup and the query run concurrently.
             :param casilla:
-            :return: list of all observaciones
+            :return: Future, list of all observaciones
 
         """
         try:
             observaciones = []
-            c = Casilla.get_from_datastore(casilla)
-            query_response = Observacion.query(Observacion.casilla == c.key).fetch()
+            c_key = ndb.Key(Casilla, casilla)
+            c, query_response = yield (Casilla.get_from_datastore_async(casilla),
+                                       Observacion.query(Observacion.casilla == c_key).fetch_async())
             if query_response:
                 for r in query_response:
                     observaciones.append(r)
@@ -76,20 +293,103 @@ class Observacion(ndb.Model):
             logging.exception("[Observacion] - "+e.message)
             raise GetObservacionError('Error getting Observaciones: '+e.__str__())
         else:
-            for r in observaciones:
-                logging.debug("[Observacion] = {0}".format(r))
-            return observaciones
+            logging.debug("[Observacion] - {0} Observaciones for Casilla: {1}".format(len(observaciones), casilla))
+            raise ndb.Return(observaciones)
 
     @classmethod
-    def count(cls):
+    def get_all(cls, casilla):
+        return cls.get_all_async(casilla).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_page_async(cls, casilla, cursor=None, page_size=LIST_PAGE_SIZE, projection=False):
+        """
+        Gets a page of the observaciones of a casilla, latest first.
+            :param casilla: (String) national id
+            :param cursor: URL safe cursor of the page, the first page if None
+            :param page_size: Observaciones in the page, at most MAX_LIST_PAGE_SIZE
+            :param projection: Read only date, observador and clasificacion, from the index, skipping the checklist
+            :return: Future, (list of Observacion, list of their filled checklists (None in projection mode), URL safe
+                     cursor of the next page, more (Boolean))
         """
-        Gets the total number of observaciones
-            :return: number
+        try:
+            query = Observacion.query(Observacion.casilla == ndb.Key(Casilla, casilla)).order(-Observacion.date)
+            options = {'start_cursor': ndb.Cursor(urlsafe=cursor) if cursor else None}
+            if projection:
+                options['projection'] = [Observacion.date, Observacion.observador, Observacion.clasificacion]
+            observaciones, next_cursor, more = yield query.fetch_page_async(min(page_size, MAX_LIST_PAGE_SIZE),
+                                                                            **options)
+            if projection:
+                filled = [None] * len(observaciones)
+            else:
+                filled = yield cls.get_filled_checklists_async(observaciones)
+        except Exception as e:
+            logging.exception("[Observacion] - Error getting a page of Observaciones for Casilla: {0}".format(casilla))
+            raise GetObservacionError('Error getting Observaciones: '+e.__str__())
+        raise ndb.Return((observaciones, filled, next_cursor.urlsafe() if next_cursor and more else None, more))
+
+    @classmethod
+    def get_page(cls, casilla, cursor=None, page_size=LIST_PAGE_SIZE, projection=False):
+        return cls.get_page_async(casilla, cursor, page_size, projection).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_filled_checklists_async(cls, observaciones):
+        """
+        Decodes the filled checklists of observaciones, compiling the checklist of each clasificacion once. The ones
+        encoded for a previous version of the checklist are decoded against the questions of that version.
+            :param observaciones: list of Observacion
+            :return: Future, list of filled checklists (dict, None if the observacion has none or it is not valid
+                     JSON) in the order of observaciones
+        """
+        clasificaciones = list(set(o.clasificacion.urlsafe() for o in observaciones
+                                   if o.checklist_data is not None))
+        compiled = yield [cls._get_checklist_async(c) for c in clasificaciones]
+        compiled = dict(zip(clasificaciones, compiled))
+        previous = set()
+        for o in observaciones:
+            checklist, error = compiled.get(o.clasificacion.urlsafe()) if o.checklist_data is not None else (None, None)
+            if checklist is not None:
+                try:
+                    version = checklists.encoded_version(o.checklist_data)
+                except ValueError:
+                    continue
+                if version is not None and version != checklist.version:
+                    previous.add((o.clasificacion, version))
+        versions = {}
+        if previous:
+            questions = yield ChecklistVersion.get_questions_async(list(previous))
+            for (c, version), names in questions.items():
+                versions.setdefault(c, {})[version] = names
+        filled = []
+        for o in observaciones:
+            try:
+                if o.checklist_data is not None:
+                    checklist, error = compiled[o.clasificacion.urlsafe()]
+                    if error:
+                        raise GetObservacionError(error)
+                    filled.append(checklist.decode(o.checklist_data, versions.get(o.clasificacion)))
+                else:
+                    filled.append(_legacy_checklist(o.filled_checklist))
+            except (GetObservacionError, FilledChecklistError, ValueError) as e:
+                logging.warning('[Observacion] - Cannot decode checklist of {0}: {1}'.format(o.key, e))
+                filled.append(None)
+        raise ndb.Return(filled)
+
+    @classmethod
+    def get_filled_checklists(cls, observaciones):
+        return cls.get_filled_checklists_async(observaciones).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def count_async(cls):
+        """
+        Gets the total number of observaciones from the sharded counter
+            :return: Future, number
 
         """
         try:
-            query_response = Observacion.query()
-            number = query_response.count()
+            number = yield counter.get_count_async(OBSERVACIONES_COUNTER)
             if number > 0:
                 pass
             else:
@@ -98,7 +398,140 @@ class Observacion(ndb.Model):
             logging.exception("[Observacion] - "+e.message)
             raise GetObservacionError('Error getting Observaciones: '+e.__str__())
         else:
-            return number
+            raise ndb.Return(number)
+
+    @classmethod
+    def count(cls):
+        return cls.count_async().get_result()
+
+
+def _same_submission(current, new):
+    return (current.observador == new.observador and current.casilla == new.casilla and
+            current.clasificacion == new.clasificacion)
+
+
+def reconcile_count(closing=None, cursor=None, total=0):
+    """
+    Recomputes the observaciones counter, chaining itself every RECONCILE_PAGES_PER_TASK pages. The first task
+    closes the current generation of the counter (counter.close_generation): the observaciones written from then on
+    are counted in the new generation. The scan counts the observaciones of the closed generation and the ones
+    written before the generations, and replaces the closed generation with that count. Observaciones carry the
+    generation that counted them, written in the same transaction, so none is counted twice whatever its date.
+        :param closing: Generation being recounted
+        :param cursor: URL safe cursor to continue the scan from
+        :param total: Observaciones counted so far
+    """
+    if closing is None:
+        closing = counter.close_generation(OBSERVACIONES_COUNTER)
+        if closing is None:
+            return
+    query = Observacion.query()
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    for i in range(RECONCILE_PAGES_PER_TASK):
+        page, start_cursor, more = query.fetch_page(RECONCILE_PAGE_SIZE, start_cursor=start_cursor)
+        total += len([o for o in page if o.counted is None or o.counted <= closing])
+        if not more:
+            counter.set_closed_total(OBSERVACIONES_COUNTER, closing, total)
+            return
+    logging.debug('[Observacion] - Reconciling counter, {0} so far'.format(total))
+    deferred.defer(reconcile_count, closing, start_cursor.urlsafe(), total)
+
+
+def backfill_rollups(cursor=None):
+    """
+    Adds the observaciones written before the rollups existed (the ones without distrito) to the rollups, chaining
+    itself every BACKFILL_BATCH_SIZE observaciones. Each observacion gets its distrito and rollups in one
+    transaction, so the job can be rerun safely. Checklists already compacted are added to the answer tallies too,
+    the others are added by compact_checklists.
+        :param cursor: URL safe cursor to continue the scan from
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    page, start_cursor, more = Observacion.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=start_cursor)
+    legacy = [o for o in page if o.distrito is None and o.casilla is not None]
+    casillas = ndb.get_multi(list(set(o.casilla for o in legacy)))
+    distritos = dict((c.key, c.distrito) for c in casillas if c)
+    answers = Observacion.get_filled_checklists(legacy)
+
+    @ndb.transactional_tasklet(xg=True)
+    def txn(key, distrito, filled):
+        o = yield key.get_async()
+        if o.distrito is None:
+            o.distrito = distrito
+            yield (o.put_async(), rollup.record_async([o], [filled if o.checklist_data is not None else None]))
+
+    futures = [txn(o.key, distritos[o.casilla], filled) for o, filled in zip(legacy, answers)
+               if distritos.get(o.casilla)]
+    if len(futures) < len(legacy):
+        # Added by a later run, once their casillas have a distrito
+        logging.warning('[Observacion] - {0} observaciones without a distrito for their casilla left out of the '
+                        'rollups'.format(len(legacy) - len(futures)))
+    ndb.Future.wait_all(futures)
+    for f in futures:
+        f.check_success()
+    if more:
+        deferred.defer(backfill_rollups, start_cursor.urlsafe())
+    else:
+        logging.info('[Observacion] - Rollups backfill done')
+
+
+def _legacy_checklist(filled_checklist):
+    """
+    Filled checklist stored before checklist_data: the submitted JSON string, stored JSON encoded
+    """
+    if isinstance(filled_checklist, basestring):
+        filled_checklist = json.loads(filled_checklist)
+    return filled_checklist if isinstance(filled_checklist, dict) else None
+
+
+def compact_checklists(cursor=None):
+    """
+    Encodes the filled checklists stored before checklist_data, chaining itself every BACKFILL_BATCH_SIZE
+    observaciones. Each observacion is rewritten in its own transaction, with its answers added to the tallies when
+    they match the checklist and the observacion is already in the rollups (see backfill_rollups), so the job can be
+    rerun safely.
+        :param cursor: URL safe cursor to continue the scan from
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    page, start_cursor, more = Observacion.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=start_cursor)
+    legacy = [o for o in page if o.checklist_data is None and o.filled_checklist is not None]
+    clasificaciones = list(set(o.clasificacion.urlsafe() for o in legacy if o.clasificacion))
+    compiled = dict(zip(clasificaciones, [Observacion._get_checklist_async(c) for c in clasificaciones]))
+    # Observaciones without a (valid) clasificacion only get the generic encoding
+    generic = checklists.compile_template(None)
+
+    @ndb.transactional_tasklet(xg=True)
+    def txn(key, checklist):
+        o = yield key.get_async()
+        if o.checklist_data is None and o.filled_checklist is not None:
+            filled = _legacy_checklist(o.filled_checklist)
+            try:
+                checklist.validate(filled)
+            except FilledChecklistError:
+                # Not tallied, the answers may not even be questions of the checklist
+                tally = None
+            else:
+                tally = filled
+            o.checklist_data = checklist.encode(filled)
+            o.filled_checklist = None
+            yield (o.put_async(), rollup.record_answers_async([o], [tally]))
+
+    futures = []
+    for o in legacy:
+        checklist, error = compiled[o.clasificacion.urlsafe()].get_result() if o.clasificacion else (None, None)
+        try:
+            if _legacy_checklist(o.filled_checklist) is None:
+                raise ValueError('Not a JSON object')
+        except ValueError as e:
+            logging.warning('[Observacion] - Checklist of {0} left as is: {1}'.format(o.key, e))
+        else:
+            futures.append(txn(o.key, checklist or generic))
+    ndb.Future.wait_all(futures)
+    for f in futures:
+        f.check_success()
+    if more:
+        deferred.defer(compact_checklists, start_cursor.urlsafe())
+    else:
+        logging.info('[Observacion] - Checklists compaction done')
 
 
 class ObservacionCreationError(Exception):
@@ -6,14 +6,21 @@ __author__ = 'Cesar'
 
 import logging
 from google.appengine.ext import ndb
+from cache import TwoTierCache
+
+
+# Observador lookups run on almost every write path: LRU (per instance) -> memcache -> datastore. Callers get an
+# entity they can modify (copy_on_read)
+observador_cache = TwoTierCache('observador', max_size=2000, local_ttl=60, memcache_ttl=3600, copy_on_read=True)
 
 
 class Observador(ndb.Model):
     """
-    Represents a observador in the platform.
+    Represents a observador in the platform. Keyed by email.
 
         - account_type: Authentication used to validate the Observador.
         - installation_id: Parse parameter for Push notifications.
+        - home: Home coordinate, used to plan casilla assignments
     """
 
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -22,9 +29,21 @@ class Observador(ndb.Model):
     age = ndb.IntegerProperty()
     account_type = ndb.StringProperty(choices=['Facebook', 'G+'])
     installation_id = ndb.StringProperty()
+    home = ndb.GeoPtProperty()
+
+    def _post_put_hook(self, future):
+        # Only observadores keyed by email are cached (legacy ones are re-keyed by migration.py)
+        if self.key.string_id():
+            observador_cache.invalidate(self.key.string_id())
 
     @classmethod
-    def exists(cls, email):
+    def _post_delete_hook(cls, key, future):
+        if key.string_id():
+            observador_cache.invalidate(key.string_id())
+
+    @classmethod
+    @ndb.tasklet
+    def exists_async(cls, email):
         """
         Checks the datastore to find if the observador (email) is already on it.
 
@@ -32,56 +51,112 @@ class Observador(ndb.Model):
             email: (String) email from request
 
         Returns:
-            True if email exist False otherwise
+            Future, True if email exist False otherwise
         """
-        return cls.query(cls.email == email).count(1) == 1
+        o = yield cls.get_by_id_async(email)
+        raise ndb.Return(o is not None)
 
     @classmethod
-    def create_in_datastore(cls, account_type, age, email, name, installation_id):
+    def exists(cls, email):
+        return cls.exists_async(email).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def create_in_datastore_async(cls, account_type, age, email, name, installation_id, home=None):
         """
         Creates a new observador in datastore
         """
-        try:
-            if Observador.exists(email):
+        @ndb.transactional_tasklet
+        def txn():
+            current = yield Observador.get_by_id_async(email)
+            if current:
                 raise ObservadorCreationError('Observador email already in platform')
-            else:
-                o = Observador(account_type=account_type,
-                               age=age,
-                               email=email,
-                               name=name,
-                               installation_id=installation_id)
-                key = o.put()
+            o = Observador(id=email,
+                           account_type=account_type,
+                           age=age,
+                           email=email,
+                           name=name,
+                           installation_id=installation_id,
+                           home=ndb.GeoPt(str(home)) if home else None)
+            key = yield o.put_async()
+            raise ndb.Return(key)
+
+        try:
+            key = yield txn()
+            observador_cache.invalidate(email)
         except Exception as e:
             raise ObservadorCreationError('Error creating the user in platform: '+e.__str__())
         else:
             logging.debug('[Observador] - New Observador Key = {0}'.format(key))
-            return True
+            raise ndb.Return(True)
 
     @classmethod
-    def get_from_datastore(cls, email):
+    def create_in_datastore(cls, account_type, age, email, name, installation_id, home=None):
+        return cls.create_in_datastore_async(account_type, age, email, name, installation_id, home).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def update_in_datastore_async(cls, email, name=None, age=None, installation_id=None, home=None):
         """
-        Gets observador from datastore based on email
+        Updates the profile of an observador in datastore, only the given (not None) fields are changed
+        """
+        @ndb.transactional_tasklet
+        def txn():
+            o = yield Observador.get_by_id_async(email)
+            if not o:
+                raise GetObservadorError('Observador does not exist')
+            if name is not None:
+                o.name = name
+            if age is not None:
+                o.age = age
+            if installation_id is not None:
+                o.installation_id = installation_id
+            if home is not None:
+                o.home = ndb.GeoPt(str(home))
+            key = yield o.put_async()
+            raise ndb.Return(key)
+
+        try:
+            key = yield txn()
+            observador_cache.invalidate(email)
+        except Exception as e:
+            raise ObservadorCreationError('Error updating the user in platform: '+e.__str__())
+        else:
+            logging.debug('[Observador] - Updated Observador Key = {0}'.format(key))
+            raise ndb.Return(True)
+
+    @classmethod
+    def update_in_datastore(cls, email, name=None, age=None, installation_id=None, home=None):
+        return cls.update_in_datastore_async(email, name, age, installation_id, home).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_from_datastore_async(cls, email):
+        """
+        Gets observador from datastore based on email, read through observador_cache
         :param:
             email: unique identifier of the Observador
         :return:
-            observador object from the datastore
+            Future, observador object from the datastore
         """
         try:
-            if Observador.exists(email):
-                query = Observador.query(Observador.email == email).fetch(limit=1)
-                u = query
-            else:
+            u = yield observador_cache.get_async(email, lambda e: Observador.get_by_id_async(e, use_memcache=False))
+            if not u:
                 raise GetObservadorError('Observador does not exist')
         except Exception as e:
                 raise GetObservadorError('Error getting user: '+e.__str__())
         else:
-            logging.debug("[Observador] - Key = {0}".format(u[0].key))
-            logging.debug("[Observador] - email = {0}".format(u[0].email))
-            logging.debug("[Observador] - name = {0}".format(u[0].name))
-            logging.debug("[Observador] - age = {0}".format(u[0].age))
-            logging.debug("[Observador] - account_type = {0}".format(u[0].account_type))
-            logging.debug("[Observador] - installation_id = {0}".format(u[0].installation_id))
-            return u[0]
+            logging.debug("[Observador] - Key = {0}".format(u.key))
+            logging.debug("[Observador] - email = {0}".format(u.email))
+            logging.debug("[Observador] - name = {0}".format(u.name))
+            logging.debug("[Observador] - age = {0}".format(u.age))
+            logging.debug("[Observador] - account_type = {0}".format(u.account_type))
+            logging.debug("[Observador] - installation_id = {0}".format(u.installation_id))
+            raise ndb.Return(u)
+
+    @classmethod
+    def get_from_datastore(cls, email):
+        return cls.get_from_datastore_async(email).get_result()
 
 
 class ObservadorCreationError(Exception):
@@ -0,0 +1,370 @@
+"""
+Defines the materialised rollups of observaciones in the Observador-Electoral platform.
+
+    - ObservacionRollup:    Observaciones per (distrito, clasificacion, BUCKET_MINUTES bucket), split in
+                            ROLLUP_SHARDS entities so a busy distrito does not contend on a single entity group
+    - CasillaRollup:        Summary of the observaciones of a casilla: total, per clasificacion and latest date,
+                            split in ROLLUP_SHARDS entities so a busy casilla does not contend either
+    - AnswerTally:          Answers to each question of the checklist of a clasificacion in a distrito, split in
+                            ROLLUP_SHARDS entities as well
+
+Rollups are updated in the transaction that writes the observacion, so they never drift from the observaciones, and
+queries read them directly instead of grouping observaciones.
+"""
+__author__ = 'Cesar'
+
+
+import json
+import random
+import datetime
+from google.appengine.ext import ndb
+
+from casilla import Casilla
+from distrito import Distrito
+from clasificacion import Clasificacion
+
+
+BUCKET_MINUTES = 15
+ROLLUP_SHARDS = 4
+BUCKET_FORMAT = '%Y-%m-%dT%H:%M'
+# Answers are tallied as their JSON, the ones longer than MAX_TALLY_ANSWER_LENGTH (free text) and the ones past the
+# first MAX_TALLY_ANSWERS distinct answers of a question are tallied as OTHER_ANSWER
+MAX_TALLY_ANSWER_LENGTH = 40
+MAX_TALLY_ANSWERS = 100
+OTHER_ANSWER = '*'
+# Longest bucket range of a query, and most ObservacionRollup entities it reads (narrow the filters beyond that)
+MAX_BUCKET_RANGE_HOURS = 24
+MAX_BUCKET_ROLLUPS = 5000
+
+
+def bucket_of(date):
+    """
+    Start of the BUCKET_MINUTES bucket holding date
+    """
+    return date.replace(minute=date.minute - date.minute % BUCKET_MINUTES, second=0, microsecond=0)
+
+
+class ObservacionRollup(ndb.Model):
+    """
+    Represents a shard of the count of observaciones of a distrito and clasificacion in a bucket.
+    Keyed by distrito|clasificacion|bucket|shard.
+
+        - bucket: Start of the bucket (UTC)
+        - count: Observaciones counted in this shard
+    """
+
+    distrito = ndb.KeyProperty(kind=Distrito)
+    clasificacion = ndb.KeyProperty(kind=Clasificacion)
+    bucket = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, distrito, clasificacion, bucket, shard):
+        """
+        Key of a shard, distrito is required: observaciones without one are rejected, or wait for backfill_rollups
+        """
+        return ndb.Key(cls, '{0}|{1}|{2}|{3}'.format(distrito.id(), clasificacion.id(),
+                                                     bucket.strftime(BUCKET_FORMAT), shard))
+
+
+class CasillaRollup(ndb.Model):
+    """
+    Represents a shard of the summary of the observaciones of a casilla. Keyed by the national_id of the casilla
+    (shard 0, the summaries written before the shards) or national_id|shard. Read the summary with get_summaries().
+
+        - clasificaciones: Observaciones per clasificacion (URL safe key -> count), None in the summaries written
+          before it existed
+        - last_observed: Date of the latest observacion
+    """
+
+    casilla = ndb.KeyProperty(kind=Casilla)
+    distrito = ndb.KeyProperty(kind=Distrito)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    clasificaciones = ndb.JsonProperty()
+    last_observed = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, national_id, shard):
+        if not shard:
+            return ndb.Key(cls, national_id)
+        return ndb.Key(cls, '{0}|{1}'.format(national_id, shard))
+
+    @classmethod
+    def merge(cls, national_id, shards):
+        """
+        Summary of a casilla from its shards (None if it has none), clasificaciones is None if a shard lacks it
+        """
+        shards = [r for r in shards if r]
+        if not shards:
+            return None
+        summary = CasillaRollup(key=cls.key_for(national_id, 0),
+                                casilla=shards[0].casilla,
+                                distrito=shards[0].distrito,
+                                clasificaciones={})
+        for r in shards:
+            summary.count += r.count
+            if r.clasificaciones is None or summary.clasificaciones is None:
+                summary.clasificaciones = None
+            else:
+                for clasificacion, count in r.clasificaciones.items():
+                    summary.clasificaciones[clasificacion] = summary.clasificaciones.get(clasificacion, 0) + count
+            if r.last_observed and (not summary.last_observed or summary.last_observed < r.last_observed):
+                summary.last_observed = r.last_observed
+        return summary
+
+
+class AnswerTally(ndb.Model):
+    """
+    Represents a shard of the tally of the answers to the checklist of a clasificacion in a distrito.
+    Keyed by distrito|clasificacion|shard.
+
+        - count: Observaciones tallied in this shard
+        - answers: Question -> {answer (JSON, or OTHER_ANSWER) -> observaciones}
+    """
+
+    distrito = ndb.KeyProperty(kind=Distrito)
+    clasificacion = ndb.KeyProperty(kind=Clasificacion)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    answers = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, distrito, clasificacion, shard):
+        return ndb.Key(cls, '{0}|{1}|{2}'.format(distrito.id(), clasificacion.id(), shard))
+
+    def add(self, filled):
+        """
+        Tallies a filled checklist (dict)
+        """
+        self.count += 1
+        for question, answer in filled.items():
+            tally = self.answers.setdefault(question, {})
+            answer = json.dumps(answer)
+            if len(answer) > MAX_TALLY_ANSWER_LENGTH or (answer not in tally and len(tally) >= MAX_TALLY_ANSWERS):
+                answer = OTHER_ANSWER
+            tally[answer] = tally.get(answer, 0) + 1
+
+
+def _tally_keys(observaciones, answers, shard):
+    """
+    AnswerTally key -> filled checklists of the observaciones with answers (and a distrito)
+    """
+    tallies = {}
+    for o, filled in zip(observaciones, answers or []):
+        if filled is not None and o.distrito is not None:
+            tallies.setdefault(AnswerTally.key_for(o.distrito, o.clasificacion, shard), []).append((o, filled))
+    return tallies
+
+
+def _add_answers(tallies, rollups):
+    for key, group in tallies.items():
+        r = rollups[key]
+        if r is None:
+            r = rollups[key] = AnswerTally(key=key,
+                                           distrito=group[0][0].distrito,
+                                           clasificacion=group[0][0].clasificacion,
+                                           answers={})
+        for o, filled in group:
+            r.add(filled)
+
+
+@ndb.tasklet
+def record_async(observaciones, answers=None, shard=None):
+    """
+    Adds observaciones to their rollups, with one get_multi and one put_multi. Must run in the transaction writing
+    the observaciones, which need date, distrito, clasificacion and casilla set (the observaciones written before
+    the rollups get their distrito from observacion.backfill_rollups, which adds them).
+
+    Args:
+        - observaciones:    list of Observacion
+        - answers:          Filled checklists (dict, None if not to be tallied) in the order of observaciones
+        - shard:            Shard of the rollups to add to, random if None. Concurrent transactions of the same
+                            batch pass different shards so they do not contend with each other
+
+    Returns:
+        Future
+    """
+    # One shard per call, so a batch adds to as few entity groups as possible
+    if shard is None:
+        shard = random.randint(0, ROLLUP_SHARDS - 1)
+    buckets = {}
+    casillas = {}
+    for o in observaciones:
+        bucket = bucket_of(o.date)
+        buckets.setdefault(ObservacionRollup.key_for(o.distrito, o.clasificacion, bucket, shard), []).append(o)
+        casillas.setdefault(CasillaRollup.key_for(o.casilla.id(), shard), []).append(o)
+    tallies = _tally_keys(observaciones, answers, shard)
+    keys = list(buckets) + list(casillas) + list(tallies)
+    current = yield ndb.get_multi_async(keys)
+    rollups = dict(zip(keys, current))
+
+    for key, group in buckets.items():
+        r = rollups[key]
+        if r is None:
+            r = rollups[key] = ObservacionRollup(key=key,
+                                                 distrito=group[0].distrito,
+                                                 clasificacion=group[0].clasificacion,
+                                                 bucket=bucket_of(group[0].date))
+        r.count += len(group)
+    for key, group in casillas.items():
+        r = rollups[key]
+        if r is None:
+            r = rollups[key] = CasillaRollup(key=key,
+                                             casilla=group[0].casilla,
+                                             distrito=group[0].distrito,
+                                             clasificaciones={})
+        r.count += len(group)
+        if r.clasificaciones is not None:
+            for o in group:
+                clasificacion = o.clasificacion.urlsafe()
+                r.clasificaciones[clasificacion] = r.clasificaciones.get(clasificacion, 0) + 1
+        last = max(o.date for o in group)
+        if not r.last_observed or r.last_observed < last:
+            r.last_observed = last
+    _add_answers(tallies, rollups)
+    yield ndb.put_multi_async([rollups[k] for k in keys])
+
+
+@ndb.tasklet
+def record_answers_async(observaciones, answers):
+    """
+    Adds the filled checklists of observaciones already in the other rollups to the answer tallies. Must run in the
+    transaction (cross group) updating the observaciones.
+
+    Returns:
+        Future
+    """
+    tallies = _tally_keys(observaciones, answers, random.randint(0, ROLLUP_SHARDS - 1))
+    if not tallies:
+        return
+    keys = list(tallies)
+    current = yield ndb.get_multi_async(keys)
+    rollups = dict(zip(keys, current))
+    _add_answers(tallies, rollups)
+    yield ndb.put_multi_async([rollups[k] for k in keys])
+
+
+@ndb.tasklet
+def get_buckets_async(distrito=None, clasificacion=None, start=None, end=None):
+    """
+    Gets the observaciones per distrito, clasificacion and bucket, in a range of at most MAX_BUCKET_RANGE_HOURS.
+
+    Args:
+        - distrito:         Distrito key, all the distritos if None
+        - clasificacion:    Clasificacion key, all the clasificaciones if None
+        - start, end:       Bucket range [start, end), end defaults to MAX_BUCKET_RANGE_HOURS after start
+
+    Returns:
+        Future, list of (distrito key, clasificacion key, bucket, count) sorted by bucket. Raises RollupError if
+        start is missing, the range is too long or it holds more than MAX_BUCKET_ROLLUPS rollups
+    """
+    if start is None:
+        raise RollupError('The first bucket of the range is required')
+    start = bucket_of(start)
+    max_range = datetime.timedelta(hours=MAX_BUCKET_RANGE_HOURS)
+    end = end or start + max_range
+    if end - start > max_range:
+        raise RollupError('At most {0} hours of buckets per request'.format(MAX_BUCKET_RANGE_HOURS))
+    query = ObservacionRollup.query(ObservacionRollup.bucket >= start, ObservacionRollup.bucket < end)
+    if distrito:
+        query = query.filter(ObservacionRollup.distrito == distrito)
+    if clasificacion:
+        query = query.filter(ObservacionRollup.clasificacion == clasificacion)
+    rollups = yield query.fetch_async(MAX_BUCKET_ROLLUPS + 1, batch_size=1000)
+    if len(rollups) > MAX_BUCKET_ROLLUPS:
+        raise RollupError('Too many buckets, narrow the range or filter by distrito or clasificacion')
+
+    counts = {}
+    for r in rollups:
+        group = (r.bucket, r.distrito, r.clasificacion)
+        counts[group] = counts.get(group, 0) + r.count
+    groups = sorted(counts, key=lambda g: (g[0], g[1].id(), g[2].id()))
+    raise ndb.Return([(d, c, bucket, counts[(bucket, d, c)]) for bucket, d, c in groups])
+
+
+def get_buckets(distrito=None, clasificacion=None, start=None, end=None):
+    return get_buckets_async(distrito, clasificacion, start, end).get_result()
+
+
+@ndb.tasklet
+def get_summaries_async(national_ids):
+    """
+    Gets the summaries of the given casillas, merged from their shards with one get_multi.
+
+    Returns:
+        Future, list of CasillaRollup (None for casillas without observaciones) in the order of national_ids
+    """
+    shards = yield ndb.get_multi_async([CasillaRollup.key_for(n, i) for n in national_ids
+                                        for i in range(ROLLUP_SHARDS)])
+    raise ndb.Return([CasillaRollup.merge(n, shards[i * ROLLUP_SHARDS:(i + 1) * ROLLUP_SHARDS])
+                      for i, n in enumerate(national_ids)])
+
+
+def get_summaries(national_ids):
+    return get_summaries_async(national_ids).get_result()
+
+
+@ndb.tasklet
+def get_casillas_async(national_ids):
+    """
+    Gets the rollups of the given casillas with one get_multi.
+
+    Returns:
+        Future, list of (national_id, count, last_observed), count 0 for casillas without observaciones
+    """
+    rollups = yield get_summaries_async(national_ids)
+    raise ndb.Return([(n, r.count if r else 0, r.last_observed if r else None)
+                      for n, r in zip(national_ids, rollups)])
+
+
+def get_casillas(national_ids):
+    return get_casillas_async(national_ids).get_result()
+
+
+@ndb.tasklet
+def get_tallies_async(clasificacion, distrito=None):
+    """
+    Gets the answer tallies of the checklist of a clasificacion, per distrito.
+
+    Args:
+        - clasificacion:    Clasificacion key
+        - distrito:         Distrito key, all the distritos if None
+
+    Returns:
+        Future, list of (distrito key, observaciones, {question: {answer (JSON or OTHER_ANSWER): count}}) sorted by
+        distrito
+    """
+    query = AnswerTally.query(AnswerTally.clasificacion == clasificacion)
+    if distrito:
+        query = query.filter(AnswerTally.distrito == distrito)
+    shards = yield query.fetch_async(batch_size=1000)
+
+    tallies = {}
+    for shard in shards:
+        count, answers = tallies.setdefault(shard.distrito, [0, {}])
+        tallies[shard.distrito][0] = count + shard.count
+        for question, tally in shard.answers.items():
+            merged = answers.setdefault(question, {})
+            for answer, n in tally.items():
+                merged[answer] = merged.get(answer, 0) + n
+    raise ndb.Return([(d, tallies[d][0], tallies[d][1]) for d in sorted(tallies, key=lambda d: d.id())])
+
+
+def get_tallies(clasificacion, distrito=None):
+    return get_tallies_async(clasificacion, distrito).get_result()
+
+
+def parse_bucket(value):
+    """
+    Parses a BUCKET_FORMAT (UTC) string, None if empty
+    """
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, BUCKET_FORMAT)
+
+
+class RollupError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
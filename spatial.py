@@ -0,0 +1,262 @@
+"""
+Defines the in-process spatial index used for nearest casilla lookups in the Observador-Electoral platform.
+
+    - GridIndex:        Points bucketed in a lat/lon grid, answers k-nearest and radius queries
+    - SnapshotIndex:    GridIndex loaded lazily per instance from a compact snapshot kept in memcache, and refreshed
+                        incrementally
+"""
+__author__ = 'Cesar'
+
+
+import math
+import zlib
+import heapq
+import time
+import array
+import logging
+import threading
+from google.appengine.api import memcache
+
+
+EARTH_RADIUS = 6371000.0
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180.0
+# ~1.1 km cells
+CELL_DEGREES = 0.01
+# Beyond this many rings of cells (~55 km) a full scan is cheaper than walking empty cells
+MAX_RINGS = 50
+# Coordinates are stored in the snapshot as integer micro degrees (~0.1 m)
+SNAPSHOT_SCALE = 1000000
+SNAPSHOT_CHUNK_SIZE = 900 * 1024
+SNAPSHOT_TTL = 60 * 60
+REFRESH_SECONDS = 60
+# Slack for clock differences between the snapshot builder and the datastore
+REFRESH_MARGIN_SECONDS = 10
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Great circle (haversine) distance in meters
+    """
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex(object):
+    """
+    Points (id, lat, lon) bucketed in cells of CELL_DEGREES. Nearest neighbour queries scan rings of cells around the
+    query point until no unseen cell can hold a closer point.
+    """
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def add(self, point_id, lat, lon):
+        self.remove(point_id)
+        self.points[point_id] = (lat, lon)
+        self.cells.setdefault(self._cell(lat, lon), []).append((point_id, lat, lon))
+
+    def remove(self, point_id):
+        current = self.points.pop(point_id, None)
+        if current is None:
+            return
+        cell = self._cell(*current)
+        bucket = [p for p in self.cells.get(cell, []) if p[0] != point_id]
+        if bucket:
+            self.cells[cell] = bucket
+        else:
+            self.cells.pop(cell, None)
+
+    def _ring(self, ci, cj, r):
+        if r == 0:
+            yield ci, cj
+            return
+        for j in range(cj - r, cj + r + 1):
+            yield ci - r, j
+            yield ci + r, j
+        for i in range(ci - r + 1, ci + r):
+            yield i, cj - r
+            yield i, cj + r
+
+    def nearest(self, lat, lon, k=1, radius=None):
+        """
+        Gets the k points closest to (lat, lon).
+
+        Args:
+            - lat, lon: Query point
+            - k:        Number of points
+            - radius:   Optional maximum distance in meters
+
+        Returns:
+            List of (distance, id, lat, lon) sorted by distance
+        """
+        if not self.points or k <= 0:
+            return []
+        ci, cj = self._cell(lat, lon)
+        # Smallest side of a cell around the query point, lower bound for the distance to the next ring
+        cell_meters = self.cell_degrees * METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + 1, 89))), 0.01)
+        best = []
+        seen = 0
+        r = 0
+        while seen < len(self.points):
+            if r > MAX_RINGS:
+                return self._scan(lat, lon, k, radius)
+            ring_distance = (r - 1) * cell_meters if r else 0
+            if radius is not None and ring_distance > radius:
+                break
+            if len(best) == k and ring_distance > -best[0][0]:
+                break
+            for cell in self._ring(ci, cj, r):
+                for point_id, p_lat, p_lon in self.cells.get(cell, ()):
+                    seen += 1
+                    d = distance(lat, lon, p_lat, p_lon)
+                    if radius is not None and d > radius:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, point_id, p_lat, p_lon))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, point_id, p_lat, p_lon))
+            r += 1
+        return sorted((-d, point_id, p_lat, p_lon) for d, point_id, p_lat, p_lon in best)
+
+    def _scan(self, lat, lon, k, radius):
+        candidates = ((distance(lat, lon, p_lat, p_lon), point_id, p_lat, p_lon)
+                      for point_id, (p_lat, p_lon) in self.points.items())
+        if radius is not None:
+            candidates = (c for c in candidates if c[0] <= radius)
+        return heapq.nsmallest(k, candidates)
+
+    def within(self, lat, lon, radius):
+        """
+        Gets all the points closer than radius meters to (lat, lon), as (distance, id, lat, lon) sorted by distance
+        """
+        return self.nearest(lat, lon, k=len(self.points), radius=radius)
+
+
+class SnapshotIndex(object):
+    """
+    GridIndex shared by the requests of an instance. Loaded on first use from the memcache snapshot (built from the
+    datastore when missing) and refreshed every REFRESH_SECONDS with the points updated since the last load.
+
+        - name:         memcache namespace of the snapshot
+        - load_all:     Function returning an iterable of (id, lat, lon) for all the points
+        - load_since:   Function returning an iterable of (id, lat, lon) updated after the given epoch seconds
+    """
+
+    def __init__(self, name, load_all, load_since):
+        self.name = name
+        self.load_all = load_all
+        self.load_since = load_since
+        self.index = None
+        self.loaded_at = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the GridIndex, loading or refreshing it if needed. The memcache and datastore reads run outside the
+        lock: a synchronous datastore call runs the tasklets of the request, and one of them could ask for the lock
+        again.
+        """
+        refresh = False
+        with self._lock:
+            index, loaded_at = self.index, self.loaded_at
+            if index is not None and time.time() - self.checked_at > REFRESH_SECONDS:
+                # Claimed, the other requests keep using the index meanwhile
+                self.checked_at = time.time()
+                refresh = True
+        if index is None:
+            return self._load()
+        if refresh:
+            self._refresh(index, loaded_at)
+        return index
+
+    def add(self, point_id, lat, lon):
+        """
+        Adds a point to the instance index if it is already loaded, other instances pick it up on refresh
+        """
+        with self._lock:
+            if self.index is not None:
+                self.index.add(point_id, lat, lon)
+
+    def invalidate(self):
+        with self._lock:
+            self.index = None
+        memcache.delete('header', namespace=self.name)
+
+    def _load(self):
+        """
+        Builds a new GridIndex and swaps it in, returns it
+        """
+        started = time.time()
+        index = GridIndex()
+        snapshot_at = self._read_snapshot(index)
+        if snapshot_at is None:
+            snapshot_at = time.time()
+            for point_id, lat, lon in self.load_all():
+                index.add(point_id, lat, lon)
+            self._write_snapshot(index, snapshot_at)
+        now = time.time()
+        for point_id, lat, lon in self.load_since(snapshot_at - REFRESH_MARGIN_SECONDS):
+            index.add(point_id, lat, lon)
+        with self._lock:
+            self.index = index
+            self.loaded_at = now
+            self.checked_at = now
+        logging.info('[Spatial] - {0}: {1} points loaded in {2:.3f}s'
+                     .format(self.name, len(index), time.time() - started))
+        return index
+
+    def _refresh(self, index, loaded_at):
+        now = time.time()
+        points = list(self.load_since(loaded_at - REFRESH_MARGIN_SECONDS))
+        with self._lock:
+            # Unless it was reloaded or invalidated meanwhile
+            if self.index is index:
+                for point_id, lat, lon in points:
+                    index.add(point_id, lat, lon)
+                self.loaded_at = now
+
+    def _write_snapshot(self, index, snapshot_at):
+        ids = []
+        coords = array.array('i')
+        for point_id, (lat, lon) in index.points.items():
+            ids.append(point_id.encode('utf-8'))
+            coords.append(int(round(lat * SNAPSHOT_SCALE)))
+            coords.append(int(round(lon * SNAPSHOT_SCALE)))
+        blob = zlib.compress(coords.tostring() + b'\n'.join(ids))
+        chunks = [blob[i:i + SNAPSHOT_CHUNK_SIZE] for i in range(0, len(blob), SNAPSHOT_CHUNK_SIZE)]
+        mapping = dict(('chunk:{0}'.format(i), c) for i, c in enumerate(chunks))
+        if memcache.set_multi(mapping, time=SNAPSHOT_TTL, namespace=self.name):
+            return
+        memcache.set('header', (snapshot_at, len(chunks), len(ids)), time=SNAPSHOT_TTL, namespace=self.name)
+
+    def _read_snapshot(self, index):
+        header = memcache.get('header', namespace=self.name)
+        if not header:
+            return None
+        snapshot_at, n_chunks, n_points = header
+        keys = ['chunk:{0}'.format(i) for i in range(n_chunks)]
+        chunks = memcache.get_multi(keys, namespace=self.name)
+        if len(chunks) != n_chunks:
+            return None
+        blob = zlib.decompress(b''.join(chunks[k] for k in keys))
+        coords = array.array('i')
+        coords.fromstring(blob[:n_points * 2 * coords.itemsize])
+        ids = blob[n_points * 2 * coords.itemsize:].split(b'\n') if n_points else []
+        for i, point_id in enumerate(ids):
+            index.add(point_id.decode('utf-8'),
+                      float(coords[2 * i]) / SNAPSHOT_SCALE,
+                      float(coords[2 * i + 1]) / SNAPSHOT_SCALE)
+        return snapshot_at
@@ -0,0 +1,214 @@
+"""
+Defines the batch upload of offline submissions in the Observador-Electoral platform.
+
+A device that was offline replays its queued observacion, nota, media and location creations as one ordered batch.
+A nota or media can point at an observacion created earlier in the same batch by using the ref of that item instead
+of a URL safe key. Observaciones are written first (pre-allocated keys, Observacion.save_batch), then the notas,
+medias and locations, each in its own get or insert transaction (all of them concurrently).
+
+Items carrying a submission_id are keyed by it (notas and medias by their name) and replays are answered from the
+dedup cache, so a device can resend a batch after a timeout.
+"""
+__author__ = 'Cesar'
+
+
+import logging
+from google.appengine.ext import ndb
+
+from observacion import Observacion
+from observador import Observador
+from location import Location, LastLocation
+from media import Media
+from nota import Nota
+from cache import submission_cache
+
+
+MAX_ITEMS = 500
+KINDS = ('observacion', 'nota', 'media', 'location')
+
+
+def upload(items):
+    """
+    Writes a batch of submissions.
+        :param items: ordered list of dicts with kind (observacion, nota, media or location), an optional ref, and
+                      the fields of the matching create request
+
+        :return: list of (URL safe key, error) in the order of items
+    """
+    if len(items) > MAX_ITEMS:
+        raise SyncError('At most {0} items per batch'.format(MAX_ITEMS))
+    results = [None] * len(items)
+    refs = {}
+    for i, item in enumerate(items):
+        if item['kind'] not in KINDS:
+            results[i] = (None, 'Unknown kind: {0}'.format(item['kind']))
+        elif item.get('ref'):
+            refs.setdefault(item['ref'], i)
+
+    cache_keys = dict((i, _cache_key(item)) for i, item in enumerate(items)
+                      if results[i] is None and item.get('submission_id'))
+    cached = [(i, submission_cache.peek_async(k)) for i, k in cache_keys.items()]
+    for i, future in cached:
+        if future.get_result():
+            results[i] = (future.get_result(), None)
+
+    _upload_observaciones(items, results)
+    _upload_others(items, results, refs)
+    submission_cache.set_multi(dict((cache_keys[i], results[i][0]) for i in cache_keys if not results[i][1]))
+    logging.info('[Sync] - Uploaded {0}/{1} items'.format(len([r for r in results if not r[1]]), len(items)))
+    return results
+
+
+def _cache_key(item):
+    """
+    Dedup cache key of an item, the same as the create of its model
+    """
+    if item['kind'] == 'observacion':
+        return Observacion.submission_cache_key(item['submission_id'], item.get('observador'), item.get('casilla'),
+                                                item.get('clasificacion'))
+    if item['kind'] == 'location':
+        return Location.submission_cache_key(item['submission_id'], item.get('observador'))
+    return '{0}:{1}'.format(item['kind'].capitalize(), item['submission_id'])
+
+
+def _upload_observaciones(items, results):
+    indexes = [i for i, item in enumerate(items) if results[i] is None and item['kind'] == 'observacion']
+    if not indexes:
+        return
+    missing_ids = len([i for i in indexes if not items[i].get('submission_id')])
+    next_id = Observacion.allocate_ids(missing_ids)[0] if missing_ids else None
+    submissions = []
+    for i in indexes:
+        submission = dict((f, items[i].get(f))
+                          for f in ('observador', 'casilla', 'clasificacion', 'filled_checklist'))
+        if items[i].get('submission_id'):
+            submission['id'] = items[i]['submission_id']
+        else:
+            submission['id'] = next_id
+            next_id += 1
+        submissions.append(submission)
+    for i, result in zip(indexes, Observacion.save_batch(submissions)):
+        results[i] = result
+
+
+def _upload_others(items, results, refs):
+    indexes = [i for i, item in enumerate(items) if results[i] is None]
+    emails = list(set(items[i]['observador'] for i in indexes if items[i]['kind'] == 'location'))
+    observadores = dict(zip(emails, ndb.get_multi([ndb.Key(Observador, e) for e in emails])))
+    taken = set()
+
+    entities = []
+    owners = []
+    for i in indexes:
+        item = items[i]
+        try:
+            if item['kind'] == 'location':
+                o = observadores[item['observador']]
+                if not o:
+                    raise SyncError('Observador does not exist')
+                entity = Location(loc=ndb.GeoPt(str(item['loc'])), observador=o.key)
+                if item.get('submission_id'):
+                    entity.key = ndb.Key(Location, item['submission_id'])
+            else:
+                name = (item['kind'], item['name'])
+                if name in taken:
+                    raise SyncError('{0} already exists in platform'.format(item['kind'].capitalize()))
+                o_key = _resolve_observacion(item['observacion'], i, items, results, refs)
+                if item['kind'] == 'nota':
+                    entity = Nota(id=item['name'], observacion=o_key, name=item['name'])
+                else:
+                    entity = Media(id=item['name'], observacion=o_key, m_type=item['m_type'], name=item['name'])
+                taken.add(name)
+        except Exception as e:
+            results[i] = (None, e.value if isinstance(e, SyncError) else e.__str__())
+        else:
+            entities.append(entity)
+            owners.append(i)
+
+    # Casilla of the observaciones of the notas and medias, denormalized for the casilla timeline
+    o_keys = list(set(e.observacion for e in entities if not isinstance(e, Location)))
+    casillas = dict((k, o.casilla) for k, o in zip(o_keys, ndb.get_multi(o_keys)) if o)
+    for e in entities:
+        if not isinstance(e, Location):
+            e.casilla = casillas.get(e.observacion)
+
+    futures = [_insert_async(e) for e in entities]
+    lasts = {}
+    for i, future in zip(owners, futures):
+        try:
+            entity = future.get_result()
+        except SyncError as e:
+            results[i] = (None, e.value)
+        except Exception as e:
+            logging.exception('[Sync] - Error writing {0}'.format(items[i]['kind']))
+            results[i] = (None, 'Error writing the {0}: {1}'.format(items[i]['kind'], e.__str__()))
+        else:
+            results[i] = (entity.key.urlsafe(), None)
+            if isinstance(entity, Location):
+                # Written concurrently, the batch order tells which one is the last
+                lasts[entity.observador] = entity
+
+    # Last location of every observador, one transaction each
+    for future in [LastLocation.record_async(l) for l in lasts.values()]:
+        try:
+            future.get_result()
+        except Exception:
+            logging.exception('[Sync] - Error recording the last location')
+
+
+@ndb.tasklet
+def _insert_async(entity):
+    """
+    Writes a nota, media or location keyed by its submission_id in its own get or insert transaction, the same as
+    the create of their models, and a location without submission_id with a plain put. The transactions of a batch
+    run concurrently.
+    :return: Future, the written entity (the existing one for a replay)
+    """
+    if entity.key is None:
+        yield entity.put_async()
+    else:
+        entity = yield _get_or_insert_async(entity)
+    raise ndb.Return(entity)
+
+
+@ndb.transactional_tasklet
+def _get_or_insert_async(entity):
+    """
+    The entity, written unless it exists. A replay (same observacion for a nota or media, same observador for a
+    location) returns the existing one, unchanged.
+    """
+    current = yield entity.key.get_async()
+    if current is None:
+        yield entity.put_async()
+        raise ndb.Return(entity)
+    owner = 'observador' if isinstance(entity, Location) else 'observacion'
+    if getattr(current, owner) != getattr(entity, owner):
+        raise SyncError('{0} already exists in platform'.format(entity.key.kind()))
+    raise ndb.Return(current)
+
+
+def _resolve_observacion(value, i, items, results, refs):
+    """
+    Key of the observacion referenced by item i: the ref of an earlier observacion in the batch, or a URL safe key
+    """
+    j = refs.get(value)
+    if j is not None and j < i and items[j]['kind'] == 'observacion':
+        url_safe_key, error = results[j]
+        if error:
+            raise SyncError('Referenced observacion failed: {0}'.format(error))
+        return ndb.Key(urlsafe=url_safe_key)
+    try:
+        key = ndb.Key(urlsafe=value)
+    except Exception:
+        key = None
+    if key is None or key.kind() != 'Observacion':
+        raise SyncError('Unknown observacion: {0}'.format(value))
+    return key
+
+
+class SyncError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
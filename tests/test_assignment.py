@@ -0,0 +1,46 @@
+import datetime
+
+import testutil
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import sync
+import assignment
+from observador import Observador
+from location import Location, LastLocation
+
+
+class ObservadorPositionsTest(testutil.TestCase):
+
+    def setUp(self):
+        super(ObservadorPositionsTest, self).setUp()
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Observador.create_in_datastore('G+', 31, 'b@b.mx', 'B', 'i')
+
+    def forget_submissions(self):
+        # Another instance, once the dedup cache expired
+        memcache.flush_all()
+        testutil._clear_instance_caches()
+
+    def positions(self):
+        return assignment._observador_positions(Observador.query().fetch())
+
+    def test_last_location(self):
+        Location.create('a@b.mx', '19.0,-99.0', 'loc-1')
+        Location.create('a@b.mx', '19.5,-99.5')
+        # A replay of the older location
+        self.forget_submissions()
+        Location.create('a@b.mx', '19.0,-99.0', 'loc-1')
+        self.assertEqual(self.positions(), {'a@b.mx': (19.5, -99.5)})
+
+    def test_synced_locations(self):
+        sync.upload([{'kind': 'location', 'observador': 'b@b.mx', 'loc': '19.0,-99.0', 'submission_id': 'loc-1'},
+                     {'kind': 'location', 'observador': 'b@b.mx', 'loc': '19.5,-99.5', 'submission_id': 'loc-2'}])
+        self.assertEqual(self.positions(), {'b@b.mx': (19.5, -99.5)})
+
+    def test_old_location_is_ignored(self):
+        Location.create('a@b.mx', '19.0,-99.0')
+        last = ndb.Key(LastLocation, 'a@b.mx').get()
+        last.created -= datetime.timedelta(hours=assignment.LOCATION_WINDOW_HOURS + 1)
+        last.put()
+        self.assertEqual(self.positions(), {})
@@ -0,0 +1,48 @@
+import json
+
+import testutil
+from google.appengine.ext import ndb
+
+from cache import TwoTierCache
+from observador import Observador
+from clasificacion import Clasificacion
+
+
+class TwoTierCacheTest(testutil.TestCase):
+
+    def load(self, key):
+        self.loads += 1
+        future = ndb.Future()
+        future.set_result({'key': key, 'values': [1, 2]})
+        return future
+
+    def setUp(self):
+        super(TwoTierCacheTest, self).setUp()
+        self.loads = 0
+
+    def test_local_tier_shares_values_by_default(self):
+        cache = TwoTierCache('test-shared')
+        first = cache.get('a', self.load)
+        self.assertIs(cache.get('a', self.load), first)
+        self.assertEqual((self.loads, cache.stats()['local_hits']), (1, 1))
+
+    def test_copy_on_read_returns_copies(self):
+        cache = TwoTierCache('test-copies', copy_on_read=True)
+        cache.get('a', self.load)['values'].append(3)
+        second = cache.get('a', self.load)
+        self.assertEqual(second['values'], [1, 2])
+        self.assertIsNot(cache.get('a', self.load), second)
+        # Immutable values are shared as they are
+        cache.set('b', u'value')
+        self.assertIs(cache.peek_async('b').get_result(), cache.peek_async('b').get_result())
+        self.assertEqual(self.loads, 1)
+
+    def test_observadores_are_copied_and_the_catalogue_shared(self):
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Observador.get_from_datastore('a@b.mx').name = 'changed'
+        self.assertEqual(Observador.get_from_datastore('a@b.mx').name, 'A')
+
+        Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), True)
+        catalogue = Clasificacion.get_catalogue_async().get_result()
+        self.assertIsInstance(catalogue, tuple)
+        self.assertIs(Clasificacion.get_catalogue_async().get_result(), catalogue)
@@ -0,0 +1,68 @@
+import json
+import datetime
+
+import testutil
+from google.appengine.ext import ndb
+
+import rollup
+from rollup import CasillaRollup
+from casilla import Casilla, CasillaActivity
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+from observacion import Observacion
+
+
+class CasillaActivityTest(testutil.TestCase):
+
+    def setUp(self):
+        super(CasillaActivityTest, self).setUp()
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Casilla(id='C1', national_id='C1', name='n', distrito=ndb.Key(Distrito, 'D1'), loc=ndb.GeoPt(19, -99)).put()
+        self.clasificacion = Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), False)
+
+    def save(self, n):
+        return Observacion.save_batch([{'observador': 'a@b.mx',
+                                        'casilla': 'C1',
+                                        'clasificacion': self.clasificacion.urlsafe(),
+                                        'filled_checklist': json.dumps({'sellada': True})} for i in range(n)])
+
+    def test_batch_of_a_casilla_does_not_contend(self):
+        results = self.save(16)
+        self.assertEqual([error for key, error in results], [None] * 16)
+        # Each concurrent transaction of the batch wrote its own shard of the summary
+        self.assertEqual(len([r for r in ndb.get_multi([CasillaRollup.key_for('C1', i)
+                                                         for i in range(rollup.ROLLUP_SHARDS)]) if r]),
+                         rollup.ROLLUP_SHARDS)
+        (national_id, count, last_observed), = rollup.get_casillas(['C1'])
+        self.assertEqual(count, 16)
+        self.assertEqual(last_observed, max(o.date for o in Observacion.query()))
+        self.assertEqual(rollup.get_summaries(['C1'])[0].clasificaciones, {self.clasificacion.urlsafe(): 16})
+        # Not repeatable and performed according to the merged summary
+        repeatable = Clasificacion.create(u'Incidente', json.dumps({'grave': 'boolean'}), True)
+        self.assertEqual(Clasificacion.get_available_async('C1').get_result(), [repeatable.urlsafe()])
+
+    def test_summaries_written_before_the_shards_are_merged(self):
+        before = datetime.datetime(2020, 1, 1)
+        CasillaRollup(id='C1', casilla=ndb.Key(Casilla, 'C1'), count=5, last_observed=before).put()
+        self.save(3)
+        summary, missing = rollup.get_summaries(['C1', 'C2'])
+        self.assertEqual(summary.count, 8)
+        self.assertIsNone(summary.clasificaciones)
+        self.assertGreater(summary.last_observed, before)
+        self.assertIsNone(missing)
+
+    def test_last_observed_never_moves_backwards(self):
+        distrito = ndb.Key(Distrito, 'D1')
+        now = datetime.datetime.utcnow()
+        older = now - datetime.timedelta(minutes=5)
+        CasillaActivity._write_newer_async([('C1', distrito, now)]).get_result()
+        CasillaActivity._write_newer_async([('C1', distrito, older)]).get_result()
+        self.assertEqual(ndb.Key(CasillaActivity, 'C1').get(use_cache=False).last_observed, now)
+
+        # Concurrent writers keep the latest date
+        newest = now + datetime.timedelta(minutes=1)
+        ndb.Future.wait_all([CasillaActivity._write_newer_async([('C1', distrito, date)])
+                             for date in (newest, older, now)])
+        self.assertEqual(ndb.Key(CasillaActivity, 'C1').get(use_cache=False).last_observed, newest)
@@ -0,0 +1,78 @@
+import StringIO
+
+import testutil
+from google.appengine.ext import ndb
+
+import casilla_import
+from casilla_import import CasillaImport, CasillaImportError
+from casilla import Casilla
+from distrito import Distrito
+
+
+ROWS = 450
+
+
+class CasillaImportTest(testutil.TestCase):
+
+    def setUp(self):
+        super(CasillaImportTest, self).setUp()
+        Distrito.create('D1', 'uno')
+        data = 'national_id,distrito,name,lat,lon,address,picture_url\n' + \
+               ''.join('C{0},D1,n{0},19.{0},-99.1,a,p\n'.format(i) for i in range(ROWS))
+        self.patch(casilla_import.blobstore, 'BlobReader', lambda key: StringIO.StringIO(data))
+        self.patch(casilla_import, 'BATCH_SIZE', 200)
+        self.key = CasillaImport.start('/bucket/casillas.csv', 'csv')
+
+    def test_import(self):
+        self.run_tasks()
+        job = self.key.get()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.rows_ok, job.rows_failed), (ROWS, 0))
+        self.assertEqual(Casilla.query().count(), ROWS)
+
+    def test_resume_stale_running_job_from_checkpoint(self):
+        # The chain is lost right after the first checkpoint: the job is left running
+        self.patch(casilla_import, 'TASK_BUDGET_SECONDS', -1)
+        self.taskqueue.FlushQueue('default')
+        casilla_import.run(self.key.urlsafe())
+        self.taskqueue.FlushQueue('default')
+        job = self.key.get()
+        self.assertEqual((job.status, job.rows_ok), ('running', 200))
+
+        # Not stale yet
+        self.assertRaises(CasillaImportError, CasillaImport.resume, self.key.urlsafe())
+
+        self.patch(casilla_import, 'RESUME_STALE_SECONDS', -1)
+        self.assertEqual(CasillaImport.resume(self.key.urlsafe()).status, 'pending')
+        self.run_tasks()
+        job = self.key.get()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.rows_ok, job.lines), (ROWS, ROWS))
+
+    def test_failed_batch_is_not_counted_twice(self):
+        self.taskqueue.FlushQueue('default')
+        put = casilla_import.search.Index.put
+        calls = []
+
+        def flaky(index, documents):
+            calls.append(len(documents))
+            if len(calls) == 2:
+                raise Exception('Search API unavailable')
+            return put(index, documents)
+
+        self.patch(casilla_import.search.Index, 'put', flaky)
+        casilla_import.run(self.key.urlsafe())
+        job = self.key.get()
+        self.assertEqual((job.status, job.rows_ok), ('failed', 200))
+
+        CasillaImport.resume(self.key.urlsafe())
+        self.run_tasks()
+        job = self.key.get()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.rows_ok, job.rows_failed, job.lines), (ROWS, 0, ROWS))
+
+    def test_resume_refuses_done_imports(self):
+        self.run_tasks()
+        self.patch(casilla_import, 'RESUME_STALE_SECONDS', -1)
+        self.assertRaises(CasillaImportError, CasillaImport.resume, self.key.urlsafe())
+        self.assertRaises(CasillaImportError, CasillaImport.resume, ndb.Key(CasillaImport, 1).urlsafe())
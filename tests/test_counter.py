@@ -0,0 +1,87 @@
+import time
+import datetime
+
+import testutil
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import counter
+import observacion
+from observacion import Observacion, OBSERVACIONES_COUNTER
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+
+
+class CounterTest(testutil.TestCase):
+
+    def test_increments_are_summed(self):
+        for i in range(30):
+            counter.increment('c')
+        counter.increment('c', 5)
+        self.assertEqual(counter.get_count('c'), 35)
+        memcache.flush_all()
+        self.assertEqual(counter.get_count('c'), 35)
+
+    def test_generations(self):
+        self.assertEqual(counter.increment('c', 3), 0)
+        closing = counter.close_generation('c')
+        self.assertEqual(closing, 0)
+        self.assertIsNone(counter.close_generation('c'))
+        for i in range(10):
+            self.assertEqual(counter.increment('c'), 1)
+        self.assertEqual(counter.get_shards_total('c'), 13)
+        # The recount of generation 0 replaces it, the increments of generation 1 are kept
+        counter.set_closed_total('c', closing, 7)
+        self.assertEqual(counter.get_count('c'), 17)
+        self.assertEqual(counter.close_generation('c'), 1)
+        self.assertEqual(counter.get_shards_total('c'), 17)
+
+
+class ReconcileCountTest(testutil.TestCase):
+
+    def setUp(self):
+        super(ReconcileCountTest, self).setUp()
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Casilla(id='C1', national_id='C1', distrito=ndb.Key(Distrito, 'D1'), loc=ndb.GeoPt(19, -99)).put()
+        self.clasificacion = Clasificacion.create('x', '{}', True).urlsafe()
+        self.patch(observacion, 'RECONCILE_PAGE_SIZE', 3)
+        self.patch(observacion, 'RECONCILE_PAGES_PER_TASK', 1)
+
+    def save(self, n, date=None):
+        for i in range(n):
+            Observacion.save_batch([{'observador': 'a@b.mx', 'casilla': 'C1', 'clasificacion': self.clasificacion,
+                                     'filled_checklist': '{}', 'date': date}])
+
+    def count(self):
+        memcache.flush_all()
+        return counter.get_count(OBSERVACIONES_COUNTER)
+
+    def test_uncounted_observaciones_are_added(self):
+        self.save(7)
+        # Written before the counter
+        Observacion(casilla=ndb.Key(Casilla, 'C1')).put()
+        Observacion(casilla=ndb.Key(Casilla, 'C1')).put()
+        self.assertEqual(self.count(), 7)
+        observacion.reconcile_count()
+        self.run_tasks()
+        self.assertEqual(self.count(), 9)
+
+    def test_observaciones_written_during_the_scan_are_counted_once(self):
+        self.save(10)
+        self.taskqueue.FlushQueue('default')
+        observacion.reconcile_count()
+        # Dated before the reconciliation started (an ingest retried for an hour), but written during the scan
+        before = time.mktime((datetime.datetime.utcnow() - datetime.timedelta(hours=1)).timetuple())
+        self.save(4, date=before)
+        self.run_tasks()
+        self.save(1)
+        self.assertEqual(self.count(), Observacion.query().count())
+        self.assertEqual(self.count(), 15)
+
+        # Reconciling again does not change an exact counter
+        observacion.reconcile_count()
+        self.run_tasks()
+        self.assertEqual(self.count(), 15)
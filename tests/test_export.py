@@ -0,0 +1,68 @@
+import csv
+import json
+import StringIO
+
+import testutil
+from google.appengine.ext import ndb
+
+import export
+from export import ObservacionExport, ExportError
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+from observacion import Observacion
+
+
+ROWS = 11
+
+
+class ExportTest(testutil.TestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.patch(export, 'WRITER', 'local')
+        self.patch(export, 'PAGE_SIZE', 4)
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Casilla(id='C1', national_id='C1', name='n', distrito=ndb.Key(Distrito, 'D1'), loc=ndb.GeoPt(19, -99)).put()
+        clasificacion = Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), True)
+        Observacion.save_batch([{'observador': 'a@b.mx',
+                                 'casilla': 'C1',
+                                 'clasificacion': clasificacion.urlsafe(),
+                                 'filled_checklist': json.dumps({'sellada': i % 2 == 0})} for i in range(ROWS)])
+        self.key = ObservacionExport.start('/bucket/observaciones.csv', 'csv')
+
+    def rows(self):
+        return list(csv.DictReader(StringIO.StringIO(export.read_local(self.key.urlsafe()))))
+
+    def test_export(self):
+        self.run_tasks()
+        job = self.key.get()
+        self.assertEqual((job.status, job.rows), ('done', ROWS))
+        rows = self.rows()
+        self.assertEqual(len(set(r['key'] for r in rows)), ROWS)
+        self.assertEqual(rows[0]['casilla_name'], 'n')
+
+    def test_resume_stale_running_export_from_checkpoint(self):
+        # The chain is lost after the first checkpoint: the job is left running with the file of the checkpoint
+        self.patch(export, 'TASK_BUDGET_SECONDS', -1)
+        self.taskqueue.FlushQueue('default')
+        export.run(self.key.urlsafe())
+        self.taskqueue.FlushQueue('default')
+        job = self.key.get()
+        self.assertEqual((job.status, job.rows), ('running', 4))
+
+        self.assertRaises(ExportError, ObservacionExport.resume, self.key.urlsafe())
+        self.patch(export, 'RESUME_STALE_SECONDS', -1)
+        self.assertEqual(ObservacionExport.resume(self.key.urlsafe()).status, 'pending')
+        self.run_tasks()
+        self.assertEqual(self.key.get().status, 'done')
+        rows = self.rows()
+        self.assertEqual(len(rows), ROWS)
+        self.assertEqual(len(set(r['key'] for r in rows)), ROWS)
+
+    def test_resume_refuses_done_exports(self):
+        self.run_tasks()
+        self.patch(export, 'RESUME_STALE_SECONDS', -1)
+        self.assertRaises(ExportError, ObservacionExport.resume, self.key.urlsafe())
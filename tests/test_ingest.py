@@ -0,0 +1,71 @@
+import json
+
+import testutil
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import ingest
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+from observacion import Observacion, WRITE_ERROR, ALREADY_EXISTS
+
+
+@ndb.tasklet
+def _timeout(cls, *args):
+    raise datastore_errors.Timeout('The datastore operation timed out')
+
+
+class ProcessQueueTest(testutil.TestCase):
+
+    def setUp(self):
+        super(ProcessQueueTest, self).setUp()
+        self.patch(ingest, 'QUEUE', 'local')
+        self.patch(ingest, 'local_queue', ingest.LocalQueue())
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Observador.create_in_datastore('G+', 31, 'b@b.mx', 'B', 'i')
+        Casilla(id='C1', national_id='C1', distrito=ndb.Key(Distrito, 'D1'), loc=ndb.GeoPt(19, -99)).put()
+        self.clasificacion = Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), True).urlsafe()
+
+    def enqueue(self, observador='a@b.mx', casilla='C1', submission_id=None):
+        return ingest.enqueue_observacion(observador, casilla, self.clasificacion, json.dumps({'sellada': True}),
+                                          submission_id)
+
+    def test_writes_the_queue(self):
+        key = self.enqueue()
+        ingest.process_queue()
+        self.assertEqual(len(ingest.local_queue), 0)
+        self.assertEqual(ingest.get_status(key), ('written', None))
+
+    def test_unknown_casilla_fails_on_the_first_attempt(self):
+        key = self.enqueue(casilla='C9')
+        ingest.process_queue()
+        self.assertEqual(len(ingest.local_queue), 0)
+        self.assertEqual(ingest.get_status(key), ('failed', 'Casilla does not exist'))
+
+    def test_used_id_fails_on_the_first_attempt(self):
+        key = self.enqueue(submission_id='sub-1')
+        ingest.process_queue()
+        self.assertEqual(self.enqueue('b@b.mx', submission_id='sub-1'), key)
+        ingest.process_queue()
+        self.assertEqual(len(ingest.local_queue), 0)
+        self.assertEqual(ingest.get_status(key), ('failed', ALREADY_EXISTS))
+        self.assertEqual(ndb.Key(urlsafe=key).get().observador, ndb.Key(Observador, 'a@b.mx'))
+
+    def test_failed_write_is_retried(self):
+        self.patch(Observacion, '_write_async', classmethod(_timeout))
+        key = self.enqueue()
+        ingest.process_queue()
+        self.assertEqual(len(ingest.local_queue), 1)
+        self.assertEqual(ingest.get_status(key), ('pending', None))
+
+        # Last lease
+        task = ingest.local_queue.tasks[0]
+        task.retry_count, task.leased_until = ingest.MAX_RETRIES, 0
+        ingest.process_queue()
+        self.assertEqual(len(ingest.local_queue), 0)
+        status, reason = ingest.get_status(key)
+        self.assertEqual(status, 'failed')
+        self.assertTrue(reason.startswith(WRITE_ERROR))
@@ -0,0 +1,74 @@
+import json
+import datetime
+
+import testutil
+from google.appengine.ext import ndb
+
+import api
+import rollup
+import messages
+import observacion
+from rollup import RollupError
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+from observacion import Observacion
+
+
+class RollupTest(testutil.TestCase):
+
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Casilla(id='C1', national_id='C1', distrito=ndb.Key(Distrito, 'D1'), loc=ndb.GeoPt(19, -99)).put()
+        # Created by hand, without distrito
+        Casilla(id='C2', national_id='C2', loc=ndb.GeoPt(19, -99)).put()
+        self.clasificacion = Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), True)
+
+    def save(self, casilla, n):
+        return Observacion.save_batch([{'observador': 'a@b.mx',
+                                        'casilla': casilla,
+                                        'clasificacion': self.clasificacion.urlsafe(),
+                                        'filled_checklist': json.dumps({'sellada': True})} for i in range(n)])
+
+    def test_buckets_need_a_bounded_range(self):
+        self.save('C1', 6)
+        now = datetime.datetime.utcnow()
+        buckets = rollup.get_buckets(start=now - datetime.timedelta(hours=1))
+        self.assertEqual([(d, c, count) for d, c, bucket, count in buckets],
+                         [(ndb.Key(Distrito, 'D1'), self.clasificacion, 6)])
+        self.assertEqual(rollup.get_buckets(ndb.Key(Distrito, 'D1'), start=now - datetime.timedelta(hours=1),
+                                            end=now - datetime.timedelta(minutes=30)), [])
+
+        for start, end in ((None, None), (None, now), (now - datetime.timedelta(hours=25), now)):
+            with self.assertRaises(RollupError):
+                rollup.get_buckets(start=start, end=end)
+
+        self.patch(rollup, 'MAX_BUCKET_ROLLUPS', 1)
+        self.save('C1', 8)
+        with self.assertRaises(RollupError) as raised:
+            rollup.get_buckets(start=now - datetime.timedelta(hours=1))
+        self.assertIn('Too many buckets', raised.exception.value)
+
+    def test_endpoint_reads_buckets_only_for_a_range(self):
+        self.save('C1', 2)
+        resp = api.ObservadorElectoralBackendApi().observacion_rollups(messages.GetObservacionRollups(casillas=['C1']))
+        self.assertTrue(resp.ok)
+        self.assertEqual((len(resp.buckets), [c.count for c in resp.casillas]), (0, [2]))
+
+        resp = api.ObservadorElectoralBackendApi().observacion_rollups(
+            messages.GetObservacionRollups(end=datetime.datetime.utcnow().strftime(rollup.BUCKET_FORMAT)))
+        self.assertEqual((resp.ok, resp.error), (None, 'The first bucket of the range is required'))
+
+    def test_observaciones_need_a_distrito(self):
+        self.assertEqual(self.save('C2', 1), [(None, observacion.NO_DISTRITO)])
+        self.assertEqual(Observacion.query().count(), 0)
+
+        # A legacy observacion of that casilla is left for a later backfill, the others are added
+        Observacion(casilla=ndb.Key(Casilla, 'C2'), clasificacion=self.clasificacion).put()
+        Observacion(casilla=ndb.Key(Casilla, 'C1'), clasificacion=self.clasificacion).put()
+        observacion.backfill_rollups()
+        self.assertEqual([count for n, count, last in rollup.get_casillas(['C1', 'C2'])], [1, 0])
+        self.assertIsNone(Observacion.query(Observacion.casilla == ndb.Key(Casilla, 'C2')).get().distrito)
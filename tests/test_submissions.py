@@ -0,0 +1,92 @@
+import json
+
+import testutil
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import sync
+from casilla import Casilla
+from distrito import Distrito
+from observador import Observador
+from clasificacion import Clasificacion
+from location import Location, LocationCreationError
+from observacion import Observacion, ObservacionCreationError
+
+
+class SubmissionTest(testutil.TestCase):
+
+    def setUp(self):
+        super(SubmissionTest, self).setUp()
+        Distrito.create('D1', 'uno')
+        Observador.create_in_datastore('G+', 30, 'a@b.mx', 'A', 'i')
+        Observador.create_in_datastore('G+', 31, 'b@b.mx', 'B', 'i')
+        for national_id in ('C1', 'C2'):
+            Casilla(id=national_id, national_id=national_id, distrito=ndb.Key(Distrito, 'D1'),
+                    loc=ndb.GeoPt(19, -99)).put()
+        self.clasificacion = Clasificacion.create(u'Apertura', json.dumps({'sellada': 'boolean'}), True).urlsafe()
+        self.checklist = json.dumps({'sellada': True})
+
+    def forget(self):
+        # Another instance, once the dedup cache expired
+        memcache.flush_all()
+        testutil._clear_instance_caches()
+
+    def save(self, observador, casilla='C1'):
+        return Observacion.save_to_datastore(observador, casilla, self.clasificacion, self.checklist, 'sub-1')
+
+    def test_observacion_replay_returns_the_same_key(self):
+        key = self.save('a@b.mx')
+        self.assertEqual(self.save('a@b.mx'), key)
+        self.forget()
+        self.assertEqual(self.save('a@b.mx'), key)
+        self.assertEqual(Observacion.query().count(), 1)
+
+    def test_observacion_of_another_submission_is_a_conflict(self):
+        self.save('a@b.mx')
+        for forget in (False, True):
+            if forget:
+                self.forget()
+            for observador, casilla in (('b@b.mx', 'C1'), ('a@b.mx', 'C2')):
+                with self.assertRaises(ObservacionCreationError) as raised:
+                    self.save(observador, casilla)
+                self.assertEqual(raised.exception.value, 'Observacion already exists in platform')
+        self.assertEqual(ndb.Key(Observacion, 'sub-1').get().observador, ndb.Key(Observador, 'a@b.mx'))
+
+    def test_batch_reports_conflicts_per_submission(self):
+        self.save('a@b.mx')
+        results = Observacion.save_batch([{'observador': observador,
+                                           'casilla': 'C1',
+                                           'clasificacion': self.clasificacion,
+                                           'filled_checklist': self.checklist,
+                                           'id': sid} for observador, sid in (('b@b.mx', 'sub-1'),
+                                                                              ('b@b.mx', 'sub-2'),
+                                                                              ('a@b.mx', 'sub-1'))])
+        self.assertEqual(results[0], (None, 'Observacion already exists in platform'))
+        self.assertIsNone(results[1][1])
+        self.assertEqual(results[2], (ndb.Key(Observacion, 'sub-1').urlsafe(), None))
+        self.assertEqual(Observacion.query().count(), 2)
+
+    def test_location_of_another_observador_is_a_conflict(self):
+        key = Location.create('a@b.mx', '19.4,-99.1', 'loc-1')
+        self.assertEqual(Location.create('a@b.mx', '19.4,-99.1', 'loc-1'), key)
+        for forget in (False, True):
+            if forget:
+                self.forget()
+            with self.assertRaises(LocationCreationError) as raised:
+                Location.create('b@b.mx', '19.4,-99.1', 'loc-1')
+            self.assertEqual(raised.exception.value, 'Location already exists in platform')
+        self.assertEqual(key.get().observador, ndb.Key(Observador, 'a@b.mx'))
+
+    def test_sync_is_not_answered_from_the_cache_of_another_observador(self):
+        key = Location.create('a@b.mx', '19.4,-99.1', 'loc-1')
+        self.save('a@b.mx')
+        results = sync.upload([{'kind': 'location', 'observador': 'b@b.mx', 'loc': '19.4,-99.1',
+                                'submission_id': 'loc-1'},
+                               {'kind': 'observacion', 'observador': 'b@b.mx', 'casilla': 'C1',
+                                'clasificacion': self.clasificacion, 'filled_checklist': self.checklist,
+                                'submission_id': 'sub-1'},
+                               {'kind': 'location', 'observador': 'a@b.mx', 'loc': '19.4,-99.1',
+                                'submission_id': 'loc-1'}])
+        self.assertEqual(results, [(None, 'Location already exists in platform'),
+                                   (None, 'Observacion already exists in platform'),
+                                   (key.urlsafe(), None)])
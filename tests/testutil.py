@@ -0,0 +1,94 @@
+"""
+Test helpers for the Observador-Electoral backend. Puts the App Engine SDK and the application on sys.path and sets
+up the testbed stubs (datastore, memcache, taskqueue, search) for every test.
+
+Run the tests with a python 2.7 interpreter, from the application root:
+
+    GAE_SDK=/path/to/google_appengine python -m unittest discover -s tests
+"""
+__author__ = 'Cesar'
+
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDK = os.environ.get('GAE_SDK', os.path.expanduser('~/google-cloud-sdk/platform/google_appengine'))
+if SDK not in sys.path:
+    sys.path.insert(0, SDK)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+
+class TestCase(unittest.TestCase):
+    """
+    Activates a testbed with strongly consistent datastore, memcache, taskqueue and search stubs
+    """
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(current_version_id='1.1', overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy, require_indexes=False)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_search_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_urlfetch_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+        self.addCleanup(self.testbed.deactivate)
+        _clear_instance_caches()
+
+    def patch(self, owner, name, value):
+        """
+        Replaces owner.name with value for the duration of the test
+        """
+        original = getattr(owner, name)
+        setattr(owner, name, value)
+        self.addCleanup(setattr, owner, name, original)
+
+    def run_tasks(self, queue='default', max_rounds=20):
+        """
+        Runs the deferred tasks of the queue, and the ones they enqueue, returns how many ran
+        """
+        ran = 0
+        for i in range(max_rounds):
+            tasks = self.taskqueue.get_filtered_tasks(queue_names=[queue])
+            if not tasks:
+                break
+            self.taskqueue.FlushQueue(queue)
+            for task in tasks:
+                deferred.run(task.payload)
+                ran += 1
+        return ran
+
+
+def _clear_instance_caches():
+    """
+    Drops the per instance caches, so no test reads what a previous one cached
+    """
+    import cache
+    import casilla
+    import distrito
+    import observador
+    import clasificacion
+    import timeline
+    for c in (cache.submission_cache, observador.observador_cache, clasificacion.catalogue_cache,
+              timeline.timeline_cache):
+        c.local.clear()
+    clasificacion.compiled_checklists.clear()
+    with distrito.distrito_cache._lock:
+        distrito.distrito_cache.snapshot = None
+    with casilla.casillas_index._lock:
+        casilla.casillas_index.index = None
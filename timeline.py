@@ -0,0 +1,214 @@
+"""
+Defines the activity timeline of a casilla in the Observador-Electoral platform.
+
+The timeline holds the observaciones, notas and medias of a casilla, latest first. A page runs one query per kind
+concurrently (page size + 1 results, with the cursor after each one), merges them with a heap and keeps the first
+page size items. The cursor of the next page holds a cursor per kind, right after the last item of that kind in the
+page, so no item is repeated or skipped.
+
+Pages are cached for CACHE_TTL seconds: a casilla watched live is read by many coordinators at once.
+
+Notas and medias created before they carried their casilla are not in the timeline until backfill_casillas has run,
+start it (e.g. from the remote api shell) with:
+
+    from google.appengine.ext import deferred
+    import timeline
+    deferred.defer(timeline.backfill_casillas)
+"""
+__author__ = 'Cesar'
+
+
+import json
+import heapq
+import base64
+import hashlib
+import logging
+import datetime
+import itertools
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+
+from casilla import Casilla
+from observacion import Observacion
+from nota import Nota
+from media import Media
+from cache import TwoTierCache
+
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+CACHE_TTL = 10
+BACKFILL_BATCH_SIZE = 200
+KINDS = ('observacion', 'nota', 'media')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Pages of the timelines (casilla|page size|cursor hash -> page), short lived in both tiers. Pages are shared by the
+# requests of the instance, never modify them
+timeline_cache = TwoTierCache('timeline', max_size=500, local_ttl=CACHE_TTL, memcache_ttl=CACHE_TTL)
+
+
+def _query(kind, casilla_key):
+    if kind == 'observacion':
+        # Projection, the checklist is not part of the timeline
+        return Observacion.query(Observacion.casilla == casilla_key,
+                                 projection=[Observacion.date, Observacion.observador, Observacion.clasificacion]) \
+            .order(-Observacion.date)
+    model = Nota if kind == 'nota' else Media
+    return model.query(model.casilla == casilla_key).order(-model.created)
+
+
+def _date(entity):
+    return entity.date if isinstance(entity, Observacion) else entity.created
+
+
+@ndb.tasklet
+def _fetch_async(kind, casilla_key, cursor, limit):
+    """
+    Up to limit (entity, cursor after it) of a kind, latest first
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    it = _query(kind, casilla_key).iter(limit=limit, batch_size=limit, start_cursor=start_cursor,
+                                        produce_cursors=True)
+    results = []
+    while (yield it.has_next_async()):
+        entity = it.next()
+        results.append((entity, it.cursor_after()))
+    raise ndb.Return(results)
+
+
+def _item(kind, entity):
+    """
+    Timeline item (dict) of an entity
+    """
+    item = {'kind': kind, 'url_safe_key': entity.key.urlsafe(), 'date': _date(entity)}
+    if kind == 'observacion':
+        item['observador'] = entity.observador.id() if entity.observador else None
+        item['clasificacion'] = entity.clasificacion.urlsafe() if entity.clasificacion else None
+    else:
+        item['observacion'] = entity.observacion.urlsafe() if entity.observacion else None
+        item['name'] = entity.name
+        if kind == 'media':
+            item['m_type'] = entity.m_type
+    return item
+
+
+def _decode_cursor(cursor):
+    """
+    (kind -> URL safe cursor, kinds exhausted) of a timeline cursor
+    """
+    if not cursor:
+        return {}, set()
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        cursors, done = state['c'], set(state['d'])
+        valid = isinstance(cursors, dict) and all(k in KINDS and isinstance(c, basestring) for k, c in cursors.items())
+    except Exception:
+        valid = False
+    if not valid or not done.issubset(KINDS):
+        raise TimelineError('Invalid cursor')
+    return cursors, done
+
+
+def _encode_cursor(cursors, done):
+    return base64.urlsafe_b64encode(json.dumps({'c': cursors, 'd': sorted(done)}))
+
+
+@ndb.tasklet
+def get_page_async(casilla, cursor=None, page_size=PAGE_SIZE):
+    """
+    Gets a page of the timeline of a casilla, from timeline_cache.
+
+    Args:
+        - casilla:      national_id of the casilla
+        - cursor:       Cursor of the page, from the previous page, the first page if None
+        - page_size:    Items in the page, at most MAX_PAGE_SIZE
+
+    Returns:
+        Future, (list of items (dicts with kind, url_safe_key and date, plus observador and clasificacion for an
+        observacion, or observacion, name and m_type for a nota or media), cursor of the next page, more (Boolean))
+    """
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    cursors, done = _decode_cursor(cursor)
+    cache_key = '{0}|{1}|{2}'.format(casilla, page_size, hashlib.sha1(cursor or '').hexdigest())
+    try:
+        page = yield timeline_cache.get_async(cache_key,
+                                              lambda k: _load_page_async(casilla, cursors, done, page_size))
+    except TimelineError:
+        raise
+    except Exception as e:
+        logging.exception('[Timeline] - Error loading the timeline of {0}'.format(casilla))
+        raise TimelineError('Error getting the timeline: {0}'.format(e))
+    raise ndb.Return(page)
+
+
+def get_page(casilla, cursor=None, page_size=PAGE_SIZE):
+    return get_page_async(casilla, cursor, page_size).get_result()
+
+
+@ndb.tasklet
+def _load_page_async(casilla, cursors, done, page_size):
+    casilla_key = ndb.Key(Casilla, casilla)
+    kinds = [k for k in KINDS if k not in done]
+    try:
+        fetched = yield [_fetch_async(k, casilla_key, cursors.get(k), page_size + 1) for k in kinds]
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError, datastore_errors.BadArgumentError):
+        # A per kind cursor that does not decode, or is not a cursor of its query
+        if not cursors:
+            raise
+        raise TimelineError('Invalid cursor')
+    fetched = dict(zip(kinds, fetched))
+
+    # Latest first: the streams are sorted by negated timestamp, ties broken by kind and position
+    streams = [[(-(_date(entity) - EPOCH).total_seconds(), rank, i, kind)
+                for i, (entity, after) in enumerate(fetched[kind])]
+               for rank, kind in enumerate(kinds)]
+    merged = list(itertools.islice(heapq.merge(*streams), page_size))
+
+    consumed = dict((kind, 0) for kind in kinds)
+    items = []
+    for ts, rank, i, kind in merged:
+        items.append(_item(kind, fetched[kind][i][0]))
+        consumed[kind] = i + 1
+    next_cursors = dict(cursors)
+    next_done = set(done)
+    for kind in kinds:
+        if consumed[kind]:
+            next_cursors[kind] = fetched[kind][consumed[kind] - 1][1].urlsafe()
+        if consumed[kind] == len(fetched[kind]):
+            next_done.add(kind)
+    more = len(next_done) < len(KINDS)
+    raise ndb.Return((items, _encode_cursor(next_cursors, next_done) if more else None, more))
+
+
+def backfill_casillas(kind='nota', cursor=None):
+    """
+    Sets the casilla of the notas and medias created before they carried it, chaining itself every
+    BACKFILL_BATCH_SIZE entities, notas first.
+        :param kind: nota or media
+        :param cursor: URL safe cursor to continue the scan from
+    """
+    model = Nota if kind == 'nota' else Media
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    page, start_cursor, more = model.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=start_cursor)
+    legacy = [e for e in page if e.casilla is None and e.observacion is not None]
+    o_keys = list(set(e.observacion for e in legacy))
+    casillas = dict((k, o.casilla) for k, o in zip(o_keys, ndb.get_multi(o_keys)) if o)
+    updated = [e for e in legacy if casillas.get(e.observacion)]
+    for e in updated:
+        e.casilla = casillas[e.observacion]
+    ndb.put_multi(updated)
+    if more:
+        deferred.defer(backfill_casillas, kind, start_cursor.urlsafe())
+    elif kind == 'nota':
+        deferred.defer(backfill_casillas, 'media')
+    else:
+        logging.info('[Timeline] - Casillas backfill done')
+
+
+class TimelineError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,22 @@
+"""
+Handler of the warmup requests (/_ah/warmup): loads the per instance caches before the instance gets traffic
+"""
+__author__ = 'Cesar'
+
+
+import logging
+import webapp2
+
+from distrito import distrito_cache
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        try:
+            distrito_cache.load()
+        except Exception:
+            # The caches load on first use instead
+            logging.exception('[Warmup] - Error loading the distritos')
+
+
+app = webapp2.WSGIApplication([('/_ah/warmup', WarmupHandler)])